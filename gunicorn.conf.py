@@ -0,0 +1,26 @@
+"""
+gunicorn sozlamalari.
+
+    gunicorn -c gunicorn.conf.py 'main:create_app()'
+
+preload_app: main.py master jarayonda bir marta import qilinadi, workerlar uni copy-on-write
+orqali bo'lishadi. DB ulanishlari va fon threadlari esa post_fork da, har bir workerda ochiladi.
+"""
+import gc
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+workers = int(os.environ.get('WEB_CONCURRENCY', '2'))
+preload_app = os.environ.get('GUNICORN_PRELOAD', '1') == '1'
+
+
+def when_ready(server):
+    # Import paytida yaratilgan obyektlarni GC kuzatuvidan chiqaramiz, aks holda
+    # workerlardagi birinchi GC sahifalarga yozib, copy-on-write bo'lishni buzadi
+    if preload_app:
+        gc.freeze()
+
+
+def post_fork(server, worker):
+    import main
+    main.on_worker_start()
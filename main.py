@@ -1,32 +1,59 @@
-from flask import Flask, request, jsonify, redirect, url_for, session, send_from_directory
+import time
+_IMPORT_STARTED = time.perf_counter()
+
+from flask import Flask, request, jsonify, redirect, url_for, session, send_file, abort, Response, stream_with_context, g, has_request_context
 from flask_socketio import SocketIO, emit, join_room, leave_room
 import json
+import csv
+import io
 import sqlite3
+import importlib.util
 import secrets
 import hashlib
 import datetime
 import os
+import math
+import socket
+import struct
+import threading
+import queue
+import mimetypes
+import gzip
+import zlib
+import atexit
+import glob
+import pathlib
+import urllib.parse
+import shutil
+import click
+import logging
 import html as html_module
 from functools import wraps
-from werkzeug.utils import secure_filename
-from collections import OrderedDict
+from werkzeug.utils import secure_filename, safe_join
+from werkzeug.middleware.proxy_fix import ProxyFix
+from collections import OrderedDict, Counter, deque
 
-try:
-    from mcstatus import JavaServer
-    MCSTATUS_AVAILABLE = True
-except ImportError:
-    MCSTATUS_AVAILABLE = False
+# Og'ir klientlar birinchi ishlatilganda import qilinadi — bu yerda faqat mavjudligi tekshiriladi
+MCSTATUS_AVAILABLE = importlib.util.find_spec('mcstatus') is not None
+PIL_AVAILABLE = importlib.util.find_spec('PIL') is not None
 
 try:
-    from mcrcon import MCRcon
-    MCRCON_AVAILABLE = True
+    import brotli
+    BROTLI_AVAILABLE = True
 except ImportError:
-    MCRCON_AVAILABLE = False
+    BROTLI_AVAILABLE = False
 
-DATABASE_URL = os.environ.get('DATABASE_URL')
+# FTS5 siz yig'ilgan SQLite da support qidiruvi LIKE ga qaytadi
+_probe = sqlite3.connect(':memory:')
+FTS5_AVAILABLE = bool(_probe.execute("SELECT sqlite_compileoption_used('ENABLE_FTS5')").fetchone()[0])
+_probe.close()
+
+# sqlite:///elitemc.db (fayl) yoki sqlite:///:memory: (jarayon ichida) — pastda open_database()
+DATABASE_URL = os.environ.get('DATABASE_URL') or 'sqlite:///elitemc.db'
 SECRET_KEY = os.environ.get('SECRET_KEY', 'dev_fallback_key_12345')
 
-app = Flask(__name__)
+# /static ni o'zimiz xizmat qilamiz (kesh, Range, oldindan siqilgan variantlar) — pastda static_files()
+app = Flask(__name__, static_folder=None)
 app.secret_key = SECRET_KEY
 
 app.config['SESSION_COOKIE_SECURE'] = True
@@ -35,10 +62,18 @@ app.config['SESSION_COOKIE_SAMESITE'] = 'Lax'
 app.config['PERMANENT_SESSION_LIFETIME'] = datetime.timedelta(days=7)
 app.config['UPLOAD_FOLDER'] = 'static/uploads'
 app.config['ALLOWED_EXTENSIONS'] = {'png', 'jpg', 'jpeg', 'gif', 'webp'}
+app.config['MAX_UPLOAD_BYTES'] = int(os.environ.get('MAX_UPLOAD_MB', '8')) * 1024 * 1024
+# Forma maydonlari uchun ozgina zaxira; undan kattasi 413 bilan darhol rad etiladi
+app.config['MAX_CONTENT_LENGTH'] = app.config['MAX_UPLOAD_BYTES'] + 64 * 1024
 
 if not os.path.exists(app.config['UPLOAD_FOLDER']):
     os.makedirs(app.config['UPLOAD_FOLDER'])
 
+# Reverse proxy ortida (Heroku router, nginx) haqiqiy klient IP X-Forwarded-For dan olinadi
+PROXY_HOPS = int(os.environ.get('PROXY_HOPS', '0'))
+if PROXY_HOPS:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=PROXY_HOPS)
+
 socketio = SocketIO(app, cors_allowed_origins="*", async_mode='threading')
 
 # C418 - Aria Math (orqa fon musiqasi)
@@ -48,14 +83,22 @@ C418_MUSIC_URL = "https://www.youtube.com/embed/TY6KMrkgaH4?autoplay=1&loop=1&pl
 def get_real_online(ip_address):
     if not MCSTATUS_AVAILABLE:
         return None
+    from mcstatus import JavaServer
+    if not breaker_allow('status'):
+        return 0
+    started = time.perf_counter()
     try:
         if ':' in ip_address:
             server = JavaServer.lookup(ip_address)
         else:
             server = JavaServer.lookup(ip_address)
         status = server.status()
+        metric_observe('status_poll_duration_seconds', time.perf_counter() - started, ok='1')
+        breaker_record('status', True)
         return status.players.online
-    except Exception:
+    except Exception as e:
+        metric_observe('status_poll_duration_seconds', time.perf_counter() - started, ok='0')
+        breaker_record('status', False, str(e) or type(e).__name__)
         return 0
 
 
@@ -64,8 +107,12 @@ def allowed_file(filename: str) -> bool:
 
 
 def get_db():
-    conn = sqlite3.connect('elitemc.db')
-    conn.row_factory = sqlite3.Row
+    """Puldan ulanish (DATABASE_URL bo'yicha); conn.close() uni pulga qaytaradi."""
+    if not _schema_ready:
+        ensure_schema()
+    conn = db.connect()
+    if has_request_context() and g.get('sql_profile') is not None:
+        sql_profile_attach(conn)
     return conn
 
 
@@ -73,57 +120,817 @@ def sanitize(text: str) -> str:
     return html_module.escape(str(text))
 
 
-def execute_purchase(minecraft_nick: str, pkg, server_mode=None):
+# ═══════════════════════════════════════════════
+# METRICS — Prometheus text format, aggregated across workers via METRICS_DIR
+# ═══════════════════════════════════════════════
+
+METRICS_DIR = os.environ.get('PROMETHEUS_MULTIPROC_DIR') or os.environ.get('METRICS_DIR', 'metrics')
+# /metrics faqat shu token bilan (Authorization: Bearer ...) ochiladi; berilmasa endpoint yopiq —
+# proxy ortida (PROXY_HOPS=0 bo'lsa) har bir so'rov 127.0.0.1 dan kelgandek ko'rinadi, loopback ga ishonib bo'lmaydi
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+METRICS_FLUSH_INTERVAL = 1.0
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (1, 2, 3, 5, 8, 13, 21, 50, 100)
+
+METRIC_HELP = {
+    'http_request_duration_seconds': ('histogram', 'Request latency by endpoint'),
+    'db_queries_per_request': ('histogram', 'SQL statements executed per request'),
+    'db_time_per_request_seconds': ('histogram', 'Time spent in SQLite per request'),
+    'db_queries_total': ('counter', 'SQL statements executed'),
+    'db_query_seconds_total': ('counter', 'Time spent in SQLite'),
+    'rcon_command_duration_seconds': ('histogram', 'RCON connect+auth+command latency'),
+    'rcon_batch_duration_seconds': ('histogram', 'RCON connect+auth+pipelined batch latency'),
+    'rcon_commands_total': ('counter', 'RCON commands sent'),
+    'rcon_failures_total': ('counter', 'Failed RCON commands'),
+    'breaker_transitions_total': ('counter', 'Circuit breaker state changes per game server'),
+    'status_poll_duration_seconds': ('histogram', 'Server List Ping latency'),
+    'ratelimit_rejected_total': ('counter', 'Requests rejected by the rate limiter'),
+    'socketio_connections': ('gauge', 'Open Socket.IO connections'),
+}
+
+# (name, ((label, value), ...)) -> qiymat; histogramlar uchun [bucket1..bucketN, +Inf, sum]
+_metrics = {'counter': {}, 'gauge': {}, 'histogram': {}}
+_metrics_lock = threading.Lock()
+_metrics_flushed_at = 0.0
+
+
+def _metric_key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def metric_inc(name, value=1.0, **labels):
+    key = _metric_key(name, labels)
+    with _metrics_lock:
+        _metrics['counter'][key] = _metrics['counter'].get(key, 0.0) + value
+
+
+def metric_gauge_add(name, delta, **labels):
+    key = _metric_key(name, labels)
+    with _metrics_lock:
+        _metrics['gauge'][key] = _metrics['gauge'].get(key, 0.0) + delta
+
+
+def metric_observe(name, value, buckets=LATENCY_BUCKETS, **labels):
+    key = _metric_key(name, labels)
+    with _metrics_lock:
+        h = _metrics['histogram'].get(key)
+        if h is None:
+            h = _metrics['histogram'][key] = [0] * (len(buckets) + 1) + [0.0]
+        for i, bound in enumerate(buckets):
+            if value <= bound:
+                h[i] += 1
+                break
+        else:
+            h[len(buckets)] += 1
+        h[-1] += value
+
+
+def metrics_flush(force=False):
+    """Shu workerning ko'rsatkichlarini METRICS_DIR/<pid>.json ga yozadi (ko'pi bilan sekundiga bir marta)."""
+    global _metrics_flushed_at
+    now = time.monotonic()
+    if not force and now - _metrics_flushed_at < METRICS_FLUSH_INTERVAL:
+        return
+    _metrics_flushed_at = now
+    with _metrics_lock:
+        snapshot = {kind: [[name, list(labels), value] for (name, labels), value in items.items()]
+                    for kind, items in _metrics.items()}
+    try:
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        path = os.path.join(METRICS_DIR, f'{os.getpid()}.json')
+        with open(path + '.tmp', 'w') as f:
+            json.dump(snapshot, f)
+        os.replace(path + '.tmp', path)
+    except OSError as e:
+        app.logger.warning("Metrics yozilmadi: %s", e)
+
+
+atexit.register(metrics_flush, True)
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def render_metrics() -> str:
+    metrics_flush(force=True)
+    totals = {'counter': {}, 'gauge': {}, 'histogram': {}}
+    for path in glob.glob(os.path.join(METRICS_DIR, '*.json')):
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            continue
+        alive = _pid_alive(int(os.path.basename(path)[:-5]))
+        for kind, items in data.items():
+            if kind == 'gauge' and not alive:
+                continue  # to'xtagan workerning ochiq ulanishlari endi yo'q
+            for name, labels, value in items:
+                key = (name, tuple(tuple(kv) for kv in labels))
+                if kind == 'histogram':
+                    cur = totals[kind].get(key)
+                    totals[kind][key] = value if cur is None else [a + b for a, b in zip(cur, value)]
+                else:
+                    totals[kind][key] = totals[kind].get(key, 0.0) + value
+
+    def fmt_labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{k}="{str(v).replace(chr(34), chr(39))}"' for k, v in pairs) + '}'
+
+    lines = []
+    for name, (kind, help_text) in METRIC_HELP.items():
+        series = sorted((k, v) for k, v in totals[kind].items() if k[0] == name)
+        if not series:
+            continue
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {kind}')
+        for (_, labels), value in series:
+            if kind != 'histogram':
+                lines.append(f'{name}{fmt_labels(labels)} {value:g}')
+                continue
+            buckets = COUNT_BUCKETS if name == 'db_queries_per_request' else LATENCY_BUCKETS
+            cumulative = 0
+            for bound, count in zip(buckets, value):
+                cumulative += count
+                lines.append(f'{name}_bucket{fmt_labels(labels, [("le", f"{bound:g}")])} {cumulative}')
+            cumulative += value[len(buckets)]
+            lines.append(f'{name}_bucket{fmt_labels(labels, [("le", "+Inf")])} {cumulative}')
+            lines.append(f'{name}_sum{fmt_labels(labels)} {value[-1]:g}')
+            lines.append(f'{name}_count{fmt_labels(labels)} {cumulative}')
+    return '\n'.join(lines) + '\n'
+
+
+class InstrumentedCursor(sqlite3.Cursor):
     """
-    server_mode: 'anarchy' yoki 'smp' - faqat Unban/Unmute uchun
+    execute va fetch vaqtini so'rov (flask.g) va umumiy hisoblagichlarga qo'shadi.
+    SLOW_QUERY_MS dan sekin statementlar logga yoziladi; profil yoqilgan bo'lsa qatorlar ham sanaladi.
+    """
+    _sql = None
+    _prof = None
+    _elapsed = 0.0
+    _slow_logged = False
+
+    def _timed(self, method, *args):
+        started = time.perf_counter()
+        try:
+            return method(*args)
+        finally:
+            elapsed = time.perf_counter() - started
+            _record_db_time(elapsed)
+            self._elapsed += elapsed
+            if self._prof is not None:
+                self._prof['ms'] += elapsed * 1000
+            if not self._slow_logged and self._elapsed * 1000 >= SLOW_QUERY_MS:
+                self._slow_logged = True
+                _log_slow_query(self._sql, self._elapsed, self.rowcount)
+
+    def _begin(self, sql, parameters):
+        self._sql, self._elapsed, self._slow_logged = sql, 0.0, False
+        self._prof = sql_profile_begin(sql, parameters)
+
+    def _count_rows(self, n):
+        if self._prof is not None:
+            self._prof['rows'] += n
+
+    def execute(self, sql, parameters=()):
+        self._begin(sql, parameters)
+        result = self._timed(super().execute, sql, parameters)
+        _record_db_query()
+        if self._prof is not None and self.rowcount > 0:
+            self._count_rows(self.rowcount)
+        return result
+
+    def executemany(self, sql, seq_of_parameters):
+        self._begin(sql, ())
+        result = self._timed(super().executemany, sql, seq_of_parameters)
+        _record_db_query()
+        if self._prof is not None and self.rowcount > 0:
+            self._count_rows(self.rowcount)
+        return result
+
+    def fetchone(self):
+        row = self._timed(super().fetchone)
+        if row is not None:
+            self._count_rows(1)
+        return row
+
+    def fetchmany(self, size=None):
+        rows = self._timed(super().fetchmany, self.arraysize if size is None else size)
+        self._count_rows(len(rows))
+        return rows
+
+    def fetchall(self):
+        rows = self._timed(super().fetchall)
+        self._count_rows(len(rows))
+        return rows
+
+
+class InstrumentedConnection(sqlite3.Connection):
+    # Connection.execute C darajasida oddiy Cursor yaratadi, shuning uchun qayta yo'naltiramiz
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+def _record_db_query():
+    metric_inc('db_queries_total')
+    if has_request_context():
+        g.db_queries = g.get('db_queries', 0) + 1
+
+
+def _record_db_time(seconds):
+    metric_inc('db_query_seconds_total', seconds)
+    if has_request_context():
+        g.db_time = g.get('db_time', 0.0) + seconds
+
+
+# ═══════════════════════════════════════════════
+# SQL PROFILER — opt-in per-request tracing, N+1 detection, slow-query log
+# ═══════════════════════════════════════════════
+
+SQL_PROFILE_ALL = os.environ.get('SQL_PROFILE') == '1'
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', '50'))
+N_PLUS_ONE_THRESHOLD = int(os.environ.get('N_PLUS_ONE_THRESHOLD', '5'))
+PROGRESS_STEP = 100
+
+sql_logger = logging.getLogger('elitemc.sql')
+_sql_profiles = deque(maxlen=50)
+_sql_profile_key = os.urandom(16)  # takroriy so'rovlarni qiymatlarsiz solishtirish uchun, jarayon bo'yicha
+
+
+def _log_slow_query(sql, seconds, rowcount):
+    event = {'event': 'slow_query', 'ms': round(seconds * 1000, 2), 'sql': ' '.join(str(sql).split()),
+             'rowcount': rowcount}
+    if has_request_context():
+        event.update(path=request.path, endpoint=request.endpoint)
+    sql_logger.warning(json.dumps(event, ensure_ascii=False))
+
+
+def sql_profile_begin(sql, parameters):
+    """
+    Parametr qiymatlari saqlanmaydi (login, parol xeshi /admin/sql-profile da ko'rinmasligi kerak) —
+    faqat soni va turlari, takroriylarni aniqlash uchun esa kalitli xesh.
+    """
+    if not has_request_context():
+        return None
+    profile = g.get('sql_profile')
+    if profile is None:
+        return None
+    if isinstance(parameters, dict):
+        shape = '{' + ', '.join(f'{k}: {type(v).__name__}' for k, v in parameters.items()) + '}'
+    else:
+        shape = '(' + ', '.join(type(v).__name__ for v in parameters) + ')'
+    fingerprint = hashlib.blake2b(repr(parameters).encode(), key=_sql_profile_key, digest_size=8).hexdigest()
+    entry = {'sql': ' '.join(sql.split()), 'params': shape, 'fingerprint': fingerprint, 'ms': 0.0, 'rows': 0,
+             'vm_steps': 0, 'triggers': []}
+    profile.append(entry)
+    return entry
+
+
+def sql_profile_attach(conn):
+    """Trace callback ishga tushgan triggerlarni, progress handler VM qadamlarini yozadi; qiymatli SQL matni saqlanmaydi."""
+    profile = g.sql_profile
+
+    def on_trace(statement):
+        if profile and statement.startswith('-- TRIGGER'):
+            profile[-1]['triggers'].append(statement[3:])
+
+    def on_progress():
+        if profile:
+            profile[-1]['vm_steps'] += PROGRESS_STEP
+        return 0
+
+    conn.set_trace_callback(on_trace)
+    conn.set_progress_handler(on_progress, PROGRESS_STEP)
+
+
+def sql_profile_summary(profile):
+    by_sql = Counter(e['sql'] for e in profile)
+    by_text = Counter((e['sql'], e['fingerprint']) for e in profile)
+    return {
+        'queries': len(profile),
+        'ms': round(sum(e['ms'] for e in profile), 3),
+        'rows': sum(e['rows'] for e in profile),
+        'n_plus_one': [{'sql': q, 'count': n} for q, n in by_sql.items() if n >= N_PLUS_ONE_THRESHOLD],
+        'duplicates': [{'sql': q, 'count': n} for (q, _), n in by_text.items() if n > 1],
+        'statements': profile,
+    }
+
+
+@app.before_request
+def _sql_profile_start():
+    wanted = request.args.get('_sqlprof') == '1' or request.headers.get('X-SQL-Profile') == '1'
+    if SQL_PROFILE_ALL or (wanted and session.get('is_admin')):
+        g.sql_profile = []
+
+
+@app.after_request
+def _sql_profile_finish(resp):
+    profile = g.get('sql_profile')
+    if profile is None:
+        return resp
+    summary = sql_profile_summary(profile)
+    resp.headers['X-SQL-Profile'] = (f"queries={summary['queries']}; ms={summary['ms']}; rows={summary['rows']}; "
+                                     f"n+1={len(summary['n_plus_one'])}; dup={len(summary['duplicates'])}")
+    if request.endpoint != 'admin_sql_profile':
+        _sql_profiles.appendleft(dict(summary, path=request.full_path.rstrip('?'), endpoint=request.endpoint,
+                                      at=datetime.datetime.now().strftime('%H:%M:%S')))
+    return resp
+
+
+# ═══════════════════════════════════════════════
+# DATABASE — DATABASE_URL bo'yicha SQLite bazasi va ulanishlar puli
+# ═══════════════════════════════════════════════
+
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 8))  # jarayondagi bo'sh ulanishlar; 0 — har safar yangi ulanish
+
+
+class PooledConnection(InstrumentedConnection):
+    """close() ulanishni puliga qaytaradi — chaqiruvchilar get_db() dagidek yopadi."""
+    pool = None
+    ident = None
+    released = False
+
+    def close(self):
+        self.pool.release(self)
+
+
+class ConnectionPool:
+    """
+    Jarayon ichidagi bo'sh SQLite ulanishlari. Qaytarilganda ochiq tranzaksiya bekor qilinadi,
+    profil callbacklari olinadi; ATTACH qilingani yopiladi. ident o'zgarsa (snapshot fayli almashgan)
+    eski ulanishlar tashlanadi, fork dan keyin ota jarayonniki ishlatilmaydi.
+    """
+
+    def __init__(self, opener, size):
+        self.opener = opener
+        self.size = size
+        self._idle = []
+        self._ident = None
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+
+    def acquire(self, ident=None):
+        with self._lock:
+            stale = []
+            if self._pid != os.getpid():
+                self._idle, self._pid = [], os.getpid()
+            if ident != self._ident:
+                stale, self._idle, self._ident = self._idle, [], ident
+            conn = self._idle.pop() if self._idle else None
+        for c in stale:
+            sqlite3.Connection.close(c)
+        if conn is None:
+            conn = self.opener()
+            conn.row_factory = sqlite3.Row
+            conn.pool, conn.ident = self, ident
+        conn.released = False
+        return conn
+
+    def release(self, conn):
+        if conn.released:
+            return
+        conn.released = True
+        if conn.in_transaction:
+            sqlite3.Connection.rollback(conn)
+        conn.set_trace_callback(None)
+        conn.set_progress_handler(None, 0)
+        attached = any(r[1] not in ('main', 'temp') for r in sqlite3.Cursor(conn).execute('PRAGMA database_list'))
+        with self._lock:
+            if not attached and conn.ident == self._ident and self._pid == os.getpid() and len(self._idle) < self.size:
+                self._idle.append(conn)
+                return
+        sqlite3.Connection.close(conn)
+
+    def clear(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for c in idle:
+            sqlite3.Connection.close(c)
+
+
+class SQLiteDatabase:
+    """Fayl yoki jarayon ichidagi (memdb VFS — bir jarayondagi barcha ulanishlar bitta bazani ko'radi) SQLite."""
+
+    def __init__(self, path):
+        self.path = path
+        self.memory = path == ':memory:'
+        self._target = 'file:/elitemc?vfs=memdb' if self.memory else path
+        self.pool = ConnectionPool(lambda: self.raw_connect(factory=PooledConnection, check_same_thread=False), DB_POOL_SIZE)
+        # memdb oxirgi ulanish yopilganda o'chadi
+        self._keeper = self.raw_connect() if self.memory else None
+
+    def raw_connect(self, **kwargs):
+        """Pulsiz va instrumentatsiyasiz ulanish — backup API, tiklash."""
+        return sqlite3.connect(self._target, uri=self.memory, **kwargs)
+
+    def connect(self):
+        return self.pool.acquire()
+
+
+DEFAULT_DATABASE_URL = 'sqlite:///elitemc.db'
+
+
+def open_database(url):
+    """
+    DATABASE_URL -> SQLiteDatabase. Sxema, migratsiyalar, triggerlar, FTS5, backup API va BEGIN IMMEDIATE
+    serializatsiyasi SQLite ga tayanadi. Boshqa sxema (masalan eski deploylardagi mysql://) ishga tushishni
+    buzmaydi — ogohlantirish yoziladi va elitemc.db ishlatiladi, avvalgidek.
+    """
+    scheme = url.split(':', 1)[0].lower()
+    if scheme != 'sqlite':
+        app.logger.warning("DATABASE_URL: '%s' qo'llab-quvvatlanmaydi (faqat sqlite:///fayl.db yoki "
+                           "sqlite:///:memory:) — %s ishlatiladi", scheme, DEFAULT_DATABASE_URL)
+        url = DEFAULT_DATABASE_URL
+    path = urllib.parse.urlsplit(url).path
+    path = path[1:] if path.startswith('/') else path
+    return SQLiteDatabase(':memory:' if path in ('', ':memory:') else path)
+
+
+db = open_database(DATABASE_URL)
+DB_PATH = db.path  # SQLite fayli: backup, arxiv, hisobot snapshoti shu fayl bilan ishlaydi
+
+
+# ═══════════════════════════════════════════════
+# SERVER HEALTH — har bir o'yin serveri uchun circuit breaker (holat barcha workerlar uchun bazada)
+# ═══════════════════════════════════════════════
+
+BREAKER_THRESHOLD = int(os.environ.get('BREAKER_THRESHOLD', 3))
+BREAKER_COOLDOWN = float(os.environ.get('BREAKER_COOLDOWN', 30))
+BREAKER_CACHE_TTL = 1.0  # sog' server holati shu muddat davomida bazadan qayta o'qilmaydi
+health_logger = logging.getLogger('elitemc.health')
+_breaker_healthy = {}  # server -> oxirgi marta "closed, 0 xato" ko'rilgan vaqt (shu process)
+
+
+def breaker_allow(server: str) -> bool:
+    """
+    closed — ruxsat. open — cooldown tugaguncha darhol rad. Cooldown tugagach bitta chaqiruvchi
+    holatni half_open ga o'tkazib sinov yuboradi; qolganlari sinov natijasini kutmasdan rad etiladi.
+    Sinovchi javobsiz qolsa (worker o'ldi), keyingi cooldown dan so'ng boshqasi urinadi.
+    Sog' server uchun bazaga BREAKER_CACHE_TTL da bir martadan ko'p murojaat qilinmaydi.
     """
-    if not MCRCON_AVAILABLE:
-        return False, "RCON moduli yo'q"
+    now = time.time()
+    if now - _breaker_healthy.get(server, 0) < BREAKER_CACHE_TTL:
+        return True
+    conn = get_db()
     try:
-        conn = get_db()
-        settings = {r['key']: r['value'] for r in conn.execute('SELECT key, value FROM settings').fetchall()}
+        row = conn.execute('SELECT state, failures FROM server_health WHERE server=?', (server,)).fetchone()
+        if row is None or row['state'] == 'closed':
+            if row is None or not row['failures']:
+                _breaker_healthy[server] = now
+            return True
+        claimed = conn.execute("""UPDATE server_health SET state='half_open', opened_at=?
+                                  WHERE server=? AND state!='closed' AND opened_at<=?""",
+                               (now, server, now - BREAKER_COOLDOWN)).rowcount
+        conn.commit()
+        if claimed:
+            metric_inc('breaker_transitions_total', server=server, state='half_open')
+        return claimed == 1
+    finally:
         conn.close()
 
-        cat = pkg['category']
 
-        if cat == 'services' and server_mode:
-            prefix = server_mode
-        elif cat == 'anarchy':
-            prefix = "anarchy"
-        elif cat == 'smp':
-            prefix = "smp"
-        else:
-            prefix = "anarchy"
+def breaker_record(server: str, ok: bool, error: str = None):
+    """Muvaffaqiyat breaker ni yopadi; ketma-ket BREAKER_THRESHOLD xato yoki half_open sinovining xatosi ochadi."""
+    now = time.time()
+    if ok and now - _breaker_healthy.get(server, 0) < BREAKER_CACHE_TTL:
+        return
+    _breaker_healthy.pop(server, None)
+    conn = get_db()
+    try:
+        row = conn.execute('SELECT state, failures, opened_at FROM server_health WHERE server=?', (server,)).fetchone()
+        if ok:
+            _breaker_healthy[server] = now
+            # Sog' server uchun yozuv yo'q — faqat holat o'zgarganda yoziladi
+            if row is not None and (row['state'] != 'closed' or row['failures']):
+                conn.execute("UPDATE server_health SET state='closed', failures=0, last_ok_at=? WHERE server=?",
+                             (now, server))
+                conn.commit()
+                if row['state'] != 'closed':
+                    health_logger.warning('%s: breaker yopildi, server qayta ishlayapti', server)
+                    metric_inc('breaker_transitions_total', server=server, state='closed')
+            return
+
+        state = row['state'] if row else 'closed'
+        failures = (row['failures'] if row else 0) + 1
+        opened_at = row['opened_at'] if row else None
+        if state == 'half_open' or (state == 'closed' and failures >= BREAKER_THRESHOLD):
+            state, opened_at = 'open', now
+            health_logger.warning('%s: breaker ochildi (%d xato): %s', server, failures, error)
+            metric_inc('breaker_transitions_total', server=server, state='open')
+        conn.execute("""INSERT INTO server_health (server, state, failures, opened_at, last_error, last_fail_at)
+                        VALUES (?, ?, ?, ?, ?, ?)
+                        ON CONFLICT(server) DO UPDATE SET state=excluded.state, failures=excluded.failures,
+                        opened_at=excluded.opened_at, last_error=excluded.last_error, last_fail_at=excluded.last_fail_at""",
+                     (server, state, failures, opened_at, (error or '')[:300], now))
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def breaker_states():
+    now = time.time()
+    conn = get_db()
+    rows = conn.execute('SELECT * FROM server_health ORDER BY server').fetchall()
+    conn.close()
+    out = []
+    for r in rows:
+        d = dict(r)
+        d['retry_in'] = max(0.0, round(d['opened_at'] + BREAKER_COOLDOWN - now, 1)) if d['state'] != 'closed' and d['opened_at'] else 0.0
+        out.append(d)
+    return out
+
+
+def breaker_reset(server: str):
+    conn = get_db()
+    conn.execute("UPDATE server_health SET state='closed', failures=0 WHERE server=?", (server,))
+    conn.commit()
+    conn.close()
+
+
+RCON_TIMEOUT = float(os.environ.get('RCON_TIMEOUT', 5))
+RCON_WINDOW = 64  # javoblarni o'qishdan oldin yuboriladigan buyruqlar soni
+RCON_AUTH, RCON_EXEC, RCON_AUTH_RESPONSE = 3, 2, 2
+RCON_SENTINEL = 200  # noma'lum tur: server uni "Unknown request" bilan o'sha id da qaytaradi
+RCON_FRAGMENT = 4096  # server javobni shu uzunlikdagi bo'laklarga ajratadi
+# Server har bir javobni alohida yozadi va Nagle yoqilgan; kechiktirilgan ACK bilan birga bu
+# pipelining da har oynaga ~40 ms qo'shadi. Linux da TCP_QUICKACK har o'qishdan oldin qayta qo'yiladi.
+_TCP_QUICKACK = getattr(socket, 'TCP_QUICKACK', None)
+
+
+class RconError(Exception):
+    pass
+
+
+def _rcon_packet(req_id, req_type, body):
+    payload = struct.pack('<ii', req_id, req_type) + body.encode('utf8') + b'\x00\x00'
+    return struct.pack('<i', len(payload)) + payload
+
+
+def _rcon_read(sock, reader):
+    if _TCP_QUICKACK is not None:
+        sock.setsockopt(socket.IPPROTO_TCP, _TCP_QUICKACK, 1)
+    head = reader.read(4)
+    if len(head) < 4:
+        raise RconError('RCON ulanishi uzildi')
+    (length,) = struct.unpack('<i', head)
+    payload = reader.read(length)
+    if len(payload) < length:
+        raise RconError('RCON ulanishi uzildi')
+    req_id, req_type = struct.unpack('<ii', payload[:8])
+    return req_id, req_type, payload[8:-2].decode('utf8', 'replace')
+
+
+def rcon_batch(host, port, password, cmds, server='default'):
+    """
+    Bir nechta buyruqni bitta autentifikatsiyalangan ulanish orqali yuboradi (pipelining).
+    Javoblar request id bo'yicha moslanadi: RCON_FRAGMENT dan qisqa bo'lak yoki keyingi id
+    buyruq javobi tugaganini bildiradi. Oxirgi bo'lak roppa-rosa RCON_FRAGMENT bo'lsagina
+    sentinel paket yuboriladi (har doim yuborilsa, Nagle tufayli ~40 ms kutish paydo bo'ladi).
+    Natija: har bir buyruq uchun (ok, javob yoki xato matni), tartib cmds bilan bir xil.
+    """
+    results = [None] * len(cmds)
+    if not cmds:
+        return results
+    if not breaker_allow(server):
+        metric_inc('rcon_failures_total', len(cmds), server=server)
+        return [(False, f"{server.upper()} serveri vaqtincha ishlamayapti, keyinroq urinib ko'ring")] * len(cmds)
+    started = time.perf_counter()
+    chunks = {}
+    error = None
+    try:
+        with socket.create_connection((host, int(port)), timeout=RCON_TIMEOUT) as sock:
+            reader = sock.makefile('rb')
+            sock.sendall(_rcon_packet(1, RCON_AUTH, password or ''))
+            while True:
+                # Ba'zi serverlar auth javobidan oldin bo'sh RESPONSE_VALUE paketini yuboradi
+                req_id, req_type, _ = _rcon_read(sock, reader)
+                if req_type == RCON_AUTH_RESPONSE:
+                    break
+            if req_id == -1:
+                raise RconError("RCON paroli noto'g'ri")
+
+            for window_no, start in enumerate(range(0, len(cmds), RCON_WINDOW)):
+                window = cmds[start:start + RCON_WINDOW]
+                last = start + len(window) + 1
+                sentinel = None
+                sock.sendall(b''.join(_rcon_packet(start + i + 2, RCON_EXEC, c) for i, c in enumerate(window)))
+                while True:
+                    req_id, _, body = _rcon_read(sock, reader)
+                    if sentinel is not None and req_id == sentinel:
+                        break
+                    chunks.setdefault(req_id, []).append(body)
+                    if req_id == last and sentinel is None:
+                        if len(body) < RCON_FRAGMENT:
+                            break
+                        sentinel = len(cmds) + 2 + window_no
+                        sock.sendall(_rcon_packet(sentinel, RCON_SENTINEL, ''))
+                for i in range(len(window)):
+                    parts = chunks.get(start + i + 2)
+                    results[start + i] = (True, ''.join(parts)) if parts is not None else (False, 'RCON javob bermadi')
+    except (OSError, ValueError, struct.error, RconError) as e:
+        # Javobi kelgan buyruqlar serverda bajarilgan — ular muvaffaqiyatli deb qoladi
+        error = str(e) or type(e).__name__
+        results = [r or ((True, ''.join(chunks[i + 2])) if i + 2 in chunks else (False, error))
+                   for i, r in enumerate(results)]
+    breaker_record(server, error is None, error)
+
+    failed = sum(1 for ok, _ in results if not ok)
+    metric_observe('rcon_batch_duration_seconds', time.perf_counter() - started, server=server)
+    metric_inc('rcon_commands_total', len(cmds), server=server)
+    if failed:
+        metric_inc('rcon_failures_total', failed, server=server)
+    return results
+
+
+def rcon_command(host, port, password, cmd, server='default'):
+    """Bitta RCON buyrug'i: ulanish, autentifikatsiya, buyruq. Xatoda RconError ko'tariladi."""
+    started = time.perf_counter()
+    ok, resp = rcon_batch(host, port, password, [cmd], server=server)[0]
+    metric_observe('rcon_command_duration_seconds', time.perf_counter() - started, server=server, ok='1' if ok else '0')
+    if not ok:
+        raise RconError(resp)
+    return resp
+
+
+@app.before_request
+def _metrics_start_timer():
+    g.request_started = time.perf_counter()
+
+
+@app.after_request
+def _metrics_record_request(resp):
+    started = g.get('request_started')
+    if started is not None:
+        endpoint = request.endpoint or 'unmatched'
+        metric_observe('http_request_duration_seconds', time.perf_counter() - started,
+                       endpoint=endpoint, method=request.method, status=str(resp.status_code // 100) + 'xx')
+        metric_observe('db_queries_per_request', g.get('db_queries', 0), buckets=COUNT_BUCKETS, endpoint=endpoint)
+        metric_observe('db_time_per_request_seconds', g.get('db_time', 0.0), endpoint=endpoint)
+    metrics_flush()
+    return resp
+
+
+@app.route('/metrics')
+def metrics_endpoint():
+    auth = request.headers.get('Authorization', '').encode()
+    if not METRICS_TOKEN or not secrets.compare_digest(auth, f'Bearer {METRICS_TOKEN}'.encode()):
+        abort(403)
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+
+TOKEN_PRICE = 1.2  # 1 token narxi (so'm)
+
+
+def token_package(amount: int):
+    """Ixtiyoriy miqdordagi tokenlar uchun katalogda yo'q "paket" — umumiy rcon_* sozlamalariga yuboriladi."""
+    return {'id': None, 'category': 'custom_token', 'name': f"{amount} Token", 'price': amount * TOKEN_PRICE}
+
+
+def package_server(pkg, server_mode=None):
+    """
+    server_mode: 'anarchy' yoki 'smp' - faqat Unban/Unmute uchun
+    """
+    cat = pkg['category']
+    if cat == 'custom_token':
+        return "default"
+    if cat == 'services' and server_mode:
+        return server_mode
+    if cat == 'smp':
+        return "smp"
+    return "anarchy"
+
+
+def package_command(minecraft_nick: str, pkg) -> str:
+    cat = pkg['category']
+    if cat in ['anarchy', 'smp']:
+        return f"lp user {minecraft_nick} parent set {pkg['name']}"
+    if cat == 'keys' and 'DT' in pkg['name']:
+        return f"crates key give {minecraft_nick} economy 1"
+    if cat == 'services':
+        if 'Unban' in pkg['name']:
+            return f"pardon {minecraft_nick}"
+        if 'Unmute' in pkg['name']:
+            return f"unmute {minecraft_nick}"
+    elif cat in ('token', 'custom_token'):
+        return f"playerpoints give {minecraft_nick} {int(pkg['name'].split()[0])}"
+    return ""
+
+
+def rcon_dispatch(items):
+    """
+    items: [(server, command), ...]. Har bir server uchun bitta RCON ulanish.
+    Natija items tartibida: [(ok, javob yoki xato), ...]
+    """
+    conn = get_db()
+    settings = {r['key']: r['value'] for r in conn.execute('SELECT key, value FROM settings').fetchall()}
+    conn.close()
 
-        host = settings.get(f'{prefix}_rcon_host')
-        port = settings.get(f'{prefix}_rcon_port')
-        pwd = settings.get(f'{prefix}_rcon_password')
+    by_server = {}
+    for i, (server, _) in enumerate(items):
+        by_server.setdefault(server, []).append(i)
 
+    results = [None] * len(items)
+    for prefix, indexes in by_server.items():
+        key = 'rcon' if prefix == 'default' else f'{prefix}_rcon'
+        host = settings.get(f'{key}_host')
+        port = settings.get(f'{key}_port')
+        pwd = settings.get(f'{key}_password')
         if not host or not pwd:
-            return False, f"{prefix.upper()} RCON sozlanmagan"
-
-        cmd = ""
-        if cat in ['anarchy', 'smp']:
-            cmd = f"lp user {minecraft_nick} parent set {pkg['name']}"
-        elif cat == 'keys' and 'DT' in pkg['name']:
-            cmd = f"crates key give {minecraft_nick} economy 1"
-        elif cat == 'services':
-            if 'Unban' in pkg['name']:
-                cmd = f"pardon {minecraft_nick}"
-            elif 'Unmute' in pkg['name']:
-                cmd = f"unmute {minecraft_nick}"
-        elif cat == 'token':
-            cmd = f"playerpoints give {minecraft_nick} {int(pkg['name'].split()[0])}"
+            for i in indexes:
+                results[i] = (False, f"{prefix.upper()} RCON sozlanmagan")
+            continue
+        cmds = [items[i][1] for i in indexes]
+        for i, result in zip(indexes, rcon_batch(host, port, pwd, cmds, server=prefix)):
+            results[i] = result
+    return results
 
-        with MCRcon(host, pwd, port=int(port)) as mcr:
-            resp = mcr.command(cmd)
-            return True, resp
+
+def execute_purchases(items):
+    """items: [(minecraft_nick, pkg, server_mode), ...]; natija items tartibida."""
+    return rcon_dispatch([(package_server(pkg, server_mode), package_command(nick, pkg))
+                          for nick, pkg, server_mode in items])
+
+
+def execute_purchase(minecraft_nick: str, pkg, server_mode=None):
+    """
+    server_mode: 'anarchy' yoki 'smp' - faqat Unban/Unmute uchun
+    """
+    try:
+        return execute_purchases([(minecraft_nick, pkg, server_mode)])[0]
     except Exception as e:
         return False, str(e)
 
 
-def init_db():
-    conn = get_db()
+SCHEMA_VERSION = 12
+DB_LOCK_PATH = 'elitemc.db.lock'
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+ANARCHY_RANKS = [
+    ('VIP', 'Anarxiya ranki', 2000, 4000, 6000, '/wb, /ec, 7 slot', '#60a5fa'),
+    ('VIP+', 'Anarxiya ranki', 5000, 9000, 13000, '/anvil, /near, Kit VIP+', '#3b82f6'),
+    ('LEGEND', 'Anarxiya ranki', 8000, 15000, 21000, '/time set, Kit Legend', '#8b5cf6'),
+    ('DONATOR', 'Anarxiya ranki', 11000, 20000, 28000, '/jump, Kit Donator', '#d946ef'),
+    ('GOLD', 'Anarxiya ranki', 14000, 24000, 35000, '/feed, Kit Gold', '#eab308'),
+    ('NITRO', 'Anarxiya ranki', 17000, 30000, 43000, '/speed, Kit Nitro', '#f97316'),
+    ('COMET', 'Anarxiya ranki', 22000, 39000, 56000, '/bc, Kit Comet', '#06b6d4'),
+    ('HERO', 'Anarxiya ranki', 32000, 55000, 79000, '/prefix, Kit Hero', '#6366f1'),
+    ('ULTRA', 'Anarxiya ranki', 40000, 70000, 100000, '/ban, Kit Ultra', '#ef4444'),
+    ('PRIME', 'Anarxiya ranki', 80000, 140000, 200000, '/fly, Kit Prime', '#10b981'),
+]
+
+DEFAULT_SETTINGS = [
+    ('admin_card_number', 'EliteMc ⚡️5614 6819 0152 9887'),
+    ('admin_card_name', 'T. SH'),
+    ('site_name', 'EliteMC'),
+    ('server_ip', 'mc.elitemc.uz'),
+    ('rcon_host', '185.130.212.39'),
+    ('rcon_port', '25496'),
+    ('rcon_password', '@shoxauz054uzcvre@$%'),
+    ('music_url', 'https://www.youtube.com/embed/TY6KMrkgaH4?autoplay=1&loop=1&playlist=TY6KMrkgaH4&controls=0'),
+    ('music_enabled', '1'),
+    ('news_version', '1'),
+    ('catalog_version', '1'),
+]
+
+
+def seed_packages():
+    """Boshlang'ich katalog: (category, name, description, price, duration, features, color)."""
+    rows = [
+        ('keys', 'DT Case', '1x DT Case Key', 10000, '1 dona', 'Noyob buyumlar kaliti', '#f43f5e'),
+        ('services', 'Unmute', 'Chatdan unmute', 5000, 'Bir martalik', 'Chatda yozish imkoni', '#10b981'),
+        ('services', 'Unban', 'Serverdan unban', 15000, 'Bir martalik', 'Serverga qayta kirish', '#ef4444'),
+    ]
+    for name, desc, p30, p90, pUmr, feat, col in ANARCHY_RANKS:
+        rows += [('anarchy', name, desc, price, dur, feat, col)
+                 for price, dur in ((p30, '30'), (p90, '90'), (pUmr, 'UMRBOT'))]
+    rows += [('smp', 'SMP+', 'SMP Server Rank', price, dur, 'SMP Maxsus imkoniyatlar', '#00ff88')
+             for price, dur in ((20000, '30'), (35000, '90'), (50000, 'UMRBOT'))]
+    rows += [('token', name, 'Server valyutasi', price, 'Bir martalik', feat, '#fbbf24')
+             for name, price, feat in (('1000 Token', 1200, '1000 token'), ('5000 Token', 6000, '5000 token'),
+                                       ('10000 Token', 12000, '10000 token'))]
+    return rows
+
+
+def init_db(conn):
+    """Sxema va boshlang'ich ma'lumotlar. Mavjud ma'lumotlarga tegmaydi — qayta chaqirish xavfsiz."""
     c = conn.cursor()
 
     c.execute('''CREATE TABLE IF NOT EXISTS users
@@ -146,7 +953,7 @@ def init_db():
     c.execute('''CREATE TABLE IF NOT EXISTS purchases
                  (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, package_id INTEGER,
                   amount REAL, package_name TEXT, minecraft_nick TEXT, status TEXT DEFAULT 'completed',
-                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP, category TEXT)''')
 
     c.execute('''CREATE TABLE IF NOT EXISTS balance_deposits
                  (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, amount REAL, card_number TEXT,
@@ -169,64 +976,213 @@ def init_db():
                   last_updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                   UNIQUE(minecraft_nick, server_type))''')
 
-    c.execute('DELETE FROM packages')
-
-    c.execute("INSERT INTO packages (category, name, description, price, duration, features, color) VALUES ('keys', 'DT Case', '1x DT Case Key', 10000, '1 dona', 'Noyob buyumlar kaliti', '#f43f5e')")
-    c.execute("INSERT INTO packages (category, name, description, price, duration, features, color) VALUES ('services', 'Unmute', 'Chatdan unmute', 5000, 'Bir martalik', 'Chatda yozish imkoni', '#10b981')")
-    c.execute("INSERT INTO packages (category, name, description, price, duration, features, color) VALUES ('services', 'Unban', 'Serverdan unban', 15000, 'Bir martalik', 'Serverga qayta kirish', '#ef4444')")
-
-    anarchy_ranks = [
-        ('VIP', 'Anarxiya ranki', 2000, 4000, 6000, '/wb, /ec, 7 slot', '#60a5fa'),
-        ('VIP+', 'Anarxiya ranki', 5000, 9000, 13000, '/anvil, /near, Kit VIP+', '#3b82f6'),
-        ('LEGEND', 'Anarxiya ranki', 8000, 15000, 21000, '/time set, Kit Legend', '#8b5cf6'),
-        ('DONATOR', 'Anarxiya ranki', 11000, 20000, 28000, '/jump, Kit Donator', '#d946ef'),
-        ('GOLD', 'Anarxiya ranki', 14000, 24000, 35000, '/feed, Kit Gold', '#eab308'),
-        ('NITRO', 'Anarxiya ranki', 17000, 30000, 43000, '/speed, Kit Nitro', '#f97316'),
-        ('COMET', 'Anarxiya ranki', 22000, 39000, 56000, '/bc, Kit Comet', '#06b6d4'),
-        ('HERO', 'Anarxiya ranki', 32000, 55000, 79000, '/prefix, Kit Hero', '#6366f1'),
-        ('ULTRA', 'Anarxiya ranki', 40000, 70000, 100000, '/ban, Kit Ultra', '#ef4444'),
-        ('PRIME', 'Anarxiya ranki', 80000, 140000, 200000, '/fly, Kit Prime', '#10b981'),
-    ]
-    for name, desc, p30, p90, pUmr, feat, col in anarchy_ranks:
-        c.execute('INSERT INTO packages (category, name, description, price, duration, features, color) VALUES (?,?,?,?,?,?,?)',
-                  ('anarchy', name, desc, p30, '30', feat, col))
-        c.execute('INSERT INTO packages (category, name, description, price, duration, features, color) VALUES (?,?,?,?,?,?,?)',
-                  ('anarchy', name, desc, p90, '90', feat, col))
-        c.execute('INSERT INTO packages (category, name, description, price, duration, features, color) VALUES (?,?,?,?,?,?,?)',
-                  ('anarchy', name, desc, pUmr, 'UMRBOT', feat, col))
-
-    c.execute('INSERT INTO packages (category, name, description, price, duration, features, color) VALUES (?,?,?,?,?,?,?)',
-              ('smp', 'SMP+', 'SMP Server Rank', 20000, '30', 'SMP Maxsus imkoniyatlar', '#00ff88'))
-    c.execute('INSERT INTO packages (category, name, description, price, duration, features, color) VALUES (?,?,?,?,?,?,?)',
-              ('smp', 'SMP+', 'SMP Server Rank', 35000, '90', 'SMP Maxsus imkoniyatlar', '#00ff88'))
-    c.execute('INSERT INTO packages (category, name, description, price, duration, features, color) VALUES (?,?,?,?,?,?,?)',
-              ('smp', 'SMP+', 'SMP Server Rank', 50000, 'UMRBOT', 'SMP Maxsus imkoniyatlar', '#00ff88'))
-
-    token_packages = [('1000 Token', 1200, '1000 token'), ('5000 Token', 6000, '5000 token'), ('10000 Token', 12000, '10000 token')]
-    for name, price, feat in token_packages:
-        c.execute('INSERT INTO packages (category, name, description, price, duration, features, color) VALUES (?,?,?,?,?,?,?)',
-                  ('token', name, 'Server valyutasi', price, 'Bir martalik', feat, '#fbbf24'))
-
-    defaults = [
-        ('admin_card_number', 'EliteMc ⚡️5614 6819 0152 9887'),
-        ('admin_card_name', 'T. SH'),
-        ('site_name', 'EliteMC'),
-        ('server_ip', 'mc.elitemc.uz'),
-        ('rcon_host', '185.130.212.39'),
-        ('rcon_port', '25496'),
-        ('rcon_password', '@shoxauz054uzcvre@$%'),
-        ('music_url', 'https://www.youtube.com/embed/TY6KMrkgaH4?autoplay=1&loop=1&playlist=TY6KMrkgaH4&controls=0'),
-        ('music_enabled', '1'),
-    ]
-    for k, v in defaults:
-        c.execute('INSERT OR IGNORE INTO settings (key, value) VALUES (?, ?)', (k, v))
+    # Katalog faqat bo'sh bo'lsa to'ldiriladi — admin o'zgartirgan narxlar saqlanib qoladi
+    if c.execute('SELECT COUNT(*) FROM packages').fetchone()[0] == 0:
+        c.executemany('INSERT INTO packages (category, name, description, price, duration, features, color) VALUES (?,?,?,?,?,?,?)',
+                      seed_packages())
+
+    c.executemany('INSERT OR IGNORE INTO settings (key, value) VALUES (?, ?)', DEFAULT_SETTINGS)
 
     admin_pw = hashlib.sha256('ssmertnix_legend'.encode()).hexdigest()
     c.execute('INSERT OR IGNORE INTO users (username, email, password, is_admin, minecraft_nick) VALUES (?, ?, ?, ?, ?)',
               ('admin', 'admin@elitemc.uz', admin_pw, 1, 'Admin'))
 
-    conn.commit()
-    conn.close()
+
+def migrate_db(conn):
+    """Mavjud bazalar uchun idempotent sxema o'zgarishlari."""
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_news_created ON news (created_at, id)')
+    conn.execute('''CREATE TABLE IF NOT EXISTS server_health
+                    (server TEXT PRIMARY KEY, state TEXT DEFAULT 'closed', failures INTEGER DEFAULT 0,
+                     opened_at REAL, last_error TEXT, last_fail_at REAL, last_ok_at REAL)''')
+    # package_id NULL bo'lsa — ixtiyoriy miqdordagi tokenlar (tokens ustuni)
+    conn.execute('''CREATE TABLE IF NOT EXISTS cart_items
+                    (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, package_id INTEGER,
+                     tokens INTEGER DEFAULT 0, nick TEXT, server_mode TEXT,
+                     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_cart_user ON cart_items (user_id)')
+
+    # Profil sarlavhasi uchun agregat: purchases dagi har bir o'zgarishda triggerlar yangilaydi
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_purchases_user_created ON purchases (user_id, created_at, id)')
+    had_user_stats = conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='user_stats'").fetchone()
+    # Arxivga ko'chirish paytida shu jadvalda qator turadi: agregat triggerlari o'chirishni hisobga olmaydi
+    conn.execute('CREATE TABLE IF NOT EXISTS archive_in_progress (flag INTEGER)')
+    # v11 gacha 'pending' xaridlar ham agregatlarga yozilgan — triggerlar qayta yaratilgach ayirib tashlanadi
+    counted_pending = conn.execute('''SELECT 1 FROM sqlite_master WHERE name = 'trg_user_stats_insert'
+                                      AND sql NOT LIKE '%pending%' ''').fetchone()
+    for name in ('trg_user_stats_insert', 'trg_user_stats_delete', 'trg_user_stats_update',
+                 'trg_analytics_purchase_insert', 'trg_analytics_purchase_delete', 'trg_analytics_purchase_update',
+                 'trg_analytics_purchase_update_old', 'trg_analytics_purchase_update_new', 'trg_analytics_deposit_delete'):
+        conn.execute(f'DROP TRIGGER IF EXISTS {name}')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_purchases_pending ON purchases (created_at) WHERE status = 'pending'")
+    conn.execute('''CREATE TABLE IF NOT EXISTS user_stats
+                    (user_id INTEGER PRIMARY KEY, total_spent REAL DEFAULT 0, purchase_count INTEGER DEFAULT 0,
+                     last_purchase_at TIMESTAMP)''')
+    # Faqat yakunlangan xaridlar hisoblanadi: 'pending' -> 'completed' o'tishi qo'shadi, o'chirilgan pending hech narsa
+    add_stats = '''INSERT INTO user_stats (user_id, total_spent, purchase_count, last_purchase_at)
+                   VALUES (NEW.user_id, COALESCE(NEW.amount, 0), 1, NEW.created_at)
+                   ON CONFLICT(user_id) DO UPDATE SET total_spent = total_spent + excluded.total_spent,
+                       purchase_count = purchase_count + 1,
+                       last_purchase_at = MAX(COALESCE(last_purchase_at, ''), excluded.last_purchase_at);'''
+    sub_stats = '''UPDATE user_stats SET total_spent = total_spent - COALESCE(OLD.amount, 0),
+                       purchase_count = purchase_count - 1,
+                       last_purchase_at = (SELECT MAX(created_at) FROM purchases
+                                           WHERE user_id = OLD.user_id AND status IS NOT 'pending')
+                   WHERE user_id = OLD.user_id;'''
+    conn.execute(f'''CREATE TRIGGER IF NOT EXISTS trg_user_stats_insert AFTER INSERT ON purchases
+                     WHEN NEW.status IS NOT 'pending' BEGIN {add_stats} END''')
+    conn.execute(f'''CREATE TRIGGER IF NOT EXISTS trg_user_stats_delete AFTER DELETE ON purchases
+                     WHEN OLD.status IS NOT 'pending' AND NOT EXISTS (SELECT 1 FROM archive_in_progress) BEGIN {sub_stats} END''')
+    conn.execute(f'''CREATE TRIGGER IF NOT EXISTS trg_user_stats_update_old AFTER UPDATE OF user_id, amount, created_at, status ON purchases
+                     WHEN OLD.status IS NOT 'pending' BEGIN {sub_stats} END''')
+    conn.execute(f'''CREATE TRIGGER IF NOT EXISTS trg_user_stats_update_new AFTER UPDATE OF user_id, amount, created_at, status ON purchases
+                     WHEN NEW.status IS NOT 'pending' BEGIN {add_stats} END''')
+    if not had_user_stats:
+        conn.execute('''INSERT INTO user_stats (user_id, total_spent, purchase_count, last_purchase_at)
+                        SELECT user_id, COALESCE(SUM(amount), 0), COUNT(*), MAX(created_at)
+                        FROM purchases WHERE status IS NOT 'pending' GROUP BY user_id''')
+    elif counted_pending:
+        conn.execute('''UPDATE user_stats SET total_spent = total_spent - p.spent, purchase_count = purchase_count - p.n
+                        FROM (SELECT user_id, COALESCE(SUM(amount), 0) AS spent, COUNT(*) AS n FROM purchases
+                              WHERE status = 'pending' GROUP BY user_id) p
+                        WHERE user_stats.user_id = p.user_id''')
+
+    # Muddatli rank'lar navbati: expires_at NULL — umrbod; status: active / expired / superseded
+    conn.execute('''CREATE TABLE IF NOT EXISTS entitlements
+                    (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, purchase_id INTEGER,
+                     minecraft_nick TEXT COLLATE NOCASE, server TEXT, package_name TEXT,
+                     granted_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP, expires_at TIMESTAMP,
+                     status TEXT DEFAULT 'active', ended_at TIMESTAMP,
+                     attempts INTEGER DEFAULT 0, retry_at TIMESTAMP, last_error TEXT)''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_support_messages_ticket ON support_messages (ticket_id, id)')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_entitlements_due ON entitlements (expires_at) WHERE status = 'active'")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_entitlements_nick ON entitlements (minecraft_nick, server) WHERE status = 'active'")
+
+    # Ikki tomonlama ledger: har bir ledger_txns uchun yozuvlar yig'indisi 0; users.balance — snapshot
+    had_ledger = conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='ledger_txns'").fetchone()
+    conn.execute('''CREATE TABLE IF NOT EXISTS ledger_txns
+                    (id INTEGER PRIMARY KEY AUTOINCREMENT, kind TEXT, ref_type TEXT, ref_id INTEGER, memo TEXT,
+                     created_by INTEGER, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS ledger_entries
+                    (id INTEGER PRIMARY KEY AUTOINCREMENT, txn_id INTEGER, account TEXT, user_id INTEGER,
+                     amount REAL, balance_after REAL)''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_ledger_entries_user ON ledger_entries (user_id, id) WHERE user_id IS NOT NULL')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_ledger_entries_txn ON ledger_entries (txn_id)')
+    for table in ('ledger_txns', 'ledger_entries'):
+        for op in ('UPDATE', 'DELETE'):
+            conn.execute(f'''CREATE TRIGGER IF NOT EXISTS trg_{table}_no_{op.lower()} BEFORE {op} ON {table}
+                             BEGIN SELECT RAISE(ABORT, '{table} faqat qo''shiladi'); END''')
+    if not had_ledger:
+        # Mavjud balanslar ochilish yozuvlari sifatida — tekshiruv birinchi kundan mos keladi
+        conn.execute('''INSERT INTO ledger_txns (kind, ref_type, ref_id, memo)
+                        SELECT 'opening', 'user', id, 'Boshlang''ich balans' FROM users WHERE balance <> 0''')
+        conn.execute('''INSERT INTO ledger_entries (txn_id, account, user_id, amount, balance_after)
+                        SELECT t.id, 'user', u.id, u.balance, u.balance FROM ledger_txns t JOIN users u ON u.id = t.ref_id
+                        WHERE t.kind = 'opening' ''')
+        conn.execute('''INSERT INTO ledger_entries (txn_id, account, user_id, amount)
+                        SELECT t.id, 'opening', NULL, -u.balance FROM ledger_txns t JOIN users u ON u.id = t.ref_id
+                        WHERE t.kind = 'opening' ''')
+
+    # Support qidiruvi: rowid = xabar id, mavzular uchun -ticket id
+    if FTS5_AVAILABLE:
+        had_fts = conn.execute("SELECT 1 FROM sqlite_master WHERE name='support_fts'").fetchone()
+        conn.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS support_fts
+                        USING fts5(body, kind UNINDEXED, ticket_id UNINDEXED, prefix='2 3', tokenize='unicode61 remove_diacritics 2')''')
+        for table, sign, col, kind, ticket in (('support_messages', '', 'message', 'message', 'ticket_id'),
+                                               ('support_tickets', '-', 'subject', 'subject', 'id')):
+            new_row = f"({sign}NEW.id, {_fts_text_sql('NEW.' + col)}, '{kind}', NEW.{ticket})"
+            old_rowid = f'{sign}OLD.id'
+            conn.execute(f'''CREATE TRIGGER IF NOT EXISTS trg_{table}_fts_insert AFTER INSERT ON {table} BEGIN
+                                 INSERT INTO support_fts (rowid, body, kind, ticket_id) VALUES {new_row};
+                             END''')
+            conn.execute(f'''CREATE TRIGGER IF NOT EXISTS trg_{table}_fts_update AFTER UPDATE OF {col}, {ticket} ON {table} BEGIN
+                                 DELETE FROM support_fts WHERE rowid = {old_rowid};
+                                 INSERT INTO support_fts (rowid, body, kind, ticket_id) VALUES {new_row};
+                             END''')
+            conn.execute(f'''CREATE TRIGGER IF NOT EXISTS trg_{table}_fts_delete AFTER DELETE ON {table} BEGIN
+                                 DELETE FROM support_fts WHERE rowid = {old_rowid};
+                             END''')
+        if not had_fts:
+            rebuild_support_index(conn)
+
+    # v12: toifa xarid paytidagidek saqlanadi — paket keyin boshqa toifaga o'tsa yoki o'chirilsa ham rollup kalitlari siljimaydi
+    if 'category' not in {r[1] for r in conn.execute('PRAGMA table_info(purchases)')}:
+        conn.execute('ALTER TABLE purchases ADD COLUMN category TEXT')
+    conn.execute(f"UPDATE purchases SET category = {package_category_sql('purchases')} WHERE category IS NULL")
+    conn.execute(f'''CREATE TRIGGER IF NOT EXISTS trg_purchases_category AFTER INSERT ON purchases WHEN NEW.category IS NULL
+                     BEGIN UPDATE purchases SET category = {package_category_sql('NEW')} WHERE id = NEW.id; END''')
+
+    # Analitika: (dimension, day, key) bo'yicha kunlik daromad; so'rov vaqti kunlar soniga proporsional
+    had_rollups = conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='revenue_daily'").fetchone()
+    conn.execute('''CREATE TABLE IF NOT EXISTS revenue_daily
+                    (dimension TEXT, day TEXT, key TEXT, revenue REAL DEFAULT 0, count INTEGER DEFAULT 0,
+                     PRIMARY KEY (dimension, day, key)) WITHOUT ROWID''')
+    for sql in analytics_triggers():
+        conn.execute(sql)
+    if not had_rollups:
+        rebuild_analytics(conn)
+    elif counted_pending:
+        for dim, key in _purchase_rollup_keys('p'):
+            conn.execute(f'''UPDATE revenue_daily SET revenue = revenue_daily.revenue - s.revenue, count = count - s.n
+                             FROM (SELECT {_analytics_day_sql('p')} AS day, {key} AS key, COALESCE(SUM(p.amount), 0) AS revenue,
+                                          COUNT(*) AS n FROM purchases p WHERE p.status = 'pending' GROUP BY 1, 2) s
+                             WHERE revenue_daily.dimension = '{dim}' AND revenue_daily.day = s.day AND revenue_daily.key = s.key''')
+
+
+def bootstrap_db():
+    """
+    Fayl bazasini WAL ga o'tkazadi; sxema versiyasi mos bo'lsa boshqa hech narsa qilmaydi. Aks holda
+    fayl qulfi ostida init_db + migrate_db bitta tranzaksiyada bajariladi — parallel ishga tushgan
+    workerlar navbat kutadi.
+    """
+    started = time.perf_counter()
+    conn = db.connect()
+    try:
+        if not db.memory:
+            # WAL faylda saqlanadi: o'quvchilar (backup, hisobot snapshoti) yozuvchilarni to'xtatmaydi
+            conn.execute('PRAGMA journal_mode=WAL')
+        if conn.execute('PRAGMA user_version').fetchone()[0] == SCHEMA_VERSION:
+            return {'bootstrapped': False, 'total_ms': (time.perf_counter() - started) * 1000}
+
+        lock = open(DB_LOCK_PATH, 'w')
+        try:
+            if fcntl:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            locked = time.perf_counter()
+            if conn.execute('PRAGMA user_version').fetchone()[0] == SCHEMA_VERSION:
+                return {'bootstrapped': False, 'total_ms': (time.perf_counter() - started) * 1000}
+            conn.execute('BEGIN IMMEDIATE')
+            init_db(conn)
+            migrate_db(conn)
+            conn.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+            conn.commit()
+            done = time.perf_counter()
+        finally:
+            if fcntl:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+            lock.close()
+        return {'bootstrapped': True, 'lock_wait_ms': (locked - started) * 1000,
+                'schema_ms': (done - locked) * 1000, 'total_ms': (done - started) * 1000}
+    finally:
+        conn.close()
+
+
+_schema_ready = False
+_schema_lock = threading.Lock()
+
+
+def ensure_schema():
+    """
+    bootstrap_db() jarayonda bir marta. create_app() dan tashqari, birinchi get_db() da ham chaqiriladi —
+    'main:app' yoki 'flask --app main ...' bilan ishga tushganda sxemasiz bazaga so'rov ketmaydi.
+    Natija — bootstrap_db() ga o'xshash, allaqachon tekshirilgan bo'lsa None.
+    """
+    global _schema_ready
+    with _schema_lock:
+        if _schema_ready:
+            return None
+        boot = bootstrap_db()
+        _schema_ready = True
+        return boot
 
 
 def login_required(f):
@@ -252,6 +1208,283 @@ def admin_required(f):
     return wrapper
 
 
+# ═══════════════════════════════════════════════
+# UPLOADS — magic-byte validation, streamed size cap, background thumbnails
+# ═══════════════════════════════════════════════
+
+THUMB_SIZE = (480, 480)
+UPLOAD_CHUNK = 64 * 1024
+
+
+def sniff_image_type(head: bytes):
+    if head.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'png'
+    if head.startswith(b'\xff\xd8\xff'):
+        return 'jpg'
+    if head[:6] in (b'GIF87a', b'GIF89a'):
+        return 'gif'
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'webp'
+    return None
+
+
+def save_upload(file, stem: str):
+    """
+    Rasmni diskka oqim bilan yozadi. (url, None) yoki (None, xato_matni) qaytaradi.
+    Kengaytma fayl nomidan emas, magic bytes dan olinadi.
+    """
+    limit = app.config['MAX_UPLOAD_BYTES']
+    first = file.stream.read(UPLOAD_CHUNK)
+    ext = sniff_image_type(first)
+    if not ext:
+        return None, "Faqat PNG, JPG, GIF yoki WEBP rasm yuklash mumkin!"
+
+    filename = secure_filename(f"{stem}.{ext}")
+    path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+    tmp_path = path + '.part'
+    written = 0
+    try:
+        with open(tmp_path, 'wb') as out:
+            chunk = first
+            while chunk:
+                written += len(chunk)
+                if written > limit:
+                    raise ValueError
+                out.write(chunk)
+                chunk = file.stream.read(UPLOAD_CHUNK)
+    except ValueError:
+        os.remove(tmp_path)
+        return None, f"Rasm hajmi {limit // (1024 * 1024)} MB dan oshmasligi kerak!"
+    os.replace(tmp_path, path)
+    enqueue_thumbnail(path)
+    return f"/static/uploads/{filename}", None
+
+
+def _variant_path(path: str, suffix: str, ext=None) -> str:
+    base, orig_ext = os.path.splitext(path)
+    return f"{base}{suffix}{ext or orig_ext}"
+
+
+def make_thumbnails(path: str):
+    """Kichik nusxa (asl formatda) va WebP variantlarini yaratadi."""
+    if not PIL_AVAILABLE:
+        return
+    from PIL import Image
+    with Image.open(path) as img:
+        img.load()
+        if img.mode not in ('RGB', 'RGBA'):
+            img = img.convert('RGBA' if 'transparency' in img.info or img.mode in ('LA', 'P') else 'RGB')
+        if not path.endswith('.webp'):
+            img.save(_variant_path(path, '', '.webp'), 'WEBP', quality=82, method=4)
+        thumb = img.copy()
+        thumb.thumbnail(THUMB_SIZE)
+        thumb_path = _variant_path(path, '_thumb')
+        if thumb_path.endswith(('.jpg', '.jpeg')) and thumb.mode == 'RGBA':
+            thumb = thumb.convert('RGB')
+        thumb.save(thumb_path, quality=80)
+        if not thumb_path.endswith('.webp'):
+            thumb.save(_variant_path(path, '_thumb', '.webp'), 'WEBP', quality=78, method=4)
+
+
+_thumb_queue = queue.Queue()
+_thumb_worker_pid = None
+_thumb_worker_lock = threading.Lock()
+
+
+def _thumbnail_worker():
+    while True:
+        path = _thumb_queue.get()
+        try:
+            make_thumbnails(path)
+        except Exception as e:
+            app.logger.warning("Thumbnail yaratilmadi %s: %s", path, e)
+        finally:
+            _thumb_queue.task_done()
+
+
+def enqueue_thumbnail(path: str):
+    global _thumb_worker_pid
+    if not PIL_AVAILABLE:
+        return
+    with _thumb_worker_lock:
+        # Thread fork dan keyin yo'qoladi, shuning uchun har bir worker o'zinikini ishga tushiradi
+        if _thumb_worker_pid != os.getpid():
+            threading.Thread(target=_thumbnail_worker, name='thumbnails', daemon=True).start()
+            _thumb_worker_pid = os.getpid()
+    _thumb_queue.put(path)
+
+
+def image_variants(url: str) -> dict:
+    """Yuklangan rasm uchun mavjud variantlar: thumb, thumb_webp, webp (yo'q bo'lsa asl url)."""
+    variants = {'original': url, 'thumb': url, 'thumb_webp': None, 'webp': None}
+    if not url or not url.startswith('/static/uploads/'):
+        return variants
+    path = os.path.join(app.config['UPLOAD_FOLDER'], url[len('/static/uploads/'):])
+    for key, candidate in (('thumb', _variant_path(path, '_thumb')),
+                           ('thumb_webp', _variant_path(path, '_thumb', '.webp')),
+                           ('webp', _variant_path(path, '', '.webp'))):
+        if os.path.exists(candidate):
+            variants[key] = '/static/uploads/' + os.path.basename(candidate)
+    return variants
+
+
+def picture_html(url: str, style: str = '', full: bool = False) -> str:
+    v = image_variants(url)
+    webp = v['webp'] if full else v['thumb_webp']
+    src = v['original'] if full else v['thumb']
+    source = f'<source srcset="{webp}" type="image/webp">' if webp and webp != src else ''
+    return f'<picture>{source}<img src="{src}" loading="lazy" decoding="async" alt="" style="{style}"></picture>'
+
+
+@app.errorhandler(413)
+def upload_too_large(e):
+    limit = app.config['MAX_UPLOAD_BYTES'] // (1024 * 1024)
+    return jsonify(success=False, message=f"Fayl hajmi {limit} MB dan oshmasligi kerak!"), 413
+
+
+@app.cli.command('make-thumbnails')
+def make_thumbnails_command():
+    """Mavjud yuklangan rasmlar uchun thumbnail va WebP variantlarini yaratadi."""
+    folder = app.config['UPLOAD_FOLDER']
+    done = 0
+    for name in sorted(os.listdir(folder)):
+        base, ext = os.path.splitext(name)
+        if ext.lower().lstrip('.') not in app.config['ALLOWED_EXTENSIONS'] or base.endswith('_thumb'):
+            continue
+        path = os.path.join(folder, name)
+        if ext == '.webp' and any(os.path.exists(os.path.join(folder, f"{base}.{e}"))
+                                  for e in app.config['ALLOWED_EXTENSIONS'] if e != 'webp'):
+            continue
+        try:
+            make_thumbnails(path)
+            done += 1
+        except Exception as e:
+            print(f"  ⚠️  {name}: {e}")
+    print(f"  ✅ {done} ta rasm qayta ishlandi")
+
+
+# ═══════════════════════════════════════════════
+# RATE LIMITING — token bucket, shared across gunicorn workers via SQLite
+# ═══════════════════════════════════════════════
+
+RATELIMIT_ENABLED = os.environ.get('RATELIMIT_ENABLED', '1') == '1'
+RATELIMIT_DB = os.environ.get('RATELIMIT_DB', 'ratelimit.db')
+STATS_TOKEN = "ssmernix_legend_teams"  # o'yin serveri plagini /api/update_stats ga yuboradi
+
+# endpoint class -> "N/SECONDS": bucket of N requests, refilled over SECONDS
+RATE_LIMIT_DEFAULTS = {
+    'purchase': '10/60',
+    'auth': '10/60',
+    'ingest': '600/60',
+}
+
+
+def _parse_rate_limit(spec: str):
+    count, per = spec.split('/', 1)
+    burst = float(count)
+    return burst / float(per), burst
+
+
+RATE_LIMITS = {
+    cls: _parse_rate_limit(os.environ.get(f'RATE_LIMIT_{cls.upper()}', default))
+    for cls, default in RATE_LIMIT_DEFAULTS.items()
+}
+
+_ratelimit_local = threading.local()
+
+
+def _ratelimit_conn():
+    # Har bir worker/thread o'z ulanishini saqlaydi; fork dan keyin qayta ochiladi
+    conn = getattr(_ratelimit_local, 'conn', None)
+    if conn is not None and _ratelimit_local.pid == os.getpid():
+        return conn
+    conn = sqlite3.connect(RATELIMIT_DB, timeout=2, isolation_level=None, check_same_thread=False)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=OFF')
+    conn.execute('CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tokens REAL, updated REAL)')
+    conn.execute('''CREATE TABLE IF NOT EXISTS rejections
+                    (limit_class TEXT PRIMARY KEY, count INTEGER DEFAULT 0, last_at REAL)''')
+    _ratelimit_local.conn = conn
+    _ratelimit_local.pid = os.getpid()
+    _ratelimit_local.calls = 0
+    return conn
+
+
+def rate_limit_take(bucket_key: str, limit_class: str) -> float:
+    """Bucket dan bitta token oladi. 0 qaytarsa ruxsat, aks holda Retry-After soniyalari."""
+    rate, burst = RATE_LIMITS[limit_class]
+    now = time.time()
+    conn = _ratelimit_conn()
+    conn.execute('BEGIN IMMEDIATE')  # ratelimit.db doim mahalliy SQLite — DATABASE_URL ga bog'liq emas
+    try:
+        row = conn.execute('SELECT tokens, updated FROM buckets WHERE key=?', (bucket_key,)).fetchone()
+        tokens = burst if row is None else min(burst, row[0] + (now - row[1]) * rate)
+        if tokens >= 1:
+            tokens -= 1
+            retry_after = 0.0
+        else:
+            retry_after = (1 - tokens) / rate
+            conn.execute('''INSERT INTO rejections (limit_class, count, last_at) VALUES (?, 1, ?)
+                            ON CONFLICT(limit_class) DO UPDATE SET count=count+1, last_at=excluded.last_at''',
+                         (limit_class, now))
+        conn.execute('INSERT OR REPLACE INTO buckets (key, tokens, updated) VALUES (?, ?, ?)',
+                     (bucket_key, tokens, now))
+        _ratelimit_local.calls += 1
+        if _ratelimit_local.calls % 1000 == 0:
+            # 1 soatdan beri tegilmagan bucketlar allaqachon to'la — o'chirsa bo'ladi
+            conn.execute('DELETE FROM buckets WHERE updated < ?', (now - 3600,))
+        conn.execute('COMMIT')
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+    return retry_after
+
+
+def _rate_limit_identity(limit_class: str) -> str:
+    if limit_class == 'ingest':
+        data = request.get_json(force=True, silent=True) or {}
+        token = str(data.get('token', ''))
+        # tekshirilmagan token bo'yicha kalit — har so'rovda yangi token bilan cheklovni chetlab o'tish
+        if secrets.compare_digest(token.encode(), STATS_TOKEN.encode()):
+            return 'token:' + hashlib.sha256(token.encode()).hexdigest()[:16]
+        return f'ip:{request.remote_addr}'
+    if 'user_id' in session:
+        return f"user:{session['user_id']}"
+    return f'ip:{request.remote_addr}'
+
+
+def rate_limited(limit_class: str):
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*a, **kw):
+            if not RATELIMIT_ENABLED or request.method != 'POST':
+                return f(*a, **kw)
+            key = f'{limit_class}:{_rate_limit_identity(limit_class)}'
+            try:
+                retry_after = rate_limit_take(key, limit_class)
+            except sqlite3.Error:
+                # Limiter bazasi band bo'lsa so'rovni to'xtatmaymiz (fail-open)
+                retry_after = 0
+            if retry_after:
+                metric_inc('ratelimit_rejected_total', limit_class=limit_class)
+                resp = jsonify(success=False, message="Juda ko'p so'rov! Birozdan keyin qayta urinib ko'ring.")
+                resp.status_code = 429
+                resp.headers['Retry-After'] = str(math.ceil(retry_after))
+                return resp
+            return f(*a, **kw)
+        return wrapper
+    return decorator
+
+
+def rate_limit_stats() -> dict:
+    rows = _ratelimit_conn().execute('SELECT limit_class, count, last_at FROM rejections').fetchall()
+    rejected = {r[0]: {'rejected': r[1], 'last_rejected_at': r[2]} for r in rows}
+    return {
+        cls: {'rate_per_sec': rate, 'burst': burst, **rejected.get(cls, {'rejected': 0, 'last_rejected_at': None})}
+        for cls, (rate, burst) in RATE_LIMITS.items()
+    }
+
+
 # ═══════════════════════════════════════════════
 # RENDER PAGE — full shell with CSS + music + status + dog sound
 # ═══════════════════════════════════════════════
@@ -265,6 +1498,7 @@ def render_page(body_content: str, **kwargs) -> str:
         nav_user = f"""
                 <li><a href="/rules"><i class="fas fa-book"></i> <span>Qoidalar</span></a></li>
                 <li><a href="/support"><i class="fas fa-headset"></i> <span>Support</span></a></li>
+                <li><a href="/cart"><i class="fas fa-shopping-basket"></i> <span>Savat</span></a></li>
                 <li><a href="/balance"><i class="fas fa-wallet"></i> <span>Balans</span></a></li>
                 <li><a href="/profile"><i class="fas fa-user-circle"></i> <span>Profil</span></a></li>
                 {'<li><a href="/admin"><i class="fas fa-bolt"></i> <span>Admin</span></a></li>' if kwargs.get('is_admin') else ''}
@@ -280,8 +1514,9 @@ def render_page(body_content: str, **kwargs) -> str:
     music_enabled = settings.get('music_enabled', '1')
     has_music = (music_enabled == '1')
     # Har doim local mp3 fayl ishlatiladi (YouTube URL <audio> tagida ishlamaydi)
-    aria_math_url = "/static/music/bg.mp3"
-    music_iframe_html = f'<audio id="musicAudio" loop preload="auto" style="display:none;"><source src="{aria_math_url}" type="audio/mpeg"></audio>' if has_music else ''
+    aria_math_url = static_url('music/bg.mp3')
+    # Musiqa faqat tugma bosilganda chalinadi — fayl Range so'rovlari bilan o'shanda yuklanadi
+    music_iframe_html = f'<audio id="musicAudio" loop preload="none" style="display:none;"><source src="{aria_math_url}" type="audio/mpeg"></audio>' if has_music else ''
     music_playing_class = ''
     music_init_js = 'false'
 
@@ -611,6 +1846,16 @@ function showToast(msg, type='success') {{
     document.body.appendChild(t);
     setTimeout(() => {{ t.classList.add('hide'); setTimeout(() => t.remove(), 400); }}, 3500);
 }}
+// ARCHIVE_BUTTON: {{html, next}} qaytaruvchi endpointdan keyingi sahifani data-target ga qo'shadi
+async function loadArchive(btn) {{
+    btn.disabled = true;
+    try {{
+        const r = await fetch(btn.dataset.url + '?before=' + encodeURIComponent(btn.dataset.before || ''));
+        const j = await r.json();
+        document.getElementById(btn.dataset.target).insertAdjacentHTML('beforeend', j.html);
+        if (j.next) {{ btn.dataset.before = j.next; btn.disabled = false; }} else btn.remove();
+    }} catch (e) {{ showToast('Xatolik!', 'error'); btn.disabled = false; }}
+}}
 function copyIP() {{
     navigator.clipboard.writeText('{server_ip}').then(() => showToast('IP nusxalandi!'));
 }}
@@ -697,6 +1942,39 @@ async function buyCustomTokens() {{
     }} catch(e) {{ showToast('Xatolik!', 'error'); }}
 }}
 
+async function addToCart(payload){{
+    const nick = prompt("Qaysi nikga?");
+    if(!nick) return;
+    payload.nick = nick;
+    try{{
+        const r=await fetch('/cart/add', {{method:'POST', headers:{{'Content-Type':'application/json'}}, body: JSON.stringify(payload)}});
+        const j=await r.json();
+        showToast(j.message, j.success?'success':'error');
+    }}catch(e){{showToast('Xatolik!','error');}}
+}}
+function addTokensToCart(){{
+    const amount = document.getElementById('tokenAmount').value;
+    if(!amount) return showToast("Token miqdorini kiriting!", "error");
+    addToCart({{tokens: amount}});
+}}
+async function removeCartItem(id){{
+    try{{
+        const r=await fetch('/cart/remove/'+id, {{method:'POST'}});
+        const j=await r.json();
+        if(j.success) location.reload(); else showToast(j.message,'error');
+    }}catch(e){{showToast('Xatolik!','error');}}
+}}
+async function checkoutCart(btn){{
+    if(!confirm("Savatdagi barcha mahsulotlarni sotib olasizmi?")) return;
+    btn.disabled = true;
+    try{{
+        const r=await fetch('/cart/checkout', {{method:'POST'}});
+        const j=await r.json();
+        showToast(j.message, j.success?'success':'error');
+        setTimeout(()=>location.reload(), 1800);
+    }}catch(e){{showToast('Xatolik!','error'); btn.disabled = false;}}
+}}
+
 async function approveDeposit(id){{
     const c=prompt('Izoh (ixtiyoriy):')||'';
     try{{
@@ -714,6 +1992,24 @@ async function rejectDeposit(id){{
         if(j.success) setTimeout(()=>location.reload(),1200);
     }}catch(e){{showToast('Xatolik!','error');}}
 }}
+async function loadRevenueChart(){{
+    const box=document.getElementById('revenueChart'); if(!box) return;
+    try{{
+        const d=await (await fetch('/admin/api/analytics?days=30')).json();
+        const s=d.series[0]||{{revenue:d.labels.map(()=>0),count:d.labels.map(()=>0),total_revenue:0,total_count:0}};
+        const max=Math.max(1,...s.revenue);
+        box.innerHTML=d.labels.map((day,i)=>'<div title="'+day+': '+s.revenue[i].toLocaleString()+" so'm, "+s.count[i]+' ta" style="flex:1;background:var(--primary);opacity:.85;border-radius:3px 3px 0 0;height:'+Math.max(2,s.revenue[i]/max*100)+'%;"></div>').join('');
+        document.getElementById('revenueChartMeta').textContent=d.labels[0]+' — '+d.labels[d.labels.length-1]+' • '+s.total_revenue.toLocaleString()+" so'm • "+s.total_count+' ta xarid';
+    }}catch(e){{}}
+}}
+document.addEventListener('DOMContentLoaded',loadRevenueChart);
+async function resetBreaker(server){{
+    try{{
+        const r=await fetch('/admin/health/'+encodeURIComponent(server)+'/reset',{{method:'POST'}});
+        const j=await r.json(); showToast(j.message,j.success?'success':'error');
+        if(j.success) setTimeout(()=>location.reload(),1200);
+    }}catch(e){{showToast('Xatolik!','error');}}
+}}
 async function saveSettings(){{
     const form=document.getElementById('settingsForm');
     const d=Object.fromEntries(new FormData(form));
@@ -747,54 +2043,326 @@ if (_newsForm) {{
 </html>'''
 
 
+_BODY_SLOT = '\x00body\x00'
+
+
+def stream_page(chunks, **kwargs) -> Response:
+    """render_page ning oqimli varianti: sahifa boshi darhol yuboriladi, tana bo'laklari keyin."""
+    head, tail = render_page(_BODY_SLOT, **kwargs).split(_BODY_SLOT, 1)
+
+    def generate():
+        yield head
+        yield from chunks
+        yield tail
+
+    return Response(stream_with_context(generate()), mimetype='text/html')
+
+
+def iter_keyset(select: str, where: list, params: list, render_row, key: str = 'id', batch: int = 200):
+    """
+    `key DESC` bo'yicha `batch` talik bo'laklar, har biri alohida `key < oxirgi` so'rovi va ulanish bilan.
+    Oqimni sekin o'qiyotgan klient SHARED qulfni ushlab turmaydi — yozuvchilar 'database is locked' olmaydi.
+    """
+    last = None
+    while True:
+        cond = where + ([f'{key} < ?'] if last is not None else [])
+        sql = f"{select}{' WHERE ' + ' AND '.join(cond) if cond else ''} ORDER BY {key} DESC LIMIT {batch}"
+        conn = get_db()
+        try:
+            rows = conn.execute(sql, params + ([last] if last is not None else [])).fetchall()
+        finally:
+            conn.close()
+        if not rows:
+            return
+        yield ''.join(render_row(r) for r in rows)
+        if len(rows) < batch:
+            return
+        last = rows[-1][key.rpartition('.')[2]]
+
+
 # ═══════════════════════════════════════════════
-# INDEX
+# RESPONSE COMPRESSION — gzip/brotli with a cache of compressed bodies
 # ═══════════════════════════════════════════════
 
-@app.route('/')
-def index():
-    conn = get_db()
-    settings = {r['key']: r['value'] for r in conn.execute('SELECT key,value FROM settings').fetchall()}
-    all_news = conn.execute('SELECT * FROM news ORDER BY created_at DESC LIMIT 6').fetchall()
-    total_users = conn.execute('SELECT COUNT(*) as c FROM users WHERE is_admin=0').fetchone()['c']
-    total_purchases = conn.execute('SELECT COUNT(*) as c FROM purchases').fetchone()['c']
-    total_revenue = conn.execute('SELECT COALESCE(SUM(amount),0) as s FROM purchases').fetchone()['s']
-    ranks = conn.execute("SELECT DISTINCT name, color FROM packages WHERE category='anarchy' AND is_active=1").fetchall()
-    conn.close()
+COMPRESS_MIN_SIZE = int(os.environ.get('COMPRESS_MIN_SIZE', '1024'))
+COMPRESS_CACHE_BYTES = int(os.environ.get('COMPRESS_CACHE_MB', '16')) * 1024 * 1024
+COMPRESS_MIMETYPES = {
+    'text/html', 'text/css', 'text/plain', 'text/csv', 'application/json', 'application/javascript',
+    'application/xml', 'application/atom+xml', 'application/x-ndjson', 'image/svg+xml',
+}
+
+_compress_cache = OrderedDict()
+_compress_cache_size = 0
+_compress_cache_lock = threading.Lock()
+
+
+def _choose_encoding():
+    accept = request.accept_encodings
+    if BROTLI_AVAILABLE and accept['br']:
+        return 'br'
+    if accept['gzip']:
+        return 'gzip'
+    return None
+
+
+def _compress(data: bytes, encoding: str) -> bytes:
+    if encoding == 'br':
+        return brotli.compress(data, quality=5)
+    return gzip.compress(data, 6)
+
+
+def _compressed_cached(data: bytes, encoding: str) -> bytes:
+    global _compress_cache_size
+    key = (encoding, hashlib.sha1(data).digest())
+    with _compress_cache_lock:
+        hit = _compress_cache.get(key)
+        if hit is not None:
+            _compress_cache.move_to_end(key)
+            return hit
+    out = _compress(data, encoding)
+    with _compress_cache_lock:
+        if key not in _compress_cache:
+            _compress_cache[key] = out
+            _compress_cache_size += len(out)
+            while _compress_cache_size > COMPRESS_CACHE_BYTES and _compress_cache:
+                _, old = _compress_cache.popitem(last=False)
+                _compress_cache_size -= len(old)
+    return out
+
+
+def _compress_stream(chunks, encoding: str):
+    # Har bir bo'lak flush qilinadi — brauzer birinchi baytlarni darhol oladi
+    if encoding == 'br':
+        comp = brotli.Compressor(quality=4)
+        step, finish = (lambda b: comp.process(b) + comp.flush()), comp.finish
+    else:
+        comp = zlib.compressobj(6, zlib.DEFLATED, 31)
+        step, finish = (lambda b: comp.compress(b) + comp.flush(zlib.Z_SYNC_FLUSH)), comp.flush
+    try:
+        for chunk in chunks:
+            out = step(chunk.encode() if isinstance(chunk, str) else chunk)
+            if out:
+                yield out
+        yield finish()
+    finally:
+        close = getattr(chunks, 'close', None)
+        if close:
+            close()
+
+
+@app.after_request
+def compress_response(resp):
+    if (request.method == 'HEAD' or resp.status_code < 200 or resp.status_code in (204, 206, 304)
+            or resp.direct_passthrough or 'Content-Encoding' in resp.headers
+            or resp.mimetype not in COMPRESS_MIMETYPES):
+        return resp
+    resp.vary.add('Accept-Encoding')
+    encoding = _choose_encoding()
+    if not encoding:
+        return resp
+
+    if resp.is_streamed:
+        resp.response = _compress_stream(resp.response, encoding)
+        resp.headers.pop('Content-Length', None)
+    else:
+        data = resp.get_data()
+        if len(data) < COMPRESS_MIN_SIZE:
+            return resp
+        if request.method == 'GET' and not resp.cache_control.no_store:
+            resp.set_data(_compressed_cached(data, encoding))
+        else:
+            resp.set_data(_compress(data, encoding))
+    resp.headers['Content-Encoding'] = encoding
+    etag, weak = resp.get_etag()
+    if etag and not weak:
+        resp.set_etag(etag, weak=True)
+    return resp
 
-    server_ip = settings.get('server_ip', 'elitemc.uz')
-    real_online = get_real_online(server_ip)
-    display_online = real_online if real_online is not None else settings.get('online_players', '0')
 
-    trailer_html = ''
-    if settings.get('show_trailer') == '1' and settings.get('trailer_url'):
-        trailer_html = f'<div style="margin:0 auto 2rem;max-width:800px;border:2px solid var(--primary);border-radius:20px;overflow:hidden;box-shadow:var(--glow-green);position:relative;z-index:1;"><iframe width="100%" height="400" src="{settings.get("trailer_url")}" frameborder="0" allowfullscreen></iframe></div>'
+# ═══════════════════════════════════════════════
+# NEWS CACHE — pre-rendered cards, invalidated by settings.news_version
+# ═══════════════════════════════════════════════
 
-    news_html = ''.join([
-        f'<div class="card"><h3 style="color:var(--primary);font-family:Orbitron,sans-serif;font-size:1rem;">{sanitize(n["title"])}</h3><p style="font-size:.78rem;opacity:.5;margin:.3rem 0 .6rem;">{str(n["created_at"])[:16]}</p><p style="font-size:.88rem;">{sanitize(n["content"][:120])}...</p></div>'
-        for n in all_news
-    ])
+NEWS_PAGE_SIZE = 10
+NEWS_FEED_SIZE = 20
+NEWS_PAGES_CACHED = 64
+# Feed dagi mutlaq havolalar uchun kanonik manzil (https://elitemc.uz). Berilmasa so'rov Host i ishlatiladi
+# va feed keshlanmaydi — soxta Host boshqalarning feed ini buzmaydi va keshni o'stira olmaydi
+SITE_URL = os.environ.get('SITE_URL', '').rstrip('/')
 
-    chips = ''
-    for i, r in enumerate(ranks):
-        delay = i * 0.07
-        chips += f'<span class="rank-chip" style="color:{r["color"]};border-color:{r["color"]};background:{r["color"]}18;animation-delay:{delay}s;">{sanitize(r["name"])}</span>'
+_news_cache = {'version': None, 'home': None, 'pages': OrderedDict(), 'feed': OrderedDict()}
+_news_cache_lock = threading.Lock()
 
-    content = f'''
-    <div class="hero">
-        <div class="hero-glow"></div>
-        <div class="container">
-            {trailer_html}
-            <h1 class="glitch-text">EliteMC.uz</h1>
-            <p style="position:relative;z-index:1;color:var(--text-dim);font-size:1.05rem;animation:fadeUp .8s .15s ease-out both;">Uzbekistandagi N1 Minecraft Serveri</p>
 
-            <div class="server-ip-box">
-                <span class="ip-text">{server_ip}</span>
-                <span class="ip-icon"><i class="fas fa-copy"></i></span>
-            </div>
+def bump_news_version(conn):
+    conn.execute("UPDATE settings SET value=CAST(value AS INTEGER)+1 WHERE key='news_version'")
 
-            <div class="server-status-bar">
-                <div class="status-card pulse-green">
+
+def _news_cache_for(version):
+    with _news_cache_lock:
+        if _news_cache['version'] != version:
+            _news_cache.update(version=version, home=None, pages=OrderedDict(), feed=OrderedDict())
+        return _news_cache
+
+
+def _news_cache_put(version, section, key, value):
+    """
+    Kesh hali shu versiyada bo'lsagina yoziladi — eski news_version ni o'qigan so'rov boshqa so'rov
+    tozalagan keshga eski fragment qo'ymaydi. Lug'atli bo'limlar NEWS_PAGES_CACHED bilan cheklanadi.
+    """
+    with _news_cache_lock:
+        if _news_cache['version'] != version:
+            return
+        if key is None:
+            _news_cache[section] = value
+            return
+        _news_cache[section][key] = value
+        while len(_news_cache[section]) > NEWS_PAGES_CACHED:
+            _news_cache[section].popitem(last=False)
+
+
+def _news_images_ready(rows) -> bool:
+    # Thumbnail hali tayyor bo'lmasa fragmentni keshlamaymiz, aks holda asl rasm keshda qolib ketadi
+    return not PIL_AVAILABLE or all(
+        image_variants(n['image'])['thumb_webp'] for n in rows if n['image'])
+
+
+def _news_home_card(n) -> str:
+    img = picture_html(n["image"], "width:100%;height:180px;object-fit:cover;border-radius:10px;margin-bottom:.8rem;") if n["image"] else ""
+    return f'<div class="card">{img}<h3 style="color:var(--primary);font-family:Orbitron,sans-serif;font-size:1rem;">{sanitize(n["title"])}</h3><p style="font-size:.78rem;opacity:.5;margin:.3rem 0 .6rem;">{str(n["created_at"])[:16]}</p><p style="font-size:.88rem;">{sanitize(n["content"][:120])}...</p></div>'
+
+
+def _news_full_card(n) -> str:
+    img = picture_html(n['image'], 'width:100%;max-height:420px;object-fit:cover;border-radius:12px;margin-bottom:1rem;', full=True) if n['image'] else ''
+    return f'''
+        <div class="card" id="news-{n['id']}">
+            <div class="card-header"><i class="fas fa-newspaper"></i><h2>{sanitize(n['title'])}</h2></div>
+            {img}
+            <p style="color:var(--text-dim);font-size:0.85rem;margin-bottom:1rem;">{n['created_at']}</p>
+            <div style="line-height:1.8; color:var(--text);">{sanitize(n['content'])}</div>
+        </div>
+        '''
+
+
+def latest_news_html(conn, version) -> str:
+    cache = _news_cache_for(version)
+    if cache['home'] is not None:
+        return cache['home']
+    rows = conn.execute('SELECT * FROM news ORDER BY created_at DESC, id DESC LIMIT 6').fetchall()
+    html_out = ''.join(_news_home_card(n) for n in rows)
+    if _news_images_ready(rows):
+        _news_cache_put(version, 'home', None, html_out)
+    return html_out
+
+
+def news_page_html(conn, version, before: str = ''):
+    """Keyset sahifa: (kartalar_html, keyingi_kursor). Kursor — 'created_at|id'."""
+    cache = _news_cache_for(version)
+    with _news_cache_lock:
+        hit = cache['pages'].get(before)
+    if hit is not None:
+        return hit
+    if before and '|' in before:
+        created_at, _, nid = before.rpartition('|')
+        rows = conn.execute('SELECT * FROM news WHERE (created_at, id) < (?, ?) ORDER BY created_at DESC, id DESC LIMIT ?',
+                            (created_at, int(nid) if nid.isdigit() else 0, NEWS_PAGE_SIZE + 1)).fetchall()
+    else:
+        rows = conn.execute('SELECT * FROM news ORDER BY created_at DESC, id DESC LIMIT ?',
+                            (NEWS_PAGE_SIZE + 1,)).fetchall()
+    page, more = rows[:NEWS_PAGE_SIZE], len(rows) > NEWS_PAGE_SIZE
+    result = (''.join(_news_full_card(n) for n in page),
+              f"{page[-1]['created_at']}|{page[-1]['id']}" if more else None)
+    if _news_images_ready(page):
+        _news_cache_put(version, 'pages', before, result)
+    return result
+
+
+def _news_feed_body(conn, version, fmt: str) -> bytes:
+    cache = _news_cache_for(version)
+    root = SITE_URL or request.url_root.rstrip('/')
+    body = cache['feed'].get(fmt) if SITE_URL else None
+    if body is not None:
+        return body
+    rows = conn.execute('SELECT * FROM news ORDER BY created_at DESC, id DESC LIMIT ?', (NEWS_FEED_SIZE,)).fetchall()
+
+    def iso(ts):
+        return str(ts).replace(' ', 'T') + 'Z'
+
+    if fmt == 'json':
+        body = json.dumps({
+            'version': 'https://jsonfeed.org/version/1.1',
+            'title': 'EliteMC — Yangiliklar',
+            'home_page_url': root + '/news',
+            'feed_url': root + '/news/feed.json',
+            'items': [{
+                'id': str(n['id']),
+                'url': f"{root}/news#news-{n['id']}",
+                'title': n['title'],
+                'content_text': n['content'],
+                'image': root + n['image'] if n['image'] else None,
+                'date_published': iso(n['created_at']),
+            } for n in rows],
+        }, ensure_ascii=False).encode()
+    else:
+        esc = html_module.escape
+        updated = iso(rows[0]['created_at']) if rows else iso(datetime.datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S'))
+        entries = ''.join(
+            f'''<entry><id>{root}/news#news-{n['id']}</id><title>{esc(n['title'])}</title>'''
+            f'''<link href="{root}/news#news-{n['id']}"/><updated>{iso(n['created_at'])}</updated>'''
+            f'''<content type="text">{esc(n['content'])}</content></entry>'''
+            for n in rows)
+        body = (f'''<?xml version="1.0" encoding="utf-8"?>'''
+                f'''<feed xmlns="http://www.w3.org/2005/Atom"><title>EliteMC — Yangiliklar</title>'''
+                f'''<id>{root}/news</id><link href="{root}/news"/><link rel="self" href="{root}/news/feed.atom"/>'''
+                f'''<updated>{updated}</updated>{entries}</feed>''').encode()
+    if SITE_URL:
+        _news_cache_put(version, 'feed', fmt, body)
+    return body
+
+
+# ═══════════════════════════════════════════════
+# INDEX
+# ═══════════════════════════════════════════════
+
+@app.route('/')
+def index():
+    conn = get_db()
+    settings = {r['key']: r['value'] for r in conn.execute('SELECT key,value FROM settings').fetchall()}
+    news_html = latest_news_html(conn, settings.get('news_version'))
+    total_users = conn.execute('SELECT COUNT(*) as c FROM users WHERE is_admin=0').fetchone()['c']
+    total_revenue, total_purchases = analytics_totals(conn)
+    ranks = conn.execute("SELECT DISTINCT name, color FROM packages WHERE category='anarchy' AND is_active=1").fetchall()
+    conn.close()
+
+    server_ip = settings.get('server_ip', 'elitemc.uz')
+    real_online = get_real_online(server_ip)
+    display_online = real_online if real_online is not None else settings.get('online_players', '0')
+
+    trailer_html = ''
+    if settings.get('show_trailer') == '1' and settings.get('trailer_url'):
+        trailer_html = f'<div style="margin:0 auto 2rem;max-width:800px;border:2px solid var(--primary);border-radius:20px;overflow:hidden;box-shadow:var(--glow-green);position:relative;z-index:1;"><iframe width="100%" height="400" src="{settings.get("trailer_url")}" frameborder="0" allowfullscreen></iframe></div>'
+
+
+    chips = ''
+    for i, r in enumerate(ranks):
+        delay = i * 0.07
+        chips += f'<span class="rank-chip" style="color:{r["color"]};border-color:{r["color"]};background:{r["color"]}18;animation-delay:{delay}s;">{sanitize(r["name"])}</span>'
+
+    content = f'''
+    <div class="hero">
+        <div class="hero-glow"></div>
+        <div class="container">
+            {trailer_html}
+            <h1 class="glitch-text">EliteMC.uz</h1>
+            <p style="position:relative;z-index:1;color:var(--text-dim);font-size:1.05rem;animation:fadeUp .8s .15s ease-out both;">Uzbekistandagi N1 Minecraft Serveri</p>
+
+            <div class="server-ip-box">
+                <span class="ip-text">{server_ip}</span>
+                <span class="ip-icon"><i class="fas fa-copy"></i></span>
+            </div>
+
+            <div class="server-status-bar">
+                <div class="status-card pulse-green">
                     <div class="status-icon green"><span class="live-dot"></span><i class="fas fa-signal"></i></div>
                     <div class="status-info">
                         <span class="status-label">Online Players</span>
@@ -842,29 +2410,40 @@ def index():
 
 @app.route('/news')
 def news_page():
+    before = request.args.get('before', '')
     conn = get_db()
-    all_news = conn.execute('SELECT * FROM news ORDER BY created_at DESC').fetchall()
+    version = conn.execute("SELECT value FROM settings WHERE key='news_version'").fetchone()
+    news_html, next_cursor = news_page_html(conn, version['value'] if version else None, before)
     conn.close()
 
-    news_html = ""
-    for n in all_news:
-        news_html += f'''
-        <div class="card">
-            <div class="card-header"><i class="fas fa-newspaper"></i><h2>{sanitize(n['title'])}</h2></div>
-            <p style="color:var(--text-dim);font-size:0.85rem;margin-bottom:1rem;">{n['created_at']}</p>
-            <div style="line-height:1.8; color:var(--text);">{sanitize(n['content'])}</div>
-        </div>
-        '''
+    more_html = f'<div style="text-align:center;margin:1rem 0 3rem;"><a href="{url_for("news_page", before=next_cursor)}" class="btn btn-outline"><i class="fas fa-angle-double-down"></i> Oldingi yangiliklar</a></div>' if next_cursor else ''
 
     content = f'''
     <div class="container" style="padding-top:2rem; max-width:900px;">
         <div class="section-title"><h2>📰 Barcha Yangiliklar</h2></div>
         {news_html if news_html else '<p style="text-align:center; opacity:0.5;">Yangiliklar mavjud emas.</p>'}
+        {more_html}
     </div>
     '''
     return render_page(content, logged_in='user_id' in session, is_admin=session.get('is_admin', False))
 
 
+@app.route('/news/feed.<fmt>')
+def news_feed(fmt):
+    if fmt not in ('atom', 'json'):
+        abort(404)
+    conn = get_db()
+    version = conn.execute("SELECT value FROM settings WHERE key='news_version'").fetchone()
+    version = version['value'] if version else None
+    body = _news_feed_body(conn, version, fmt)
+    conn.close()
+    resp = Response(body, mimetype='application/json' if fmt == 'json' else 'application/atom+xml')
+    resp.set_etag(f'news-{version}-{fmt}')
+    resp.cache_control.public = True
+    resp.cache_control.max_age = 300
+    return resp.make_conditional(request)
+
+
 @app.route('/admin/add_news', methods=['POST'])
 @admin_required
 def add_news():
@@ -878,18 +2457,17 @@ def add_news():
     if 'image' in request.files:
         file = request.files['image']
         if file and file.filename and allowed_file(file.filename):
-            filename = secure_filename(file.filename)
+            name = os.path.splitext(secure_filename(file.filename))[0]
             timestamp = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
-            name, ext = os.path.splitext(filename)
-            unique_filename = f"{name}_{timestamp}{ext}"
-            filepath = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
-            file.save(filepath)
-            image_url = f"/static/uploads/{unique_filename}"
+            image_url, error = save_upload(file, f"{name}_{timestamp}")
+            if error:
+                return jsonify(success=False, message=error)
 
     try:
         conn = get_db()
         conn.execute('INSERT INTO news (title, content, image) VALUES (?, ?, ?)',
                      (title, content, image_url))
+        bump_news_version(conn)
         conn.commit()
         conn.close()
         return jsonify(success=True, message="Yangilik muvaffaqiyatli qo'shildi!")
@@ -902,6 +2480,7 @@ def add_news():
 def delete_news(nid):
     conn = get_db()
     conn.execute('DELETE FROM news WHERE id=?', (nid,))
+    bump_news_version(conn)
     conn.commit()
     conn.close()
     return jsonify(success=True, message="Yangilik o'chirildi!")
@@ -912,6 +2491,7 @@ def delete_news(nid):
 # ═══════════════════════════════════════════════
 
 @app.route('/register', methods=['GET', 'POST'])
+@rate_limited('auth')
 def register():
     if request.method == 'POST':
         data = request.get_json(force=True, silent=True) or {}
@@ -970,6 +2550,7 @@ def register():
 
 
 @app.route('/login', methods=['GET', 'POST'])
+@rate_limited('auth')
 def login():
     if request.method == 'POST':
         data = request.get_json(force=True, silent=True) or {}
@@ -1046,7 +2627,7 @@ def shop():
                 dur = 'UMRBOT' if v['duration'] == 'UMRBOT' else v['duration']
                 select_opts += f'<option value="{v["id"]}">{dur} — {v["price"]:,.0f} so\'m</option>'
 
-            btn = f'<button class="btn btn-primary btn-full" onclick="buySelectedRank(this)"><i class="fas fa-shopping-basket"></i> Sotib Olish</button>' if 'user_id' in session else '<a href="/login" class="btn btn-primary btn-full">Kirish Kerak</a>'
+            btn = f'<div style="display:flex;gap:.5rem;"><button class="btn btn-primary btn-full" onclick="buySelectedRank(this)"><i class="fas fa-shopping-basket"></i> Sotib Olish</button><button class="btn btn-secondary" title="Savatga" onclick="cartSelectedRank(this)"><i class="fas fa-cart-plus"></i></button></div>' if 'user_id' in session else '<a href="/login" class="btn btn-primary btn-full">Kirish Kerak</a>'
 
             html_out += f'''
             <div class="package-card" style="--pkg-color:{base['color']};">
@@ -1080,7 +2661,7 @@ def shop():
                 <strong style="color:var(--primary);font-size:1.2rem;" id="tokenPriceDisplay">0 so'm</strong>
             </div>
             ''' + (
-        f'<button class="btn btn-primary btn-full" onclick="buyCustomTokens()">Sotib Olish</button>' if 'user_id' in session else '<a href="/login" class="btn btn-primary btn-full">Kirish Kerak</a>') + '''
+        f'<div style="display:flex;gap:.5rem;"><button class="btn btn-primary btn-full" onclick="buyCustomTokens()">Sotib Olish</button><button class="btn btn-secondary" title="Savatga" onclick="addTokensToCart()"><i class="fas fa-cart-plus"></i></button></div>' if 'user_id' in session else '<a href="/login" class="btn btn-primary btn-full">Kirish Kerak</a>') + '''
         </div>
         <p style="text-align:center;font-size:0.8rem;color:var(--text-dim);margin-top:10px;">Kurs: 1 Token = 1.2 so'm</p>
     </div>
@@ -1125,19 +2706,56 @@ def shop():
         const card=btn.closest('.package-card');
         buyRank(card.querySelector('.pkg-select').value);
     }}
+    function cartSelectedRank(btn){{
+        const card=btn.closest('.package-card');
+        addToCart({{package_id: card.querySelector('.pkg-select').value}});
+    }}
     </script>'''
     return render_page(content, logged_in='user_id' in session, is_admin=session.get('is_admin', False))
 
 
+def reserve_purchase(conn, user_id, pkg, nick):
+    """
+    Bitta BEGIN IMMEDIATE ichida balans tekshiriladi, xarid 'pending' yoziladi va pul yechiladi —
+    parallel xaridlar balansni manfiyga tushira olmaydi. purchase_id yoki mablag' yetmasa None.
+    """
+    conn.execute('BEGIN IMMEDIATE')
+    if conn.execute('SELECT balance FROM users WHERE id=?', (user_id,)).fetchone()['balance'] < pkg['price']:
+        conn.rollback()
+        return None
+    purchase_id = conn.execute('''INSERT INTO purchases (user_id, package_id, amount, package_name, minecraft_nick, status, category)
+                                  VALUES (?, ?, ?, ?, ?, 'pending', ?)''',
+                               (user_id, pkg['id'], pkg['price'], pkg['name'], nick, pkg['category'])).lastrowid
+    post_ledger(conn, user_id, -pkg['price'], 'purchase', 'revenue', 'purchase', purchase_id)
+    conn.commit()
+    return purchase_id
+
+
+def settle_purchase(conn, user_id, purchase_id, pkg, nick, ok, memo='Berilmadi'):
+    """
+    RCON natijasi: 'completed' + entitlement, yoki xarid o'chirilib pul qaytariladi. Faqat hali 'pending'
+    bo'lsa — reconcile_pending_purchases bilan bir vaqtda ikki marta yakunlanmaydi. Yangi balans.
+    """
+    conn.execute('BEGIN IMMEDIATE')
+    if ok:
+        if conn.execute("UPDATE purchases SET status='completed' WHERE id=? AND status='pending'", (purchase_id,)).rowcount:
+            record_entitlement(conn, user_id, purchase_id, nick, pkg)
+    elif conn.execute("DELETE FROM purchases WHERE id=? AND status='pending'", (purchase_id,)).rowcount:
+        post_ledger(conn, user_id, pkg['price'], 'refund', 'revenue', 'purchase', purchase_id, memo=memo)
+    balance = conn.execute('SELECT balance FROM users WHERE id=?', (user_id,)).fetchone()['balance']
+    conn.commit()
+    return balance
+
+
 @app.route('/buy_rank/<int:package_id>', methods=['POST'])
 @login_required
+@rate_limited('purchase')
 def buy_rank(package_id):
     data = request.get_json(force=True, silent=True) or {}
     custom_nick = data.get('nick')
 
     conn = get_db()
     pkg = conn.execute('SELECT * FROM packages WHERE id=?', (package_id,)).fetchone()
-    user = conn.execute('SELECT balance FROM users WHERE id=?', (session['user_id'],)).fetchone()
 
     if not pkg:
         conn.close()
@@ -1147,25 +2765,481 @@ def buy_rank(package_id):
         conn.close()
         return jsonify(success=False, message="Iltimos, o'yinchi nikini kiriting!")
 
-    if not user or user['balance'] < pkg['price']:
+    nick = custom_nick
+    purchase_id = reserve_purchase(conn, session['user_id'], pkg, nick)
+    if purchase_id is None:
         conn.close()
         return jsonify(success=False, message="Mablag' yetarli emas!")
 
-    nick = custom_nick
-    new_bal = user['balance'] - pkg['price']
+    try:
+        ok, resp = execute_purchase(nick, pkg)
+    except Exception as e:
+        ok, resp = False, str(e)
+    new_bal = settle_purchase(conn, session['user_id'], purchase_id, pkg, nick, ok)
+    conn.close()
+    if ok:
+        return jsonify(success=True, message=f"{nick} ga {pkg['name']} berildi!", new_balance=new_bal)
+    return jsonify(success=False, message=f"Server xatosi: {resp}")
 
-    ok, resp = execute_purchase(nick, pkg)
 
-    if ok:
-        conn.execute('UPDATE users SET balance=? WHERE id=?', (new_bal, session['user_id']))
-        conn.execute('INSERT INTO purchases (user_id,package_id,amount,package_name,minecraft_nick) VALUES (?,?,?,?,?)',
-                     (session['user_id'], package_id, pkg['price'], pkg['name'], nick))
+# ═══════════════════════════════════════════════
+# SAVAT (CART) — bir nechta paketni bitta to'lov bilan sotib olish
+# ═══════════════════════════════════════════════
+
+CART_MAX_ITEMS = 20
+
+
+def cart_rows(conn, user_id):
+    """Savat qatorlari paket ma'lumotlari bilan; o'chirilgan/nofaol paketlar uchun pkg=None."""
+    rows = conn.execute('''SELECT c.id, c.package_id, c.tokens, c.nick, c.server_mode,
+                                  p.category, p.name, p.price, p.duration, p.is_active
+                           FROM cart_items c LEFT JOIN packages p ON p.id = c.package_id
+                           WHERE c.user_id=? ORDER BY c.id''', (user_id,)).fetchall()
+    out = []
+    for r in rows:
+        if r['package_id'] is None:
+            pkg = token_package(r['tokens'])
+        elif r['name'] is not None and r['is_active']:
+            pkg = {'id': r['package_id'], 'category': r['category'], 'name': r['name'], 'price': r['price'],
+                   'duration': r['duration']}
+        else:
+            pkg = None
+        out.append({'id': r['id'], 'nick': r['nick'], 'server_mode': r['server_mode'], 'pkg': pkg})
+    return out
+
+
+@app.route('/api/cart')
+@login_required
+def api_cart():
+    conn = get_db()
+    items = cart_rows(conn, session['user_id'])
+    conn.close()
+    return jsonify(items=[{'id': i['id'], 'nick': i['nick'], 'name': i['pkg']['name'] if i['pkg'] else None,
+                           'price': i['pkg']['price'] if i['pkg'] else None} for i in items],
+                   total=sum(i['pkg']['price'] for i in items if i['pkg']))
+
+
+@app.route('/cart/add', methods=['POST'])
+@login_required
+def cart_add():
+    data = request.get_json(force=True, silent=True) or {}
+    nick = sanitize(data.get('nick', '')).strip()
+    if not nick:
+        return jsonify(success=False, message="Iltimos, o'yinchi nikini kiriting!")
+    server_mode = data.get('server') if data.get('server') in ('anarchy', 'smp') else None
+
+    conn = get_db()
+    if conn.execute('SELECT COUNT(*) FROM cart_items WHERE user_id=?', (session['user_id'],)).fetchone()[0] >= CART_MAX_ITEMS:
+        conn.close()
+        return jsonify(success=False, message=f"Savatda {CART_MAX_ITEMS} tadan ortiq mahsulot bo'lishi mumkin emas!")
+
+    if data.get('package_id'):
+        pkg = conn.execute('SELECT id, name FROM packages WHERE id=? AND is_active=1', (data.get('package_id'),)).fetchone()
+        if not pkg:
+            conn.close()
+            return jsonify(success=False, message='Tovar topilmadi!')
+        conn.execute('INSERT INTO cart_items (user_id, package_id, nick, server_mode) VALUES (?, ?, ?, ?)',
+                     (session['user_id'], pkg['id'], nick, server_mode))
+        name = pkg['name']
+    else:
+        try:
+            amount = int(data.get('tokens', 0))
+        except (TypeError, ValueError):
+            amount = 0
+        if amount < 100:
+            conn.close()
+            return jsonify(success=False, message="Minimal 100 token!")
+        conn.execute('INSERT INTO cart_items (user_id, tokens, nick) VALUES (?, ?, ?)', (session['user_id'], amount, nick))
+        name = f"{amount} Token"
+    conn.commit()
+    count = conn.execute('SELECT COUNT(*) FROM cart_items WHERE user_id=?', (session['user_id'],)).fetchone()[0]
+    conn.close()
+    return jsonify(success=True, message=f"{name} savatga qo'shildi", count=count)
+
+
+@app.route('/cart/remove/<int:item_id>', methods=['POST'])
+@login_required
+def cart_remove(item_id):
+    conn = get_db()
+    conn.execute('DELETE FROM cart_items WHERE id=? AND user_id=?', (item_id, session['user_id']))
+    conn.commit()
+    conn.close()
+    return jsonify(success=True, message="Savatdan olib tashlandi")
+
+
+@app.route('/cart/checkout', methods=['POST'])
+@login_required
+@rate_limited('purchase')
+def cart_checkout():
+    """
+    1) Bitta tranzaksiyada: jami narx tekshiriladi, balansdan bir marta yechiladi, xaridlar 'pending'
+       holatda yoziladi va savat tozalanadi. 2) Buyruqlar har bir server uchun bitta RCON ulanishda
+       yuboriladi. 3) Bitta tranzaksiyada: bajarilganlar 'completed', bajarilmaganlar o'chirilib,
+       puli qaytariladi va savatga qaytariladi. RCON vaqtida baza qulflanmaydi.
+    """
+    uid = session['user_id']
+    conn = get_db()
+    conn.execute('BEGIN IMMEDIATE')
+    items = cart_rows(conn, uid)
+    if not items:
+        conn.rollback()
+        conn.close()
+        return jsonify(success=False, message="Savat bo'sh!")
+    missing = [i for i in items if i['pkg'] is None]
+    if missing:
+        conn.execute(f"DELETE FROM cart_items WHERE id IN ({','.join('?' * len(missing))})", [i['id'] for i in missing])
         conn.commit()
         conn.close()
-        return jsonify(success=True, message=f"{nick} ga {pkg['name']} berildi!", new_balance=new_bal)
+        return jsonify(success=False, message="Savatdagi ba'zi mahsulotlar endi sotilmaydi va olib tashlandi. Qayta tekshiring.")
 
+    total = sum(i['pkg']['price'] for i in items)
+    balance = conn.execute('SELECT balance FROM users WHERE id=?', (uid,)).fetchone()['balance']
+    if balance < total:
+        conn.rollback()
+        conn.close()
+        return jsonify(success=False, message=f"Mablag' yetarli emas! {total:,.0f} so'm kerak.")
+
+    purchase_ids = [conn.execute('''INSERT INTO purchases (user_id, package_id, amount, package_name, minecraft_nick, status, category)
+                                    VALUES (?, ?, ?, ?, ?, 'pending', ?)''',
+                                 (uid, i['pkg']['id'], i['pkg']['price'], i['pkg']['name'], i['nick'], i['pkg']['category'])).lastrowid
+                    for i in items]
+    post_ledger(conn, uid, -total, 'purchase', 'revenue', 'purchase', purchase_ids[0], memo=f"Savat: {len(items)} ta mahsulot")
+    conn.execute('DELETE FROM cart_items WHERE user_id=?', (uid,))
+    conn.commit()
+
+    try:
+        results = execute_purchases([(i['nick'], i['pkg'], i['server_mode']) for i in items])
+    except Exception as e:
+        results = [(False, str(e))] * len(items)
+
+    failed = [n for n, (ok, _) in enumerate(results) if not ok]
+    conn.execute('BEGIN IMMEDIATE')
+    # status='pending' sharti: shu orada reconcile_pending_purchases yakunlagan qatorlarga tegilmaydi
+    for n, (ok, _) in enumerate(results):
+        if ok and conn.execute("UPDATE purchases SET status='completed' WHERE id=? AND status='pending'",
+                               (purchase_ids[n],)).rowcount:
+            record_entitlement(conn, uid, purchase_ids[n], items[n]['nick'], items[n]['pkg'])
+    refunded = [n for n in failed if conn.execute("DELETE FROM purchases WHERE id=? AND status='pending'",
+                                                  (purchase_ids[n],)).rowcount]
+    refund = sum(items[n]['pkg']['price'] for n in failed)
+    if refunded:
+        post_ledger(conn, uid, sum(items[n]['pkg']['price'] for n in refunded), 'refund', 'revenue', 'purchase',
+                    purchase_ids[refunded[0]], memo=f"Savat: {len(refunded)} ta mahsulot berilmadi")
+        conn.executemany('INSERT INTO cart_items (user_id, package_id, tokens, nick, server_mode) VALUES (?, ?, ?, ?, ?)',
+                         [(uid, items[n]['pkg']['id'], int(items[n]['pkg']['name'].split()[0]) if items[n]['pkg']['id'] is None else 0,
+                           items[n]['nick'], items[n]['server_mode']) for n in refunded])
+    new_bal = conn.execute('SELECT balance FROM users WHERE id=?', (uid,)).fetchone()['balance']
+    conn.commit()
     conn.close()
-    return jsonify(success=False, message=f"Server xatosi: {resp}")
+
+    report = [{'name': i['pkg']['name'], 'nick': i['nick'], 'ok': ok, 'response': resp}
+              for i, (ok, resp) in zip(items, results)]
+    if not failed:
+        return jsonify(success=True, message=f"{len(items)} ta mahsulot berildi!", new_balance=new_bal, items=report)
+    return jsonify(success=False, new_balance=new_bal, items=report,
+                   message=f"{len(items) - len(failed)}/{len(items)} berildi. Qolganlari uchun {refund:,.0f} so'm qaytarildi va savatda qoldi: {results[failed[0]][1]}")
+
+
+@app.route('/cart')
+@login_required
+def cart_page():
+    conn = get_db()
+    items = cart_rows(conn, session['user_id'])
+    balance = conn.execute('SELECT balance FROM users WHERE id=?', (session['user_id'],)).fetchone()['balance']
+    conn.close()
+    total = sum(i['pkg']['price'] for i in items if i['pkg'])
+
+    rows = ''
+    for i in items:
+        name = sanitize(i['pkg']['name']) if i['pkg'] else '<span style="color:var(--danger);">Sotuvda yo\'q</span>'
+        price = f"{i['pkg']['price']:,.0f} so'm" if i['pkg'] else '—'
+        rows += f'<tr><td><strong>{name}</strong></td><td>{i["nick"]}</td><td>{price}</td><td><button onclick="removeCartItem({i["id"]})" class="btn btn-danger btn-sm"><i class="fas fa-trash"></i></button></td></tr>'
+    if not rows:
+        rows = '<tr><td colspan="4" style="text-align:center;color:var(--text-dim);padding:1.5rem;">Savat bo\'sh — <a href="/shop">Do\'konga o\'tish</a></td></tr>'
+
+    content = f'''
+    <div class="container" style="max-width:900px;margin:0 auto;padding-top:2rem;">
+        <div class="section-title"><h2>🧺 Savat</h2></div>
+        <div class="card">
+            <div class="table-wrap"><table>
+                <thead><tr><th>Mahsulot</th><th>Nik</th><th>Narx</th><th></th></tr></thead>
+                <tbody>{rows}</tbody>
+            </table></div>
+            <div style="display:flex;justify-content:space-between;align-items:center;gap:1rem;flex-wrap:wrap;margin-top:1.2rem;">
+                <div>
+                    <div style="color:var(--text-dim);font-size:.85rem;">Balans: {balance:,.0f} so'm</div>
+                    <div style="font-size:1.3rem;">Jami: <strong style="color:var(--primary);">{total:,.0f} so'm</strong></div>
+                </div>
+                {'<button onclick="checkoutCart(this)" class="btn btn-primary"><i class="fas fa-credit-card"></i> Sotib Olish</button>' if items else ''}
+            </div>
+        </div>
+    </div>'''
+    return render_page(content, logged_in=True, is_admin=session.get('is_admin', False))
+
+
+# ═══════════════════════════════════════════════
+# RANK MUDDATI — entitlements navbati va fon rejalashtiruvchisi
+# ═══════════════════════════════════════════════
+
+RANK_CATEGORIES = ('anarchy', 'smp')
+EXPIRY_INTERVAL = float(os.environ.get('EXPIRY_INTERVAL', 60))  # 0 — fon thread o'chiq (cron + flask expire-ranks)
+EXPIRY_BATCH = 500
+EXPIRY_RETRY_BASE = 60
+EXPIRY_RETRY_MAX = 3600
+EXPIRY_LOCK_PATH = 'elitemc.expiry.lock'
+
+
+def package_duration_days(pkg):
+    """'30' / '90' — kunlar soni; 'UMRBOT' va boshqa qiymatlar — None (muddatsiz)."""
+    duration = str(pkg['duration'] or '').strip()
+    return int(duration) if duration.isdigit() else None
+
+
+def record_entitlement(conn, user_id, purchase_id, minecraft_nick, pkg, granted_at=None):
+    """
+    Berilgan rank'ni navbatga yozadi (chaqiruvchi tranzaksiyasi ichida). 'lp parent set' avvalgi
+    guruhni almashtiradi, shuning uchun nik+serverda bitta faol yozuv qoladi: boshqa rank'lar
+    'superseded' bo'ladi, xuddi shu rank qayta olinsa muddati uzaytiriladi.
+    """
+    if pkg['category'] not in RANK_CATEGORIES:
+        return None
+    server = package_server(pkg)
+    days = package_duration_days(pkg)
+    granted_at = granted_at or conn.execute('SELECT CURRENT_TIMESTAMP').fetchone()[0]
+    current = conn.execute("SELECT id, package_name, expires_at FROM entitlements WHERE minecraft_nick=? AND server=? AND status='active'",
+                           (minecraft_nick, server)).fetchall()
+    same = next((r for r in current if r['package_name'] == pkg['name']), None)
+    conn.executemany("UPDATE entitlements SET status='superseded', ended_at=? WHERE id=?",
+                     [(granted_at, r['id']) for r in current if r is not same])
+
+    if same:
+        if days is None or same['expires_at'] is None:
+            expires_at = None
+        else:
+            expires_at = conn.execute('SELECT datetime(MAX(?, ?), ?)',
+                                      (same['expires_at'], granted_at, f'+{days} days')).fetchone()[0]
+        conn.execute('UPDATE entitlements SET expires_at=?, purchase_id=?, attempts=0, retry_at=NULL, last_error=NULL WHERE id=?',
+                     (expires_at, purchase_id, same['id']))
+        return same['id']
+
+    expires_at = None if days is None else conn.execute('SELECT datetime(?, ?)', (granted_at, f'+{days} days')).fetchone()[0]
+    return conn.execute('''INSERT INTO entitlements (user_id, purchase_id, minecraft_nick, server, package_name, granted_at, expires_at)
+                           VALUES (?, ?, ?, ?, ?, ?, ?)''',
+                        (user_id, purchase_id, minecraft_nick, server, pkg['name'], granted_at, expires_at)).lastrowid
+
+
+def process_expirations(limit=EXPIRY_BATCH):
+    """
+    Muddati o'tgan yozuvlarning bitta partiyasi: idx_entitlements_due bo'yicha eng eskilari olinadi,
+    har bir server uchun bitta RCON ulanishda 'parent remove' yuboriladi. Xato bo'lganlari
+    eksponensial kutish bilan qayta uriniladi. Natija: (olib tashlandi, xato) soni.
+    """
+    conn = get_db()
+    rows = conn.execute('''SELECT id, minecraft_nick, server, package_name, attempts FROM entitlements
+                           WHERE status = 'active' AND expires_at <= CURRENT_TIMESTAMP
+                             AND (retry_at IS NULL OR retry_at <= CURRENT_TIMESTAMP)
+                           ORDER BY expires_at LIMIT ?''', (limit,)).fetchall()
+    if not rows:
+        conn.close()
+        return 0, 0
+
+    try:
+        results = rcon_dispatch([(r['server'], f"lp user {r['minecraft_nick']} parent remove {r['package_name']}") for r in rows])
+    except Exception as e:
+        results = [(False, str(e))] * len(rows)
+
+    regrant, done, failed = [], 0, 0
+    conn.execute('BEGIN IMMEDIATE')
+    for r, (ok, resp) in zip(rows, results):
+        if not ok:
+            delay = min(EXPIRY_RETRY_MAX, EXPIRY_RETRY_BASE * 2 ** r['attempts'])
+            conn.execute('''UPDATE entitlements SET attempts = attempts + 1, last_error = ?,
+                            retry_at = datetime('now', ?) WHERE id = ?''', (str(resp)[:200], f'+{delay} seconds', r['id']))
+            failed += 1
+            continue
+        updated = conn.execute('''UPDATE entitlements SET status = 'expired', ended_at = CURRENT_TIMESTAMP, last_error = NULL
+                                  WHERE id = ? AND status = 'active' AND expires_at <= CURRENT_TIMESTAMP''', (r['id'],)).rowcount
+        if updated:
+            done += 1
+        elif conn.execute("SELECT 1 FROM entitlements WHERE id=? AND status='active'", (r['id'],)).fetchone():
+            # RCON vaqtida muddat uzaytirilgan — olib tashlangan rank qaytariladi
+            regrant.append((r['server'], f"lp user {r['minecraft_nick']} parent add {r['package_name']}"))
+    conn.commit()
+    conn.close()
+
+    if regrant:
+        rcon_dispatch(regrant)
+    metric_inc('rank_expirations_total', done, result='expired')
+    metric_inc('rank_expirations_total', failed, result='failed')
+    return done, failed
+
+
+def run_expirations(limit=EXPIRY_BATCH):
+    """Navbat bo'shaguncha partiyalab ishlaydi; faqat qayta urinishdagilar qolsa to'xtaydi."""
+    total_done = total_failed = 0
+    while True:
+        done, failed = process_expirations(limit)
+        total_done += done
+        total_failed += failed
+        if done + failed < limit or not done:
+            return total_done, total_failed
+
+
+_leader_pids = {}
+_leader_lock = threading.Lock()
+
+
+def _leader_loop(lock_path, interval, job, label):
+    # Bir nechta worker bo'lsa ishni faqat fayl qulfini olgani bajaradi; u o'lsa boshqasi egallaydi
+    lock = open(lock_path, 'w')
+    while fcntl:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            break
+        except OSError:
+            time.sleep(interval)
+    while True:
+        try:
+            job()
+        except Exception as e:
+            app.logger.warning("%s: %s", label, e)
+        time.sleep(interval)
+
+
+def start_leader_thread(name, lock_path, interval, job, label):
+    """Har bir workerda bir marta fon thread; job() ni barcha workerlar orasida faqat bittasi bajaradi."""
+    with _leader_lock:
+        if _leader_pids.get(name) != os.getpid():
+            threading.Thread(target=_leader_loop, args=(lock_path, interval, job, label), name=name, daemon=True).start()
+            _leader_pids[name] = os.getpid()
+
+
+def _expire_ranks_job():
+    done, failed = run_expirations()
+    if done or failed:
+        app.logger.info("Rank muddati: %d ta olib tashlandi, %d ta xato", done, failed)
+
+
+def start_expiry_scheduler():
+    if EXPIRY_INTERVAL > 0:
+        start_leader_thread('rank-expiry', EXPIRY_LOCK_PATH, EXPIRY_INTERVAL, _expire_ranks_job, "Rank muddati navbati")
+
+
+@app.cli.command('expire-ranks')
+def expire_ranks_command():
+    """Muddati o'tgan rank'larni hozir olib tashlaydi (cron uchun)."""
+    done, failed = run_expirations()
+    print(f"  ✅ {done} ta rank olib tashlandi" + (f", ⚠️  {failed} ta keyinroq qayta uriniladi" if failed else ''))
+
+
+@app.cli.command('backfill-entitlements')
+def backfill_entitlements_command():
+    """Bir martalik: jadval paydo bo'lishidan oldingi rank xaridlarini navbatga yozadi."""
+    conn = get_db()
+    if conn.execute('SELECT 1 FROM entitlements LIMIT 1').fetchone():
+        conn.close()
+        print("  ⚠️  entitlements bo'sh emas — backfill allaqachon bajarilgan")
+        return
+    conn.execute('BEGIN IMMEDIATE')
+    rows = conn.execute(f'''SELECT pu.id, pu.user_id, pu.minecraft_nick, pu.created_at, p.category, p.name, p.duration
+                            FROM purchases pu JOIN packages p ON p.id = pu.package_id
+                            WHERE p.category IN ({','.join('?' * len(RANK_CATEGORIES))}) AND pu.status = 'completed'
+                            ORDER BY pu.created_at, pu.id''', RANK_CATEGORIES).fetchall()
+    for r in rows:
+        record_entitlement(conn, r['user_id'], r['id'], r['minecraft_nick'], r, granted_at=r['created_at'])
+    conn.commit()
+    active = conn.execute("SELECT COUNT(*) FROM entitlements WHERE status='active'").fetchone()[0]
+    conn.close()
+    print(f"  ✅ {len(rows)} ta xarid ko'rib chiqildi, {active} ta faol rank")
+
+
+@app.route('/admin/api/entitlements')
+@admin_required
+def api_entitlements():
+    conn = get_db()
+    by_status = {r['status']: r['c'] for r in conn.execute('SELECT status, COUNT(*) AS c FROM entitlements GROUP BY status')}
+    due = conn.execute('''SELECT COUNT(*) AS c, MIN(expires_at) AS oldest FROM entitlements
+                          WHERE status = 'active' AND expires_at <= CURRENT_TIMESTAMP''').fetchone()
+    upcoming = conn.execute('''SELECT minecraft_nick, server, package_name, expires_at FROM entitlements
+                               WHERE status = 'active' AND expires_at > CURRENT_TIMESTAMP
+                               ORDER BY expires_at LIMIT 20''').fetchall()
+    failing = conn.execute('''SELECT minecraft_nick, server, package_name, attempts, last_error, retry_at FROM entitlements
+                              WHERE status = 'active' AND attempts > 0 ORDER BY expires_at LIMIT 20''').fetchall()
+    conn.close()
+    return jsonify(by_status=by_status, due=due['c'], oldest_due=due['oldest'],
+                   upcoming=[dict(r) for r in upcoming], failing=[dict(r) for r in failing])
+
+
+# ═══════════════════════════════════════════════
+# YAKUNLANMAGAN XARIDLAR — worker 'pending' bosqichida o'lsa pul ilinib qolmasin
+# ═══════════════════════════════════════════════
+
+PENDING_PURCHASE_TIMEOUT = float(os.environ.get('PENDING_PURCHASE_TIMEOUT', 600))  # soniya; RCON timeoutlaridan ancha katta
+RECONCILE_INTERVAL = float(os.environ.get('RECONCILE_INTERVAL', 300))  # 0 — fon thread o'chiq (cron + flask reconcile-purchases)
+RECONCILE_LOCK_PATH = 'elitemc.reconcile.lock'
+
+
+def _pending_package(conn, row):
+    """Xarid qatoridan paket; narx — xarid paytida yechilgan summa (katalog narxi o'zgargan bo'lishi mumkin)."""
+    if row['package_id'] is None:
+        pkg = token_package(int(row['package_name'].split()[0]))
+    else:
+        found = conn.execute('SELECT id, category, name, price, duration FROM packages WHERE id=?', (row['package_id'],)).fetchone()
+        pkg = dict(found) if found else {'id': row['package_id'], 'category': row['category'] or 'unknown',
+                                         'name': row['package_name'], 'duration': None}
+    return dict(pkg, name=row['package_name'], price=row['amount'])
+
+
+def reconcile_pending_purchases(older_than=PENDING_PURCHASE_TIMEOUT, limit=EXPIRY_BATCH):
+    """
+    PENDING_PURCHASE_TIMEOUT dan eski 'pending' xaridlar (pul yechilgan, natija yozilmagan). Rank'lar
+    ('lp parent set' — takrorlash xavfsiz) qayta yuboriladi, agar shu nik+serverda undan yangi faol rank
+    bo'lmasa; tokenlar va xizmatlar (takrorlansa ikki marta beriladi) va muvaffaqiyatsizlar — pul qaytariladi.
+    Natija: (yakunlandi, qaytarildi).
+    """
+    conn = get_db()
+    completed = refunded = 0
+    try:
+        rows = conn.execute('''SELECT id, user_id, package_id, package_name, minecraft_nick, amount, category FROM purchases
+                               WHERE status = 'pending' AND created_at <= datetime('now', ?) ORDER BY created_at LIMIT ?''',
+                            (f'-{int(older_than)} seconds', limit)).fetchall()
+        for r in rows:
+            pkg = _pending_package(conn, r)
+            ok = False
+            if pkg['category'] in RANK_CATEGORIES and not conn.execute(
+                    "SELECT 1 FROM entitlements WHERE minecraft_nick=? AND server=? AND status='active' AND purchase_id > ?",
+                    (r['minecraft_nick'], package_server(pkg), r['id'])).fetchone():
+                try:
+                    ok, _ = execute_purchase(r['minecraft_nick'], pkg)
+                except Exception:
+                    ok = False
+            settle_purchase(conn, r['user_id'], r['id'], pkg, r['minecraft_nick'], ok, memo='Yakunlanmagan xarid')
+            completed, refunded = completed + ok, refunded + (not ok)
+            app.logger.warning("Yakunlanmagan xarid #%d (%s, %s): %s", r['id'], r['minecraft_nick'], r['package_name'],
+                               'qayta berildi' if ok else "pul qaytarildi")
+    finally:
+        conn.close()
+    metric_inc('purchases_reconciled_total', completed, result='completed')
+    metric_inc('purchases_reconciled_total', refunded, result='refunded')
+    return completed, refunded
+
+
+def _reconcile_job():
+    reconcile_pending_purchases()
+
+
+def start_reconcile_scheduler():
+    # leader thread ishni darhol bajaradi — qayta ishga tushishda qolib ketganlar birinchi navbatda yopiladi
+    if RECONCILE_INTERVAL > 0:
+        start_leader_thread('reconcile', RECONCILE_LOCK_PATH, RECONCILE_INTERVAL, _reconcile_job, "Xaridlarni moslash")
+
+
+@app.cli.command('reconcile-purchases')
+@click.option('--older-than', default=PENDING_PURCHASE_TIMEOUT, show_default=True, help="soniya; shundan eski 'pending' xaridlar")
+def reconcile_purchases_command(older_than):
+    """Yakunlanmay qolgan 'pending' xaridlarni qayta beradi yoki pulini qaytaradi."""
+    completed, refunded = reconcile_pending_purchases(older_than)
+    print(f"  ✅ {completed} ta qayta berildi, {refunded} ta pul qaytarildi")
 
 
 # ═══════════════════════════════════════════════
@@ -1234,24 +3308,154 @@ def rules():
 # BALANCE
 # ═══════════════════════════════════════════════
 
-@app.route('/balance')
+LEDGER_PAGE_SIZE = 50
+LEDGER_EPSILON = 0.005
+
+
+def post_ledger(conn, user_id, amount, kind, counter_account, ref_type=None, ref_id=None, memo=None, created_by=None):
+    """
+    users.balance ni o'zgartirishning yagona yo'li (chaqiruvchi tranzaksiyasi ichida): snapshot yangilanadi
+    va ikki yozuv qo'shiladi — foydalanuvchiga amount, counter_account ('cash', 'revenue', 'adjustments')
+    ga -amount. Yangi balansni qaytaradi.
+    """
+    amount = round(float(amount), 2)
+    conn.execute('UPDATE users SET balance = balance + ? WHERE id = ?', (amount, user_id))
+    balance = conn.execute('SELECT balance FROM users WHERE id = ?', (user_id,)).fetchone()['balance']
+    txn_id = conn.execute('INSERT INTO ledger_txns (kind, ref_type, ref_id, memo, created_by) VALUES (?, ?, ?, ?, ?)',
+                          (kind, ref_type, ref_id, memo, created_by)).lastrowid
+    conn.executemany('INSERT INTO ledger_entries (txn_id, account, user_id, amount, balance_after) VALUES (?, ?, ?, ?, ?)',
+                     [(txn_id, 'user', user_id, amount, balance), (txn_id, counter_account, None, -amount, None)])
+    return balance
+
+
+def ledger_statement(conn, user_id, before=None):
+    """Keyset sahifa: (yozuvlar, keyingi_kursor). Kursor — ledger_entries.id, indeks (user_id, id)."""
+    rows = conn.execute('''SELECT e.id, e.amount, e.balance_after, t.kind, t.ref_type, t.ref_id, t.memo, t.created_at
+                           FROM ledger_entries e JOIN ledger_txns t ON t.id = e.txn_id
+                           WHERE e.user_id = ? AND e.id < ? ORDER BY e.id DESC LIMIT ?''',
+                        (user_id, before or 2 ** 62, LEDGER_PAGE_SIZE + 1)).fetchall()
+    page = rows[:LEDGER_PAGE_SIZE]
+    return [dict(r) for r in page], (page[-1]['id'] if len(rows) > LEDGER_PAGE_SIZE else None)
+
+
+def verify_ledger(conn, limit=100):
+    """
+    Bitta oqimli o'tish: ledger_entries (user_id, id) tartibida o'qiladi, har bir foydalanuvchi balansi
+    qayta hisoblanib balance_after va users.balance (id tartibida parallel kursor) bilan solishtiriladi.
+    So'ng yig'indisi 0 bo'lmagan tranzaksiyalar qidiriladi.
+    """
+    users = conn.execute('SELECT id, balance FROM users ORDER BY id')
+    entries = conn.execute('SELECT id, user_id, amount, balance_after FROM ledger_entries WHERE user_id IS NOT NULL ORDER BY user_id, id')
+    problems = []
+    stats = {'entries': 0, 'users': 0}
+
+    def report(**problem):
+        if len(problems) < limit:
+            problems.append(problem)
+
+    user = users.fetchone()
+
+    def settle(user_id, computed):
+        # Ledgerda yozuvi yo'q foydalanuvchilarning balansi 0 bo'lishi kerak
+        nonlocal user
+        while user is not None and (user_id is None or user['id'] < user_id):
+            if abs(user['balance'] or 0) > LEDGER_EPSILON:
+                report(kind='snapshot', user_id=user['id'], balance=user['balance'], ledger=0)
+            user = users.fetchone()
+        if user_id is None:
+            return
+        stats['users'] += 1
+        if user is None or user['id'] != user_id:
+            report(kind='orphan', user_id=user_id, ledger=round(computed, 2))
+            return
+        if abs((user['balance'] or 0) - computed) > LEDGER_EPSILON:
+            report(kind='snapshot', user_id=user_id, balance=user['balance'], ledger=round(computed, 2))
+        user = users.fetchone()
+
+    current, running = None, 0.0
+    for e in entries:
+        stats['entries'] += 1
+        if e['user_id'] != current:
+            if current is not None:
+                settle(current, running)
+            current, running = e['user_id'], 0.0
+        running += e['amount']
+        if e['balance_after'] is not None and abs(e['balance_after'] - running) > LEDGER_EPSILON:
+            report(kind='balance_after', user_id=current, entry_id=e['id'], balance_after=e['balance_after'], ledger=round(running, 2))
+    if current is not None:
+        settle(current, running)
+    settle(None, 0.0)
+
+    unbalanced = conn.execute('''SELECT txn_id, SUM(amount) AS total FROM ledger_entries GROUP BY txn_id
+                                 HAVING ABS(SUM(amount)) > ?''', (LEDGER_EPSILON,)).fetchall()
+    for t in unbalanced:
+        report(kind='unbalanced', txn_id=t['txn_id'], total=round(t['total'], 2))
+    return dict(stats, ok=not problems, unbalanced=len(unbalanced), problems=problems)
+
+
+@app.cli.command('verify-ledger')
+def verify_ledger_command():
+    """Barcha balanslarni ledger dan qayta hisoblab users.balance bilan solishtiradi (nomuvofiqlikda chiqish kodi 1)."""
+    started = time.perf_counter()
+    conn = get_db()
+    result = verify_ledger(conn)
+    conn.close()
+    for p in result['problems']:
+        print(f"  ⚠️  {p}")
+    status = '✅ Ledger mos' if result['ok'] else '❌ Nomuvofiqlik topildi'
+    print(f"  {status}: {result['entries']} yozuv, {result['users']} foydalanuvchi, {time.perf_counter() - started:.2f} s")
+    if not result['ok']:
+        raise SystemExit(1)
+
+
+@app.route('/api/statement')
 @login_required
-def balance():
+def api_statement():
     conn = get_db()
-    user = conn.execute('SELECT * FROM users WHERE id=?', (session['user_id'],)).fetchone()
-    deposits = conn.execute('SELECT * FROM balance_deposits WHERE user_id=? ORDER BY created_at DESC',
-                            (session['user_id'],)).fetchall()
-    settings = {r['key']: r['value'] for r in conn.execute('SELECT key,value FROM settings').fetchall()}
+    page, cursor = ledger_statement(conn, session['user_id'], request.args.get('before', type=int))
     conn.close()
-    rows_html = ''
-    for d in deposits:
-        sc = 'pending' if d['status'] == 'pending' else ('approved' if d['status'] == 'approved' else 'rejected')
-        st = '⏳ Kutilmoqda' if d['status'] == 'pending' else (
-            '✅ Tasdiqlandi' if d['status'] == 'approved' else '❌ Rad etildi')
-        rows_html += f'<tr><td>#{d["id"]}</td><td><strong>{d["amount"]:,.0f} so\'m</strong></td><td><span class="badge badge-{sc}">{st}</span></td><td>{str(d["created_at"])[:16]}</td><td>{d["admin_comment"] or "—"}</td></tr>'
-    content = f'''
-    <div class="container" style="max-width:780px;margin:0 auto;padding-top:2rem;">
-        <div class="section-title"><h2>💰 Balans</h2></div>
+    return jsonify(entries=page, next=cursor)
+
+
+@app.route('/admin/api/users/<int:uid>/statement')
+@admin_required
+def api_admin_statement(uid):
+    conn = get_db()
+    page, cursor = ledger_statement(conn, uid, request.args.get('before', type=int))
+    conn.close()
+    return jsonify(entries=page, next=cursor)
+
+
+def _deposit_row_html(d):
+    sc = 'pending' if d['status'] == 'pending' else ('approved' if d['status'] == 'approved' else 'rejected')
+    st = '⏳ Kutilmoqda' if d['status'] == 'pending' else (
+        '✅ Tasdiqlandi' if d['status'] == 'approved' else '❌ Rad etildi')
+    return f'<tr><td>#{d["id"]}</td><td><strong>{d["amount"]:,.0f} so\'m</strong></td><td><span class="badge badge-{sc}">{st}</span></td><td>{str(d["created_at"])[:16]}</td><td>{d["admin_comment"] or "—"}</td></tr>'
+
+
+@app.route('/api/deposits/archive')
+@login_required
+def api_archived_deposits():
+    page, cursor = archive_page('balance_deposits', session['user_id'], request.args.get('before', ''))
+    return jsonify(html=''.join(_deposit_row_html(d) for d in page), next=cursor)
+
+
+@app.route('/balance')
+@login_required
+def balance(error=None):
+    conn = get_db()
+    user = conn.execute('SELECT * FROM users WHERE id=?', (session['user_id'],)).fetchone()
+    deposits = conn.execute('SELECT * FROM balance_deposits WHERE user_id=? ORDER BY created_at DESC',
+                            (session['user_id'],)).fetchall()
+    settings = {r['key']: r['value'] for r in conn.execute('SELECT key,value FROM settings').fetchall()}
+    conn.close()
+    rows_html = ''.join(_deposit_row_html(d) for d in deposits)
+    archive_btn = f'<div style="text-align:center;margin-top:1rem;">{ARCHIVE_BUTTON.format(target="depositRows", url="/api/deposits/archive")}</div>' if os.path.exists(ARCHIVE_DB_PATH) else ''
+    error_html = f'<div class="alert alert-warning"><i class="fas fa-times-circle"></i><div>{sanitize(error)}</div></div>' if error else ''
+    content = f'''
+    <div class="container" style="max-width:780px;margin:0 auto;padding-top:2rem;">
+        <div class="section-title"><h2>💰 Balans</h2></div>
+        {error_html}
         <div class="balance-hero"><h3>Joriy Balans</h3><div class="balance-amount">{user['balance']:,.0f} <span>so'm</span></div></div>
         <div class="card">
             <div class="card-header"><i class="fas fa-credit-card"></i><h2>Balansga Pul Qo'shish</h2></div>
@@ -1269,11 +3473,12 @@ def balance():
             <div class="card-header"><i class="fas fa-history"></i><h2>To'lov Tarixi</h2></div>
             <div class="table-wrap"><table>
                 <thead><tr><th>#</th><th>Summa</th><th>Status</th><th>Sana</th><th>Izoh</th></tr></thead>
-                <tbody>{rows_html or '<tr><td colspan="5" style="text-align:center;color:var(--text-dim);padding:1.5rem;">Tolovlar yoq</td></tr>'}</tbody>
+                <tbody id="depositRows">{rows_html or '<tr><td colspan="5" style="text-align:center;color:var(--text-dim);padding:1.5rem;">Tolovlar yoq</td></tr>'}</tbody>
             </table></div>
+            {archive_btn}
         </div>
     </div>'''
-    return render_page(content, logged_in=True, is_admin=session.get('is_admin', False))
+    return render_page(content, logged_in=True, is_admin=session.get('is_admin', False)), 400 if error else 200
 
 
 @app.route('/deposit_balance', methods=['POST'])
@@ -1286,9 +3491,10 @@ def deposit_balance():
     if 'screenshot' in request.files:
         f = request.files['screenshot']
         if f and allowed_file(f.filename):
-            fname = secure_filename(f"{session['user_id']}_{datetime.datetime.now().timestamp()}_{f.filename}")
-            f.save(os.path.join(app.config['UPLOAD_FOLDER'], fname))
-            screenshot = f'/static/uploads/{fname}'
+            name = os.path.splitext(f.filename)[0]
+            screenshot, error = save_upload(f, f"{session['user_id']}_{datetime.datetime.now().timestamp()}_{name}")
+            if error:
+                return balance(error=error)
     conn = get_db()
     conn.execute(
         'INSERT INTO balance_deposits (user_id,amount,card_number,transaction_id,screenshot) VALUES (?,?,?,?,?)',
@@ -1302,22 +3508,62 @@ def deposit_balance():
 # PROFILE
 # ═══════════════════════════════════════════════
 
+PURCHASES_PAGE_SIZE = 20
+
+
+def keyset_page(conn, table, user_id, before: str = '', size: int = PURCHASES_PAGE_SIZE):
+    """Keyset sahifa: (qatorlar, keyingi_kursor). Kursor — 'created_at|id', indeks (user_id, created_at, id)."""
+    if before and '|' in before:
+        created_at, _, rid = before.rpartition('|')
+        rows = conn.execute(f'''SELECT * FROM {table} WHERE user_id=? AND (created_at, id) < (?, ?)
+                                ORDER BY created_at DESC, id DESC LIMIT ?''',
+                            (user_id, created_at, int(rid) if rid.isdigit() else 0, size + 1)).fetchall()
+    else:
+        rows = conn.execute(f'SELECT * FROM {table} WHERE user_id=? ORDER BY created_at DESC, id DESC LIMIT ?',
+                            (user_id, size + 1)).fetchall()
+    page = rows[:size]
+    return page, (f"{page[-1]['created_at']}|{page[-1]['id']}" if len(rows) > size else None)
+
+
+def purchase_history(conn, user_id, before: str = ''):
+    """Issiq bazadagi xaridlar tugagach kursor ARCHIVE_CURSOR bilan boshlanadi — keyingi sahifalar arxivdan."""
+    if before.startswith(ARCHIVE_CURSOR):
+        return archive_page('purchases', user_id, before[len(ARCHIVE_CURSOR):])
+    page, cursor = keyset_page(conn, 'purchases', user_id, before)
+    if cursor is None and os.path.exists(ARCHIVE_DB_PATH):
+        cursor = ARCHIVE_CURSOR + (f"{page[-1]['created_at']}|{page[-1]['id']}" if page else before)
+    return page, cursor
+
+
+def _purchase_row_html(p):
+    return f'<tr><td>#{p["id"]}</td><td><strong>{sanitize(p["package_name"])}</strong></td><td>{p["amount"]:,.0f}</td><td>{str(p["created_at"])[:16]}</td><td><span class="badge badge-success">✅ {sanitize(p["status"])}</span></td></tr>'
+
+
+@app.route('/api/purchases')
+@login_required
+def api_purchases():
+    conn = get_db()
+    page, cursor = purchase_history(conn, session['user_id'], request.args.get('before', ''))
+    conn.close()
+    return jsonify(html=''.join(_purchase_row_html(p) for p in page), next=cursor)
+
+
 @app.route('/profile')
 @login_required
 def profile():
     conn = get_db()
     user = conn.execute('SELECT * FROM users WHERE id=?', (session['user_id'],)).fetchone()
-    purchases = conn.execute('SELECT * FROM purchases WHERE user_id=? ORDER BY created_at DESC',
-                             (session['user_id'],)).fetchall()
-
-    res_spent = conn.execute('SELECT SUM(amount) as s FROM purchases WHERE user_id=?', (session['user_id'],)).fetchone()
+    stats = conn.execute('SELECT * FROM user_stats WHERE user_id=?', (session['user_id'],)).fetchone()
+    purchases, next_cursor = purchase_history(conn, session['user_id'])
     join_date = str(user['created_at'])[:10]
     user_tokens = user['tokens'] if user['tokens'] else 0
     conn.close()
 
-    pur_html = ''
-    for p in purchases:
-        pur_html += f'<tr><td>#{p["id"]}</td><td><strong>{sanitize(p["package_name"])}</strong></td><td>{p["amount"]:,.0f}</td><td>{str(p["created_at"])[:16]}</td><td><span class="badge badge-success">✅ {sanitize(p["status"])}</span></td></tr>'
+    total_spent = stats['total_spent'] if stats else 0
+    purchase_count = stats['purchase_count'] if stats else 0
+    last_purchase = str(stats['last_purchase_at'])[:16] if stats and stats['last_purchase_at'] else '—'
+    pur_html = ''.join(_purchase_row_html(p) for p in purchases)
+    more_btn = f'<div style="text-align:center;margin-top:1rem;"><button class="btn btn-secondary" data-before="{sanitize(next_cursor)}" onclick="loadMorePurchases(this)"><i class="fas fa-chevron-down"></i> Ko\'proq</button></div>' if next_cursor else ''
 
     content = f'''
     <style>
@@ -1340,14 +3586,32 @@ def profile():
                     <div style="padding:0.8rem;background:rgba(255,255,255,0.03);border-radius:8px;display:flex;justify-content:space-between;">
                         <span>Balans</span><strong>{user['balance']:,.0f}</strong>
                     </div>
+                    <div class="stat-grid-box">
+                        <div class="game-stat"><i class="fas fa-coins"></i><div><h4>Jami sarflangan</h4><div class="val">{total_spent:,.0f}</div></div></div>
+                        <div class="game-stat"><i class="fas fa-shopping-cart"></i><div><h4>Xaridlar</h4><div class="val">{purchase_count}</div></div></div>
+                        <div class="game-stat"><i class="fas fa-clock"></i><div><h4>Oxirgi xarid</h4><div class="val" style="font-size:.85rem;">{last_purchase}</div></div></div>
+                        <div class="game-stat"><i class="fas fa-calendar"></i><div><h4>Ro'yxatdan o'tgan</h4><div class="val" style="font-size:.85rem;">{join_date}</div></div></div>
+                    </div>
                 </div>
             </div>
             </div>
         <div class="card" style="margin-top:2rem;">
             <div class="card-header"><h2>Xaridlar</h2></div>
-            <div class="table-wrap"><table><thead><tr><th>#</th><th>Nomi</th><th>Narx</th><th>Sana</th><th>Status</th></tr></thead><tbody>{pur_html or '<tr><td colspan="5">Bosh</td></tr>'}</tbody></table></div>
+            <div class="table-wrap"><table><thead><tr><th>#</th><th>Nomi</th><th>Narx</th><th>Sana</th><th>Status</th></tr></thead><tbody id="purchaseRows">{pur_html or '<tr><td colspan="5">Bosh</td></tr>'}</tbody></table></div>
+            {more_btn}
         </div>
-    </div>'''
+    </div>
+    <script>
+    async function loadMorePurchases(btn){{
+        btn.disabled = true;
+        try{{
+            const r = await fetch('/api/purchases?before=' + encodeURIComponent(btn.dataset.before));
+            const j = await r.json();
+            document.getElementById('purchaseRows').insertAdjacentHTML('beforeend', j.html);
+            if(j.next){{ btn.dataset.before = j.next; btn.disabled = false; }} else btn.parentElement.remove();
+        }}catch(e){{ showToast('Xatolik!','error'); btn.disabled = false; }}
+    }}
+    </script>'''
     return render_page(content, logged_in=True, is_admin=session.get('is_admin', False))
 
 
@@ -1355,6 +3619,114 @@ def profile():
 # SUPPORT
 # ═══════════════════════════════════════════════
 
+SUPPORT_SEARCH_LIMIT = 20
+SUPPORT_SEARCH_WINDOW = 2000
+# Matnlar bazada html.escape qilingan holda saqlanadi; indeksga asl ko'rinishi yoziladi
+_FTS_UNESCAPE = (('&lt;', '<'), ('&gt;', '>'), ('&quot;', '"'), ('&#x27;', "'"), ('ʻ', "'"), ('ʼ', "'"), ('&amp;', '&'))
+
+
+def _fts_text_sql(column):
+    expr = column
+    for a, b in _FTS_UNESCAPE:
+        expr = f"replace({expr}, '{a}', '{b.replace(chr(39), chr(39) * 2)}')"
+    return expr
+
+
+def rebuild_support_index(conn):
+    """support_fts ni support_tickets va support_messages dan qaytadan to'ldiradi (chaqiruvchi tranzaksiyasida)."""
+    conn.execute('DELETE FROM support_fts')
+    conn.execute(f"INSERT INTO support_fts (rowid, body, kind, ticket_id) SELECT -id, {_fts_text_sql('subject')}, 'subject', id FROM support_tickets")
+    conn.execute(f"INSERT INTO support_fts (rowid, body, kind, ticket_id) SELECT id, {_fts_text_sql('message')}, 'message', ticket_id FROM support_messages")
+    conn.execute("INSERT INTO support_fts (support_fts) VALUES ('optimize')")
+    return conn.execute('SELECT COUNT(*) FROM support_fts').fetchone()[0]
+
+
+def _fts_match(q: str) -> str:
+    """Foydalanuvchi matni -> FTS5 so'rovi: har bir so'z qo'shtirnoqli prefiks, sintaksis xatosi bo'lmaydi."""
+    for a, b in _FTS_UNESCAPE[4:6]:
+        q = q.replace(a, b)
+    terms = [t for t in q.replace('"', ' ').split() if any(ch.isalnum() for ch in t)]
+    return ' '.join(f'"{t}"*' for t in terms[:8])
+
+
+def search_support(conn, q, status=None, limit=SUPPORT_SEARCH_LIMIT):
+    """bm25 bo'yicha tartiblangan natijalar, har bir murojaat uchun eng yaxshi topilma va belgilangan parcha."""
+    match = _fts_match(q)
+    if not match:
+        return []
+    status_sql = 'AND t.status = ?' if status else ''
+    params = [match, SUPPORT_SEARCH_WINDOW] + ([status] if status else [])
+    if FTS5_AVAILABLE:
+        # bm25 faqat eng yangi SUPPORT_SEARCH_WINDOW topilma ichida: FTS5 rowid DESC bo'yicha erta to'xtaydi,
+        # juda umumiy so'zlarda ham butun doclist tartiblanmaydi
+        rows = conn.execute(f'''SELECT h.kind, h.ticket_id, h.snippet, h.score, t.subject, t.status, t.created_at, u.username
+                                FROM (SELECT kind, ticket_id, snippet(support_fts, 0, char(2), char(3), '…', 16) AS snippet,
+                                             bm25(support_fts) AS score
+                                      FROM support_fts WHERE support_fts MATCH ? ORDER BY rowid DESC LIMIT ?) h
+                                JOIN support_tickets t ON t.id = h.ticket_id LEFT JOIN users u ON u.id = t.user_id
+                                WHERE 1 {status_sql} ORDER BY h.score LIMIT ?''', params + [limit * 5]).fetchall()
+    else:
+        like = '%' + sanitize(q.strip()) + '%'
+        rows = conn.execute(f'''SELECT 'message' AS kind, m.ticket_id, m.message AS snippet, 0 AS score,
+                                       t.subject, t.status, t.created_at, u.username
+                                FROM support_messages m JOIN support_tickets t ON t.id = m.ticket_id
+                                LEFT JOIN users u ON u.id = t.user_id
+                                WHERE m.message LIKE ? {status_sql} ORDER BY m.id DESC LIMIT ?''',
+                            [like] + ([status] if status else []) + [limit * 5]).fetchall()
+
+    seen, out = set(), []
+    for r in rows:
+        if r['ticket_id'] in seen:
+            continue
+        seen.add(r['ticket_id'])
+        snippet = r['snippet'] if FTS5_AVAILABLE else html_module.unescape(r['snippet'])[:200]
+        out.append({'ticket_id': r['ticket_id'], 'subject': html_module.unescape(r['subject'] or ''), 'status': r['status'],
+                    'username': r['username'], 'created_at': r['created_at'], 'kind': r['kind'], 'score': r['score'],
+                    'snippet_html': sanitize(snippet).replace('\x02', '<mark>').replace('\x03', '</mark>')})
+        if len(out) >= limit:
+            break
+    return out
+
+
+@app.route('/admin/api/support/search')
+@admin_required
+def api_support_search():
+    started = time.perf_counter()
+    conn = get_db()
+    results = search_support(conn, request.args.get('q', ''), request.args.get('status') or None,
+                             min(request.args.get('limit', SUPPORT_SEARCH_LIMIT, type=int), 100))
+    conn.close()
+    return jsonify(results=results, took_ms=round((time.perf_counter() - started) * 1000, 2), fts=FTS5_AVAILABLE)
+
+
+@app.cli.command('rebuild-support-index')
+def rebuild_support_index_command():
+    """Support qidiruv indeksini mavjud murojaat va xabarlardan qayta quradi."""
+    if not FTS5_AVAILABLE:
+        print("  ⚠️  SQLite FTS5 siz yig'ilgan — qidiruv LIKE bilan ishlaydi")
+        return
+    started = time.perf_counter()
+    conn = get_db()
+    conn.execute('BEGIN IMMEDIATE')
+    total = rebuild_support_index(conn)
+    conn.commit()
+    conn.close()
+    print(f"  ✅ {total} ta yozuv indekslandi ({time.perf_counter() - started:.1f} s)")
+
+def _ticket_row_html(t):
+    bc = 'badge-open' if t['status'] == 'open' else (
+        'badge-answered' if t['status'] == 'answered' else 'badge-closed')
+    lb = 'Ochiq' if t['status'] == 'open' else ('Javob berildi' if t['status'] == 'answered' else 'Yopilgan')
+    return f'<a href="/support/{t["id"]}" class="ticket-row" style="text-decoration:none;"><div class="ticket-row-left"><span class="ticket-id">#{t["id"]}</span><div><div class="ticket-subject">{sanitize(t["subject"])}</div><div class="ticket-meta"><i class="fas fa-clock"></i> {str(t["created_at"])[:16]}</div></div></div><div class="ticket-row-right"><span class="badge {bc}">{lb}</span><span class="btn btn-outline btn-sm"><i class="fas fa-eye"></i> Ko\'rish</span></div></a>'
+
+
+@app.route('/api/support/archive')
+@login_required
+def api_archived_tickets():
+    page, cursor = archive_page('support_tickets', session['user_id'], request.args.get('before', ''))
+    return jsonify(html=''.join(_ticket_row_html(t) for t in page), next=cursor)
+
+
 @app.route('/support')
 @login_required
 def support():
@@ -1362,12 +3734,8 @@ def support():
     tickets = conn.execute('SELECT * FROM support_tickets WHERE user_id=? ORDER BY created_at DESC',
                            (session['user_id'],)).fetchall()
     conn.close()
-    list_html = ''
-    for t in tickets:
-        bc = 'badge-open' if t['status'] == 'open' else (
-            'badge-answered' if t['status'] == 'answered' else 'badge-closed')
-        lb = 'Ochiq' if t['status'] == 'open' else ('Javob berildi' if t['status'] == 'answered' else 'Yopilgan')
-        list_html += f'<a href="/support/{t["id"]}" class="ticket-row" style="text-decoration:none;"><div class="ticket-row-left"><span class="ticket-id">#{t["id"]}</span><div><div class="ticket-subject">{sanitize(t["subject"])}</div><div class="ticket-meta"><i class="fas fa-clock"></i> {str(t["created_at"])[:16]}</div></div></div><div class="ticket-row-right"><span class="badge {bc}">{lb}</span><span class="btn btn-outline btn-sm"><i class="fas fa-eye"></i> Ko\'rish</span></div></a>'
+    list_html = ''.join(_ticket_row_html(t) for t in tickets)
+    archive_btn = f'<div style="text-align:center;margin-top:1rem;">{ARCHIVE_BUTTON.format(target="ticketList", url="/api/support/archive")}</div>' if os.path.exists(ARCHIVE_DB_PATH) else ''
     if not list_html:
         list_html = '<div style="text-align:center;color:var(--text-dim);padding:2.5rem 0;"><i class="fas fa-inbox" style="font-size:2.5rem;margin-bottom:.8rem;display:block;opacity:.4;"></i>Murojaatlar hali yo\'q</div>'
     content = f'''
@@ -1376,7 +3744,7 @@ def support():
             <div class="section-title" style="margin:0;text-align:left;"><h2>🛠️ Support</h2></div>
             <a href="/support/new" class="btn btn-primary btn-sm"><i class="fas fa-plus"></i> Yangi Murojaat</a>
         </div>
-        <div class="card"><div class="support-list">{list_html}</div></div>
+        <div class="card"><div class="support-list" id="ticketList">{list_html}</div>{archive_btn}</div>
     </div>'''
     return render_page(content, logged_in=True, is_admin=session.get('is_admin', False))
 
@@ -1388,8 +3756,7 @@ def new_ticket():
         subject = sanitize(request.form.get('subject', ''))
         message = sanitize(request.form.get('message', ''))
         conn = get_db()
-        conn.execute('INSERT INTO support_tickets (user_id,subject) VALUES (?,?)', (session['user_id'], subject))
-        ticket_id = conn.execute('SELECT last_insert_rowid() as id').fetchone()['id']
+        ticket_id = conn.execute('INSERT INTO support_tickets (user_id,subject) VALUES (?,?)', (session['user_id'], subject)).lastrowid
         conn.execute('INSERT INTO support_messages (ticket_id,user_id,message) VALUES (?,?,?)',
                      (ticket_id, session['user_id'], message))
         conn.commit()
@@ -1424,12 +3791,16 @@ def view_ticket(ticket_id):
         conn.execute('UPDATE support_tickets SET status=? WHERE id=?', ('answered' if is_admin else 'open', ticket_id))
         conn.commit()
     ticket = conn.execute('SELECT * FROM support_tickets WHERE id=?', (ticket_id,)).fetchone()
+    archived = ticket is None
+    if archived:
+        ticket, messages = archived_ticket(conn, ticket_id)
     if not ticket or (ticket['user_id'] != session['user_id'] and not session.get('is_admin')):
         conn.close()
         return redirect(url_for('support'))
-    messages = conn.execute(
-        'SELECT sm.*, u.username FROM support_messages sm JOIN users u ON sm.user_id=u.id WHERE ticket_id=? ORDER BY sm.created_at ASC',
-        (ticket_id,)).fetchall()
+    if not archived:
+        messages = conn.execute(
+            'SELECT sm.*, u.username FROM support_messages sm JOIN users u ON sm.user_id=u.id WHERE ticket_id=? ORDER BY sm.created_at ASC',
+            (ticket_id,)).fetchall()
     conn.close()
     msgs_html = ''
     for m in messages:
@@ -1442,6 +3813,10 @@ def view_ticket(ticket_id):
     bc = 'badge-open' if ticket['status'] == 'open' else (
         'badge-answered' if ticket['status'] == 'answered' else 'badge-closed')
     lb = 'Ochiq' if ticket['status'] == 'open' else ('Javob berildi' if ticket['status'] == 'answered' else 'Yopilgan')
+    chat_input = '''<div class="chat-input-area">
+                <input type="text" id="chatInput" placeholder="Xabar yozing..." autocomplete="off"/>
+                <button class="btn btn-primary btn-sm" id="sendBtn"><i class="fas fa-paper-plane"></i></button>
+            </div>''' if not archived else '<div class="chat-input-area" style="justify-content:center;color:var(--text-dim);"><i class="fas fa-box-archive"></i>&nbsp;Arxivlangan murojaat — faqat o\'qish uchun</div>'
     content = f'''
     <div class="container" style="max-width:780px;margin:0 auto;padding-top:2rem;">
         <div class="card" style="display:flex;flex-direction:column;">
@@ -1455,10 +3830,7 @@ def view_ticket(ticket_id):
             </div>
             <div class="messages-area" id="messagesArea">{msgs_html}</div>
 
-            <div class="chat-input-area">
-                <input type="text" id="chatInput" placeholder="Xabar yozing..." autocomplete="off"/>
-                <button class="btn btn-primary btn-sm" id="sendBtn"><i class="fas fa-paper-plane"></i></button>
-            </div>
+            {chat_input}
         </div>
     </div>
     <script>
@@ -1466,6 +3838,7 @@ def view_ticket(ticket_id):
         const TID={ticket_id}, UID={session['user_id']}, IS_ADMIN={'true' if session.get('is_admin') else 'false'}, UNAME='{sanitize(session.get("username", ""))}';
         const area=document.getElementById('messagesArea'), inp=document.getElementById('chatInput'), btn=document.getElementById('sendBtn');
         function scrollBot(){{area.scrollTop=area.scrollHeight;}} scrollBot();
+        if(!btn) return;
         let lastCount = area.querySelectorAll('.msg').length;
 
         function appendMsg(d, mine){{
@@ -1557,9 +3930,14 @@ def handle_join(data):
     join_room(f"ticket_{data.get('ticket_id')}")
 
 
+@socketio.on('connect')
+def handle_connect():
+    metric_gauge_add('socketio_connections', 1)
+
+
 @socketio.on('disconnect')
 def handle_disconnect():
-    pass
+    metric_gauge_add('socketio_connections', -1)
 
 
 @socketio.on('send_message')
@@ -1574,6 +3952,7 @@ def handle_typing(data):
 
 @app.route('/buy_token_custom', methods=['POST'])
 @login_required
+@rate_limited('purchase')
 def buy_token_custom():
     data = request.get_json(force=True)
     try:
@@ -1585,30 +3964,24 @@ def buy_token_custom():
         if not nick:
             return jsonify(success=False, message="Nik kiritilmadi!")
 
-        price = amount * 1.2
+        pkg = token_package(amount)
 
         conn = get_db()
-        user = conn.execute('SELECT balance FROM users WHERE id=?', (session['user_id'],)).fetchone()
-
-        if user['balance'] < price:
+        purchase_id = reserve_purchase(conn, session['user_id'], pkg, nick)
+        if purchase_id is None:
             conn.close()
-            return jsonify(success=False, message=f"Mablag' yetarli emas! {price:,.0f} so'm kerak.")
+            return jsonify(success=False, message=f"Mablag' yetarli emas! {pkg['price']:,.0f} so'm kerak.")
 
         cmd = f"playerpoints give {nick} {amount}"
 
-        if MCRCON_AVAILABLE:
-            conn_set = get_db()
-            settings = {r['key']: r['value'] for r in conn_set.execute('SELECT key, value FROM settings').fetchall()}
-            conn_set.close()
-            with MCRcon(settings.get('rcon_host'), settings.get('rcon_password'),
-                        port=int(settings.get('rcon_port'))) as mcr:
-                mcr.command(cmd)
-
-        new_bal = user['balance'] - price
-        conn.execute('UPDATE users SET balance=? WHERE id=?', (new_bal, session['user_id']))
-        conn.execute('INSERT INTO purchases (user_id, amount, package_name, minecraft_nick) VALUES (?, ?, ?, ?)',
-                     (session['user_id'], price, f"{amount} Token", nick))
-        conn.commit()
+        settings = {r['key']: r['value'] for r in conn.execute('SELECT key, value FROM settings').fetchall()}
+        try:
+            rcon_command(settings.get('rcon_host'), settings.get('rcon_port'), settings.get('rcon_password'), cmd)
+        except Exception:
+            settle_purchase(conn, session['user_id'], purchase_id, pkg, nick, False)
+            conn.close()
+            raise
+        new_bal = settle_purchase(conn, session['user_id'], purchase_id, pkg, nick, True)
         conn.close()
 
         return jsonify(success=True, message=f"{nick} ga {amount} Token berildi!", new_balance=new_bal)
@@ -1764,6 +4137,7 @@ def admin_ranks():
     };
 
     let allPackages = [];
+    let catalogVersion = null;
     let editMode = false;
 
     document.getElementById('rankColorPicker').addEventListener('input', (e) => {
@@ -1778,10 +4152,39 @@ def admin_ranks():
 
     async function loadRanks() {
         const res = await fetch('/api/packages');
+        catalogVersion = res.headers.get('X-Catalog-Version');
         allPackages = await res.json();
         renderRanks();
     }
 
+    // Barcha o'zgarishlar bitta so'rov/tranzaksiyada; javobdagi qatorlar bilan holat yangilanadi
+    async function applyOps(ops) {
+        const res = await fetch('/admin/api/packages/bulk', {
+            method: 'POST',
+            headers: {'Content-Type': 'application/json'},
+            body: JSON.stringify({version: catalogVersion === null ? null : parseInt(catalogVersion), ops: ops})
+        });
+        const result = await res.json();
+        if (res.status === 409) {
+            showToast(result.message, 'error');
+            await loadRanks();
+            return null;
+        }
+        if (!result.success) {
+            showToast('Xatolik: ' + (result.message || 'Noma\\'lum xatolik'), 'error');
+            return null;
+        }
+        catalogVersion = String(result.version);
+        const byId = new Map(result.changed.map(p => [p.id, p]));
+        allPackages = allPackages
+            .filter(p => !result.deleted.includes(p.id))
+            .map(p => byId.get(p.id) || p);
+        const known = new Set(allPackages.map(p => p.id));
+        result.changed.forEach(p => { if (!known.has(p.id)) allPackages.push(p); });
+        renderRanks();
+        return result;
+    }
+
     function renderRanks() {
         const search = document.getElementById('searchBox').value.toLowerCase();
         const catFilter = document.getElementById('categoryFilter').value;
@@ -1945,22 +4348,11 @@ def admin_ranks():
         };
 
         const id = document.getElementById('rankId').value;
-        const url = editMode ? `/admin/edit_rank/${id}` : '/admin/add_rank';
-
-        const res = await fetch(url, {
-            method: 'POST',
-            headers: {'Content-Type': 'application/json'},
-            body: JSON.stringify(data)
-        });
-
-        const result = await res.json();
+        const op = editMode ? {op: 'update', id: parseInt(id), data: data} : {op: 'create', data: data};
 
-        if (result.success) {
+        if (await applyOps([op])) {
             closeModal();
-            loadRanks();
-            showToast(result.message, 'success');
-        } else {
-            showToast('Xatolik: ' + (result.message || 'Noma\\'lum xatolik'), 'error');
+            showToast(editMode ? 'Rank muvaffaqiyatli yangilandi!' : 'Rank muvaffaqiyatli qo\\'shildi!', 'success');
         }
 
         return false;
@@ -1969,15 +4361,7 @@ def admin_ranks():
     async function deleteRank(id, name, duration) {
         if (!confirm(`"${name} (${duration})" ni o'chirishga ishonchingiz komilmi?`)) return;
 
-        const res = await fetch(`/admin/delete_rank/${id}`, {method: 'POST'});
-        const result = await res.json();
-
-        if (result.success) {
-            loadRanks();
-            showToast(result.message, 'success');
-        } else {
-            showToast('Xatolik: ' + (result.message || 'Noma\\'lum xatolik'), 'error');
-        }
+        if (await applyOps([{op: 'delete', id: id}])) showToast('Rank o\\'chirildi!', 'success');
     }
 
     async function duplicateRank(id) {
@@ -1995,54 +4379,23 @@ def admin_ranks():
             is_active: 0
         };
 
-        const res = await fetch('/admin/add_rank', {
-            method: 'POST',
-            headers: {'Content-Type': 'application/json'},
-            body: JSON.stringify(data)
-        });
-
-        const result = await res.json();
-
-        if (result.success) {
-            loadRanks();
-            showToast('Rank nusxalandi!', 'success');
-        } else {
-            showToast('Xatolik yuz berdi!', 'error');
-        }
+        if (await applyOps([{op: 'create', data: data}])) showToast('Rank nusxalandi!', 'success');
     }
 
     async function bulkActivate() {
         if (!confirm('Barcha ranklarni aktivlashtirish ishonchingiz komilmi?')) return;
 
-        for (const pkg of allPackages) {
-            if (!pkg.is_active) {
-                await fetch(`/admin/edit_rank/${pkg.id}`, {
-                    method: 'POST',
-                    headers: {'Content-Type': 'application/json'},
-                    body: JSON.stringify({...pkg, is_active: 1})
-                });
-            }
-        }
-
-        loadRanks();
-        showToast('Barcha ranklar aktivlashtirildi!', 'success');
+        const ids = allPackages.filter(p => !p.is_active).map(p => p.id);
+        if (!ids.length) return showToast('Barcha ranklar allaqachon aktiv', 'success');
+        if (await applyOps([{op: 'activate', ids: ids}])) showToast('Barcha ranklar aktivlashtirildi!', 'success');
     }
 
     async function bulkDeactivate() {
         if (!confirm('Barcha ranklarni o\\'chirish ishonchingiz komilmi?')) return;
 
-        for (const pkg of allPackages) {
-            if (pkg.is_active) {
-                await fetch(`/admin/edit_rank/${pkg.id}`, {
-                    method: 'POST',
-                    headers: {'Content-Type': 'application/json'},
-                    body: JSON.stringify({...pkg, is_active: 0})
-                });
-            }
-        }
-
-        loadRanks();
-        showToast('Barcha ranklar o\\'chirildi!', 'success');
+        const ids = allPackages.filter(p => p.is_active).map(p => p.id);
+        if (!ids.length) return showToast('Barcha ranklar allaqachon o\\'chirilgan', 'success');
+        if (await applyOps([{op: 'deactivate', ids: ids}])) showToast('Barcha ranklar o\\'chirildi!', 'success');
     }
 
     function exportRanks() {
@@ -2082,14 +4435,23 @@ def admin_panel():
     pending = conn.execute(
         'SELECT bd.*, u.username as uname, u.minecraft_nick as mc FROM balance_deposits bd JOIN users u ON bd.user_id=u.id WHERE bd.status=\'pending\' ORDER BY bd.created_at DESC').fetchall()
     total_users = conn.execute('SELECT COUNT(*) as c FROM users WHERE is_admin=0').fetchone()['c']
-    total_deposits = conn.execute("SELECT COUNT(*) as c FROM balance_deposits WHERE status='approved'").fetchone()['c']
-    total_purchases = conn.execute('SELECT COUNT(*) as c FROM purchases').fetchone()['c']
-    total_revenue = conn.execute('SELECT COALESCE(SUM(amount),0) as s FROM purchases').fetchone()['s']
+    _, total_deposits = analytics_totals(conn, 'deposits')
+    total_revenue, total_purchases = analytics_totals(conn)
     open_tickets = conn.execute("SELECT COUNT(*) as c FROM support_tickets WHERE status='open'").fetchone()['c']
     conn.close()
+    hh = ''
+    for h in breaker_states():
+        badge = {'closed': ('success', '🟢 Ishlayapti'), 'open': ('danger', '🔴 O\'chgan'),
+                 'half_open': ('pending', '🟡 Tekshirilmoqda')}[h['state']]
+        last_fail = datetime.datetime.fromtimestamp(h['last_fail_at']).strftime('%Y-%m-%d %H:%M:%S') if h['last_fail_at'] else '—'
+        retry = f' ({h["retry_in"]:.0f}s)' if h['retry_in'] else ''
+        reset = f'<button onclick="resetBreaker(\'{h["server"]}\')" class="btn btn-secondary btn-sm"><i class="fas fa-redo"></i> Reset</button>' if h['state'] != 'closed' else ''
+        hh += f'<tr><td><strong>{sanitize(h["server"].upper())}</strong></td><td><span class="badge badge-{badge[0]}">{badge[1]}{retry}</span></td><td>{h["failures"]}</td><td>{last_fail}</td><td style="max-width:320px;color:var(--text-dim);font-size:.8rem;">{sanitize(h["last_error"] or "—")}</td><td>{reset}</td></tr>'
+    if not hh:
+        hh = '<tr><td colspan="6" style="text-align:center;color:var(--text-dim);padding:1.5rem;">Hozircha xato qayd etilmagan</td></tr>'
     ph = ''
     for d in pending:
-        ss = f'<a href="{d["screenshot"]}" target="_blank" class="btn btn-outline btn-sm"><i class="fas fa-image"></i></a>' if \
+        ss = f'<a href="{d["screenshot"]}" target="_blank">{picture_html(d["screenshot"], "width:56px;height:40px;object-fit:cover;border-radius:6px;")}</a>' if \
             d['screenshot'] else ''
         ph += f'<tr><td>#{d["id"]}</td><td><strong>{sanitize(d["uname"])}</strong><br/><span style="color:var(--text-dim);font-size:.8rem;">{sanitize(d["mc"] or "—")}</span></td><td>{d["amount"]:,.0f} so\'m</td><td>{sanitize(d["card_number"])}</td><td>{sanitize(d["transaction_id"])}</td><td>{str(d["created_at"])[:16]}</td><td style="display:flex;gap:.4rem;flex-wrap:wrap;">{ss}<button onclick="approveDeposit({d["id"]})" class="btn btn-primary btn-sm"><i class="fas fa-check"></i> Tasdiqlash</button><button onclick="rejectDeposit({d["id"]})" class="btn btn-danger btn-sm"><i class="fas fa-times"></i> Rad</button></td></tr>'
     if not ph:
@@ -2120,25 +4482,59 @@ def admin_panel():
                 <tbody>{ph}</tbody>
             </table></div>
         </div>
+        <div class="card">
+            <div class="card-header"><i class="fas fa-chart-bar"></i><h2>Daromad — oxirgi 30 kun</h2>{report_freshness_html()}</div>
+            <div id="revenueChart" style="display:flex;align-items:flex-end;gap:3px;height:140px;"></div>
+            <div id="revenueChartMeta" style="color:var(--text-dim);font-size:.8rem;margin-top:.6rem;"></div>
+            <div style="display:flex;gap:.5rem;flex-wrap:wrap;margin-top:1rem;">
+                <a href="/admin/export/purchases.csv" class="btn btn-secondary btn-sm"><i class="fas fa-file-csv"></i> Xaridlar</a>
+                <a href="/admin/export/deposits.csv" class="btn btn-secondary btn-sm"><i class="fas fa-file-csv"></i> To'lovlar</a>
+                <a href="/admin/export/users.csv" class="btn btn-secondary btn-sm"><i class="fas fa-file-csv"></i> Foydalanuvchilar</a>
+            </div>
+        </div>
+        <div class="card">
+            <div class="card-header"><i class="fas fa-heartbeat"></i><h2>Serverlar holati</h2></div>
+            <div class="table-wrap"><table>
+                <thead><tr><th>Server</th><th>Holat</th><th>Xatolar</th><th>Oxirgi xato</th><th>Sabab</th><th></th></tr></thead>
+                <tbody>{hh}</tbody>
+            </table></div>
+        </div>
     </div>'''
     return render_page(content, logged_in=True, is_admin=True)
 
 
+@app.route('/admin/api/health')
+@admin_required
+def api_server_health():
+    return jsonify(servers=breaker_states(), threshold=BREAKER_THRESHOLD, cooldown=BREAKER_COOLDOWN)
+
+
+@app.route('/admin/health/<server>/reset', methods=['POST'])
+@admin_required
+def reset_server_health(server):
+    breaker_reset(server)
+    return jsonify(success=True, message=f"{sanitize(server.upper())} holati tiklandi")
+
+
 @app.route('/admin/approve_deposit/<int:did>', methods=['POST'])
 @admin_required
 def approve_deposit(did):
     data = request.get_json(force=True, silent=True) or {}
     comment = sanitize(data.get('comment', ''))
     conn = get_db()
-    dep = conn.execute('SELECT * FROM balance_deposits WHERE id=?', (did,)).fetchone()
-    if dep and dep['status'] == 'pending':
-        conn.execute('UPDATE users SET balance=balance+? WHERE id=?', (dep['amount'], dep['user_id']))
-        conn.execute('UPDATE balance_deposits SET status=?,admin_comment=? WHERE id=?', ('approved', comment, did))
+    try:
+        # status sharti + BEGIN IMMEDIATE: parallel ikki tasdiq balansni ikki marta oshirmaydi
+        conn.execute('BEGIN IMMEDIATE')
+        if conn.execute("UPDATE balance_deposits SET status='approved', admin_comment=? WHERE id=? AND status='pending'",
+                        (comment, did)).rowcount != 1:
+            conn.rollback()
+            return jsonify(success=False, message='Xatolik!')
+        dep = conn.execute('SELECT user_id, amount FROM balance_deposits WHERE id=?', (did,)).fetchone()
+        post_ledger(conn, dep['user_id'], dep['amount'], 'deposit', 'cash', 'deposit', did, created_by=session['user_id'])
         conn.commit()
+    finally:
         conn.close()
-        return jsonify(success=True, message="To'lov tasdiqlandi!")
-    conn.close()
-    return jsonify(success=False, message='Xatolik!')
+    return jsonify(success=True, message="To'lov tasdiqlandi!")
 
 
 @app.route('/admin/reject_deposit/<int:did>', methods=['POST'])
@@ -2147,13 +4543,12 @@ def reject_deposit(did):
     data = request.get_json(force=True, silent=True) or {}
     comment = sanitize(data.get('comment', ''))
     conn = get_db()
-    dep = conn.execute('SELECT * FROM balance_deposits WHERE id=?', (did,)).fetchone()
-    if dep and dep['status'] == 'pending':
-        conn.execute('UPDATE balance_deposits SET status=?,admin_comment=? WHERE id=?', ('rejected', comment, did))
-        conn.commit()
-        conn.close()
-        return jsonify(success=True, message="To'lov rad etildi!")
+    rejected = conn.execute("UPDATE balance_deposits SET status='rejected', admin_comment=? WHERE id=? AND status='pending'",
+                            (comment, did)).rowcount
+    conn.commit()
     conn.close()
+    if rejected:
+        return jsonify(success=True, message="To'lov rad etildi!")
     return jsonify(success=False, message='Xatolik!')
 
 
@@ -2161,22 +4556,19 @@ def reject_deposit(did):
 @admin_required
 def admin_deposits():
     sf = request.args.get('status', 'all')
-    conn = get_db()
     q = 'SELECT bd.*, u.username as uname FROM balance_deposits bd JOIN users u ON bd.user_id=u.id'
-    params = []
-    if sf != 'all': q += ' WHERE bd.status=?'; params.append(sf)
-    q += ' ORDER BY bd.created_at DESC'
-    deposits = conn.execute(q, params).fetchall()
-    conn.close()
-    rows = ''
-    for d in deposits:
+    where, params = ([], []) if sf == 'all' else (['bd.status=?'], [sf])
+
+    def render_row(d):
         sc = 'pending' if d['status'] == 'pending' else ('approved' if d['status'] == 'approved' else 'rejected')
         st = '⏳ Kutilmoqda' if d['status'] == 'pending' else (
             '✅ Tasdiqlandi' if d['status'] == 'approved' else '❌ Rad etildi')
-        ss = f'<a href="{d["screenshot"]}" target="_blank" class="btn btn-outline btn-sm"><i class="fas fa-image"></i></a>' if \
+        ss = f'<a href="{d["screenshot"]}" target="_blank">{picture_html(d["screenshot"], "width:56px;height:40px;object-fit:cover;border-radius:6px;")}</a>' if \
             d['screenshot'] else ''
-        rows += f'<tr><td>#{d["id"]}</td><td><strong>{sanitize(d["uname"])}</strong></td><td>{d["amount"]:,.0f} so\'m</td><td>{sanitize(d["card_number"])}</td><td><span class="badge badge-{sc}">{st}</span></td><td>{str(d["created_at"])[:16]}</td><td>{ss}</td></tr>'
-    content = f'''
+        return f'<tr><td>#{d["id"]}</td><td><strong>{sanitize(d["uname"])}</strong></td><td>{d["amount"]:,.0f} so\'m</td><td>{sanitize(d["card_number"])}</td><td><span class="badge badge-{sc}">{st}</span></td><td>{str(d["created_at"])[:16]}</td><td>{ss}</td></tr>'
+
+    def generate():
+        yield f'''
     <div class="container" style="padding-top:2rem;">
         <div class="section-title"><h2>💳 To'lovlar</h2></div>
         <div class="tabs">
@@ -2185,57 +4577,76 @@ def admin_deposits():
             <a href="/admin/deposits?status=pending" class="tab {'active' if sf == 'pending' else ''}">⏳ Kutilmoqda</a>
             <a href="/admin/deposits?status=approved" class="tab {'active' if sf == 'approved' else ''}">✅ Tasdiqlangan</a>
             <a href="/admin/deposits?status=rejected" class="tab {'active' if sf == 'rejected' else ''}">❌ Rad etilgan</a>
+            <a href="/admin/export/deposits.csv{'' if sf == 'all' else '?status=' + sanitize(sf)}" class="tab"><i class="fas fa-file-csv"></i> CSV</a>
         </div>
         <div class="card"><div class="table-wrap"><table>
             <thead><tr><th>#</th><th>User</th><th>Summa</th><th>Karta</th><th>Status</th><th>Sana</th><th>Screenshot</th></tr></thead>
-            <tbody>{rows or '<tr><td colspan="7" style="text-align:center;color:var(--text-dim);padding:1.5rem;">Malumotlar yoq</td></tr>'}</tbody>
-        </table></div></div>
+            <tbody>'''
+        empty = True
+        for chunk in iter_keyset(q, where, params, render_row, key='bd.id'):
+            empty = False
+            yield chunk
+        if empty:
+            yield '<tr><td colspan="7" style="text-align:center;color:var(--text-dim);padding:1.5rem;">Malumotlar yoq</td></tr>'
+        yield '</tbody></table></div>'
+        archived_until = archive_newest('balance_deposits')
+        if archived_until and sf != 'pending':
+            yield (f'<p style="color:var(--text-dim);font-size:.85rem;margin-top:1rem;"><i class="fas fa-box-archive"></i> '
+                   f'{str(archived_until)[:10]} gacha tasdiqlangan/rad etilgan to\'lovlar arxivga ko\'chirilgan va bu ro\'yxatda yo\'q — '
+                   f'to\'liq ro\'yxat CSV eksportda.</p>')
+        yield '''</div>
     </div>'''
-    return render_page(content, logged_in=True, is_admin=True)
+
+    return stream_page(generate(), logged_in=True, is_admin=True)
 
 
 @app.route('/admin/users')
 @admin_required
 def admin_users():
-    conn = get_db()
-    users = conn.execute('SELECT * FROM users ORDER BY created_at DESC').fetchall()
-    conn.close()
-    rows = ''
-    for u in users:
-        rows += f'<tr><td>#{u["id"]}</td><td><strong>{sanitize(u["username"])}</strong></td><td>{sanitize(u["minecraft_nick"] or "—")}</td><td>{u["balance"]:,} so\'m</td><td><div style="display:flex;gap:5px;align-items:center;"><input type="number" id="bal_{u["id"]}" placeholder="Balans" style="width:90px;padding:.4rem .5rem;background:rgba(255,255,255,.04);border:1px solid rgba(255,255,255,.1);border-radius:6px;color:var(--text);font-size:.82rem;"><button class="btn btn-primary btn-sm" onclick="updateBal({u["id"]})" style="padding:.35rem .7rem;"><i class="fas fa-check"></i></button><button class="btn btn-danger btn-sm" onclick="setZero({u["id"]})" style="padding:.35rem .7rem;"><i class="fas fa-trash"></i></button></div></td></tr>'
-    content = f'''
+    def render_row(u):
+        return f'<tr><td>#{u["id"]}</td><td><strong>{sanitize(u["username"])}</strong></td><td>{sanitize(u["minecraft_nick"] or "—")}</td><td>{u["balance"]:,} so\'m</td><td><div style="display:flex;gap:5px;align-items:center;"><input type="number" id="bal_{u["id"]}" placeholder="Balans" style="width:90px;padding:.4rem .5rem;background:rgba(255,255,255,.04);border:1px solid rgba(255,255,255,.1);border-radius:6px;color:var(--text);font-size:.82rem;"><button class="btn btn-primary btn-sm" onclick="updateBal({u["id"]})" style="padding:.35rem .7rem;"><i class="fas fa-check"></i></button><button class="btn btn-danger btn-sm" onclick="setZero({u["id"]})" style="padding:.35rem .7rem;"><i class="fas fa-trash"></i></button></div></td></tr>'
+
+    def generate():
+        yield '''
     <div class="container" style="padding-top:2rem;">
         <div class="section-title"><h2>👥 Foydalanuvchilar</h2></div>
         <div class="tabs"><a href="/admin" class="tab"><i class="fas fa-tachometer-alt"></i> Dashboard</a><a href="/admin/users" class="tab active"><i class="fas fa-users"></i> Users</a></div>
         <div class="card"><div class="table-wrap"><table>
             <thead><tr><th>ID</th><th>Username</th><th>MC Nick</th><th>Balans</th><th>Balans Tahrir</th></tr></thead>
-            <tbody>{rows}</tbody>
+            <tbody>'''
+        yield from iter_keyset('SELECT * FROM users', [], [], render_row)
+        yield '''</tbody>
         </table></div></div>
     </div>
     <script>
-    async function updateBal(uid){{
+    async function updateBal(uid){
         const val=document.getElementById('bal_'+uid).value;
         if(val==='') return showToast('Qiymat kiriting!','error');
-        const r=await fetch('/admin/update_balance',{{method:'POST',headers:{{'Content-Type':'application/x-www-form-urlencoded'}},body:'user_id='+uid+'&new_balance='+val}});
-        if(r.ok){{showToast('Balans yangilandi!');location.reload();}}
-    }}
-    async function setZero(uid){{
+        const r=await fetch('/admin/update_balance',{method:'POST',headers:{'Content-Type':'application/x-www-form-urlencoded'},body:'user_id='+uid+'&new_balance='+val});
+        if(r.ok){showToast('Balans yangilandi!');location.reload();}
+    }
+    async function setZero(uid){
         if(!confirm('Balansni 0 qilishga ishonchingiz komilmi?')) return;
-        const r=await fetch('/admin/update_balance',{{method:'POST',headers:{{'Content-Type':'application/x-www-form-urlencoded'}},body:'user_id='+uid+'&new_balance=0'}});
-        if(r.ok){{showToast('Balans 0 qilib qo\\'yildi!');location.reload();}}
-    }}
+        const r=await fetch('/admin/update_balance',{method:'POST',headers:{'Content-Type':'application/x-www-form-urlencoded'},body:'user_id='+uid+'&new_balance=0'});
+        if(r.ok){showToast('Balans 0 qilib qo\\'yildi!');location.reload();}
+    }
     </script>'''
-    return render_page(content, logged_in=True, is_admin=True)
+
+    return stream_page(generate(), logged_in=True, is_admin=True)
 
 
 @app.route('/admin/update_balance', methods=['POST'])
 @admin_required
 def update_balance():
-    user_id = request.form.get('user_id')
-    new_balance = request.form.get('new_balance')
+    user_id = request.form.get('user_id', type=int)
+    new_balance = request.form.get('new_balance', type=float)
     if user_id and new_balance is not None:
         conn = get_db()
-        conn.execute('UPDATE users SET balance=? WHERE id=?', (new_balance, user_id))
+        conn.execute('BEGIN IMMEDIATE')
+        user = conn.execute('SELECT balance FROM users WHERE id=?', (user_id,)).fetchone()
+        if user and abs(new_balance - user['balance']) > LEDGER_EPSILON:
+            post_ledger(conn, user_id, new_balance - user['balance'], 'adjustment', 'adjustments', 'user', user_id,
+                        memo=sanitize(request.form.get('memo', '')) or None, created_by=session['user_id'])
         conn.commit()
         conn.close()
     return redirect(url_for('admin_users'))
@@ -2260,15 +4671,934 @@ def admin_support_list():
     <div class="container" style="max-width:860px;margin:0 auto;padding-top:2rem;">
         <div class="section-title"><h2>⚡ Admin Support</h2></div>
         <div class="tabs"><a href="/admin" class="tab"><i class="fas fa-tachometer-alt"></i> Dashboard</a><a href="/admin/support" class="tab active"><i class="fas fa-headset"></i> Support</a></div>
+        <div class="card">
+            <div class="form-group" style="margin-bottom:0;"><input type="search" id="supportSearch" placeholder="🔍 Murojaat va xabarlardan qidirish..." oninput="searchSupport(this.value)"></div>
+            <div id="supportSearchMeta" style="color:var(--text-dim);font-size:.8rem;margin-top:.5rem;"></div>
+            <div class="support-list" id="supportSearchResults" style="margin-top:.8rem;"></div>
+        </div>
         <div class="card"><div class="support-list">{lh}</div></div>
+    </div>
+    <script>
+    let supportSearchTimer=null;
+    function searchSupport(q){{
+        clearTimeout(supportSearchTimer);
+        supportSearchTimer=setTimeout(async()=>{{
+            const box=document.getElementById('supportSearchResults'), meta=document.getElementById('supportSearchMeta');
+            if(!q.trim()){{box.innerHTML='';meta.textContent='';return;}}
+            const r=await fetch('/admin/api/support/search?q='+encodeURIComponent(q));
+            const d=await r.json();
+            meta.textContent=d.results.length+' ta natija • '+d.took_ms+' ms';
+            box.innerHTML=d.results.map(t=>{{
+                const subj=document.createElement('div');subj.textContent=t.subject;
+                return '<a href="/support/'+t.ticket_id+'" class="ticket-row" style="text-decoration:none;"><div class="ticket-row-left"><span class="ticket-id">#'+t.ticket_id+'</span><div><div class="ticket-subject">'+subj.innerHTML+'</div><div class="ticket-meta">'+t.snippet_html+'</div></div></div><div class="ticket-row-right"><span class="badge badge-'+t.status+'">'+t.status+'</span></div></a>';
+            }}).join('');
+        }},200);
+    }}
+    </script>'''
+    return render_page(content, logged_in=True, is_admin=True)
+
+
+@app.route('/admin/sql-profile')
+@admin_required
+def admin_sql_profile():
+    """Shu workerda oxirgi profillangan so'rovlar (?_sqlprof=1 yoki SQL_PROFILE=1)."""
+    if request.args.get('format') == 'json':
+        return jsonify(list(_sql_profiles))
+    cards = ''
+    for p in _sql_profiles:
+        warn = ''.join(f'<div class="alert alert-warning"><i class="fas fa-exclamation-triangle"></i><div><strong>N+1 ({w["count"]}x)</strong> {sanitize(w["sql"])}</div></div>' for w in p['n_plus_one'])
+        warn += ''.join(f'<div class="alert alert-info"><i class="fas fa-clone"></i><div><strong>Takroriy ({w["count"]}x)</strong> {sanitize(w["sql"])}</div></div>' for w in p['duplicates'])
+        rows = ''.join(f'<tr><td>{i + 1}</td><td style="font-family:monospace;font-size:.78rem;">{sanitize(e["sql"])} <span style="opacity:.5;">{sanitize(e["params"])}</span></td><td>{e["ms"]:.2f}</td><td>{e["rows"]}</td><td>{e["vm_steps"]}</td></tr>' for i, e in enumerate(p['statements']))
+        cards += f'''
+        <div class="card">
+            <div class="card-header"><i class="fas fa-database"></i><h2>{sanitize(p["path"])}</h2></div>
+            <p style="color:var(--text-dim);margin-bottom:1rem;">{p["at"]} • {p["queries"]} ta so'rov • {p["ms"]:.2f} ms • {p["rows"]} qator</p>
+            {warn}
+            <div class="table-wrap"><table>
+                <thead><tr><th>#</th><th>SQL</th><th>ms</th><th>Qator</th><th>VM</th></tr></thead>
+                <tbody>{rows}</tbody>
+            </table></div>
+        </div>'''
+    empty = '<div class="card"><p style="text-align:center;color:var(--text-dim);">Hali profil yo\'q. Istalgan sahifani <code>?_sqlprof=1</code> bilan oching.</p></div>'
+    content = f'''
+    <div class="container" style="padding-top:2rem;">
+        <div class="section-title"><h2>🧪 SQL Profil</h2></div>
+        <div class="tabs"><a href="/admin" class="tab"><i class="fas fa-tachometer-alt"></i> Dashboard</a><a href="/admin/sql-profile" class="tab active"><i class="fas fa-database"></i> SQL</a></div>
+        {cards or empty}
     </div>'''
     return render_page(content, logged_in=True, is_admin=True)
 
 
+# ═══════════════════════════════════════════════
+# ANALYTICS — kunlik rollup jadvali, triggerlar bilan yangilanadi
+# ═══════════════════════════════════════════════
+
+ANALYTICS_UTC_OFFSET_HOURS = 5  # Toshkent (yozgi vaqt yo'q) — kun chegarasi mahalliy yarim tun
+ANALYTICS_DIMENSIONS = ('total', 'category', 'package', 'server', 'deposits')
+ANALYTICS_DEFAULT_DAYS = 30
+ANALYTICS_MAX_DAYS = 3660
+
+
+def _analytics_day_sql(row):
+    return f"date({row}.created_at, '+{ANALYTICS_UTC_OFFSET_HOURS} hours')"
+
+
+def package_category_sql(row):
+    """Xarid qatori uchun paketning joriy toifasi — faqat purchases.category bo'sh bo'lganda (eski yozuvlar)."""
+    return (f"CASE WHEN {row}.package_id IS NULL THEN 'custom_token' "
+            f"ELSE COALESCE((SELECT category FROM packages WHERE id = {row}.package_id), 'unknown') END")
+
+
+def _purchase_rollup_keys(row):
+    """
+    (dimension, kalit SQL ifodasi) — purchases qatori uchun; server moslashuvi package_server() bilan bir xil.
+    Toifa xaridda saqlangani olinadi: triggerlar va rebuild_analytics tarixni bugungi katalog bo'yicha qayta taqsimlamaydi.
+    """
+    category = f"COALESCE({row}.category, {package_category_sql(row)})"
+    return (('total', "'all'"),
+            ('category', category),
+            ('package', f"COALESCE({row}.package_name, '')"),
+            ('server', f"CASE {category} WHEN 'smp' THEN 'smp' WHEN 'custom_token' THEN 'default' ELSE 'anarchy' END"))
+
+
+def _rollup_sql(row, sign, keys):
+    day = _analytics_day_sql(row)
+    amount = f'COALESCE({row}.amount, 0)'
+    if sign > 0:
+        return ''.join(f"""INSERT INTO revenue_daily (dimension, day, key, revenue, count) VALUES ('{dim}', {day}, {key}, {amount}, 1)
+                           ON CONFLICT(dimension, day, key) DO UPDATE SET revenue = revenue + excluded.revenue, count = count + 1;"""
+                       for dim, key in keys)
+    return ''.join(f"""UPDATE revenue_daily SET revenue = revenue - {amount}, count = count - 1
+                       WHERE dimension = '{dim}' AND day = {day} AND key = {key};"""
+                   for dim, key in keys)
+
+
+def analytics_triggers():
+    """Yakunlangan purchases va tasdiqlangan balance_deposits o'zgarishlarini revenue_daily ga yozuvchi triggerlar."""
+    deposit = (('deposits', "'approved'"),)
+    purchase_update = 'AFTER UPDATE OF amount, created_at, package_name, status, category ON purchases'
+    return [
+        f"""CREATE TRIGGER IF NOT EXISTS trg_analytics_purchase_insert AFTER INSERT ON purchases
+            WHEN NEW.status IS NOT 'pending' BEGIN {_rollup_sql('NEW', 1, _purchase_rollup_keys('NEW'))} END""",
+        f"""CREATE TRIGGER IF NOT EXISTS trg_analytics_purchase_delete AFTER DELETE ON purchases
+            WHEN OLD.status IS NOT 'pending' AND NOT EXISTS (SELECT 1 FROM archive_in_progress)
+            BEGIN {_rollup_sql('OLD', -1, _purchase_rollup_keys('OLD'))} END""",
+        f"""CREATE TRIGGER IF NOT EXISTS trg_analytics_purchase_update_old {purchase_update}
+            WHEN OLD.status IS NOT 'pending' BEGIN {_rollup_sql('OLD', -1, _purchase_rollup_keys('OLD'))} END""",
+        f"""CREATE TRIGGER IF NOT EXISTS trg_analytics_purchase_update_new {purchase_update}
+            WHEN NEW.status IS NOT 'pending' BEGIN {_rollup_sql('NEW', 1, _purchase_rollup_keys('NEW'))} END""",
+        f"""CREATE TRIGGER IF NOT EXISTS trg_analytics_deposit_insert AFTER INSERT ON balance_deposits WHEN NEW.status = 'approved'
+            BEGIN {_rollup_sql('NEW', 1, deposit)} END""",
+        f"""CREATE TRIGGER IF NOT EXISTS trg_analytics_deposit_delete AFTER DELETE ON balance_deposits
+            WHEN OLD.status = 'approved' AND NOT EXISTS (SELECT 1 FROM archive_in_progress) BEGIN {_rollup_sql('OLD', -1, deposit)} END""",
+        f"""CREATE TRIGGER IF NOT EXISTS trg_analytics_deposit_update_old AFTER UPDATE OF status, amount, created_at ON balance_deposits
+            WHEN OLD.status = 'approved' BEGIN {_rollup_sql('OLD', -1, deposit)} END""",
+        f"""CREATE TRIGGER IF NOT EXISTS trg_analytics_deposit_update_new AFTER UPDATE OF status, amount, created_at ON balance_deposits
+            WHEN NEW.status = 'approved' BEGIN {_rollup_sql('NEW', 1, deposit)} END""",
+    ]
+
+
+def rebuild_analytics(conn):
+    """revenue_daily ni butun tarixdan qayta quradi (chaqiruvchi tranzaksiyasida; arxiv ulangan bo'lsa u ham qo'shiladi)."""
+    conn.execute('DELETE FROM revenue_daily')
+    for dim, key in _purchase_rollup_keys('p'):
+        conn.execute(f'''INSERT INTO revenue_daily (dimension, day, key, revenue, count)
+                         SELECT '{dim}', {_analytics_day_sql('p')}, {key}, COALESCE(SUM(p.amount), 0), COUNT(*)
+                         FROM {with_archive(conn, 'purchases')} p WHERE p.status IS NOT 'pending' GROUP BY 2, 3''')
+    conn.execute(f'''INSERT INTO revenue_daily (dimension, day, key, revenue, count)
+                     SELECT 'deposits', {_analytics_day_sql('d')}, 'approved', COALESCE(SUM(d.amount), 0), COUNT(*)
+                     FROM {with_archive(conn, 'balance_deposits')} d WHERE d.status = 'approved' GROUP BY 2''')
+    return conn.execute('SELECT COUNT(*) FROM revenue_daily').fetchone()[0]
+
+
+def analytics_totals(conn, dimension='total'):
+    """Butun davr uchun (revenue, count) — kunlar soniga proporsional, purchases skan qilinmaydi."""
+    row = conn.execute('SELECT COALESCE(SUM(revenue), 0) AS revenue, COALESCE(SUM(count), 0) AS count FROM revenue_daily WHERE dimension=?',
+                       (dimension,)).fetchone()
+    return row['revenue'], row['count']
+
+
+def analytics_series(conn, dimension, start, end):
+    """Grafik uchun: kunlar ro'yxati va har bir kalit bo'yicha nol bilan to'ldirilgan revenue/count qatorlari."""
+    labels = [(start + datetime.timedelta(days=i)).isoformat() for i in range((end - start).days + 1)]
+    index = {day: i for i, day in enumerate(labels)}
+    series = {}
+    for r in conn.execute('SELECT day, key, revenue, count FROM revenue_daily WHERE dimension=? AND day BETWEEN ? AND ?',
+                          (dimension, labels[0], labels[-1])):
+        s = series.setdefault(r['key'], {'key': r['key'], 'revenue': [0] * len(labels), 'count': [0] * len(labels)})
+        s['revenue'][index[r['day']]] = round(r['revenue'], 2)
+        s['count'][index[r['day']]] = r['count']
+    ordered = sorted(series.values(), key=lambda s: -sum(s['revenue']))
+    for s in ordered:
+        s['total_revenue'] = round(sum(s['revenue']), 2)
+        s['total_count'] = sum(s['count'])
+    return {'labels': labels, 'series': ordered}
+
+
+def analytics_today():
+    return (datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(hours=ANALYTICS_UTC_OFFSET_HOURS)).date()
+
+
+@app.route('/admin/api/analytics')
+@admin_required
+def api_analytics():
+    """?dimension=total|category|package|server|deposits&from=YYYY-MM-DD&to=YYYY-MM-DD (yoki ?days=30)"""
+    dimension = request.args.get('dimension', 'total')
+    if dimension not in ANALYTICS_DIMENSIONS:
+        return jsonify(success=False, message=f"dimension: {', '.join(ANALYTICS_DIMENSIONS)}"), 400
+    try:
+        end = datetime.date.fromisoformat(request.args['to']) if request.args.get('to') else analytics_today()
+        if request.args.get('from'):
+            start = datetime.date.fromisoformat(request.args['from'])
+        else:
+            start = end - datetime.timedelta(days=request.args.get('days', ANALYTICS_DEFAULT_DAYS, type=int) - 1)
+    except ValueError:
+        return jsonify(success=False, message="Sana formati: YYYY-MM-DD"), 400
+    if start > end or (end - start).days >= ANALYTICS_MAX_DAYS:
+        return jsonify(success=False, message=f"Oraliq 1..{ANALYTICS_MAX_DAYS} kun bo'lishi kerak"), 400
+
+    snapshot = report_snapshot_info()
+    conn = get_report_db()
+    data = analytics_series(conn, dimension, start, end)
+    conn.close()
+    return jsonify(success=True, dimension=dimension, snapshot_at=snapshot['taken_at'] if snapshot else None, **data)
+
+
+@app.cli.command('backfill-analytics')
+def backfill_analytics_command():
+    """revenue_daily ni mavjud purchases va balance_deposits tarixidan (arxiv bilan birga) qayta quradi."""
+    started = time.perf_counter()
+    conn = get_db()
+    if os.path.exists(ARCHIVE_DB_PATH):
+        attach_archive(conn)
+    conn.execute('BEGIN IMMEDIATE')
+    rows = rebuild_analytics(conn)
+    conn.commit()
+    conn.close()
+    print(f"  ✅ {rows} ta rollup qatori ({time.perf_counter() - started:.1f} s)")
+
+
+# ═══════════════════════════════════════════════
+# EXPORT — CSV/JSONL oqim, id bo'yicha keyset bo'laklar
+# ═══════════════════════════════════════════════
+
+EXPORT_CHUNK = 1000
+EXPORT_FORMATS = {'csv': 'text/csv', 'jsonl': 'application/x-ndjson'}
+EXPORTS = {
+    'purchases': ('purchases', ('id', 'user_id', 'package_id', 'package_name', 'minecraft_nick', 'amount', 'status', 'created_at')),
+    'deposits': ('balance_deposits', ('id', 'user_id', 'amount', 'card_number', 'transaction_id', 'status', 'admin_comment', 'created_at')),
+    'users': ('users', ('id', 'username', 'email', 'minecraft_nick', 'balance', 'is_admin', 'created_at')),
+}
+
+
+def _csv_safe(value):
+    # Excel/Sheets '=', '+', '-', '@' bilan boshlangan matnni formula deb bajaradi
+    if isinstance(value, str) and value[:1] in ('=', '+', '-', '@'):
+        return "'" + value
+    return value
+
+
+def _archive_rows(sql, params):
+    """Arxivdan xuddi shu so'rov; arxiv yo'q bo'lsa bo'sh ro'yxat."""
+    conn = open_archive()
+    if conn is None:
+        return []
+    try:
+        return conn.execute(sql, params).fetchall()
+    finally:
+        conn.close()
+
+
+def export_chunks(dataset, after_id=0, until_id=None, date_from=None, date_to=None, status=None):
+    """
+    (id, qator) bo'laklari: har bir bo'lak alohida `id > oxirgi` so'rovi, ulanish bo'laklar orasida
+    yopiladi — uzoq eksport yozuvchilarni bloklamaydi, xotira bo'lak hajmi bilan cheklangan.
+    Arxivlanadigan jadvallarda har bir bo'lak arxivdagi qatorlar bilan id bo'yicha birlashtiriladi
+    (id ko'chirishda saqlanadi; snapshotdan keyin arxivlangan qator ikki tomonda bo'lsa bir marta olinadi).
+    """
+    table, columns = EXPORTS[dataset]
+    where, params = ['id > ?', 'id <= ?'], [until_id]
+    if date_from:
+        where.append('created_at >= ?')
+        params.append(date_from)
+    if date_to:
+        where.append('created_at < ?')
+        params.append(date_to)
+    if status:
+        where.append('status = ?')
+        params.append(status)
+    sql = f"SELECT {', '.join(columns)} FROM {table} WHERE {' AND '.join(where)} ORDER BY id LIMIT {EXPORT_CHUNK}"
+    last = after_id
+    while True:
+        conn = get_report_db()
+        try:
+            rows = conn.execute(sql, [last] + params).fetchall()
+        finally:
+            conn.close()
+        if table in ARCHIVE_TABLES:
+            merged = {r['id']: r for r in _archive_rows(sql, [last] + params)}
+            merged.update((r['id'], r) for r in rows)
+            rows = [merged[k] for k in sorted(merged)[:EXPORT_CHUNK]]
+        if not rows:
+            return
+        yield rows
+        last = rows[-1]['id']
+        if len(rows) < EXPORT_CHUNK:
+            return
+
+
+def _export_lines(dataset, fmt, chunks, header):
+    columns = EXPORTS[dataset][1]
+    if fmt == 'csv':
+        buf = io.StringIO()
+        writer = csv.writer(buf)
+        if header:
+            writer.writerow(columns)
+        for rows in chunks:
+            writer.writerows([_csv_safe(v) for v in row] for row in rows)
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+            metric_inc('export_rows_total', len(rows), dataset=dataset)
+        if header and buf.tell():
+            yield buf.getvalue()
+    else:
+        for rows in chunks:
+            yield ''.join(json.dumps(dict(zip(columns, row)), ensure_ascii=False) + '\n' for row in rows)
+            metric_inc('export_rows_total', len(rows), dataset=dataset)
+
+
+@app.route('/admin/export/<dataset>.<fmt>')
+@admin_required
+def admin_export(dataset, fmt):
+    """
+    ?from=YYYY-MM-DD&to=YYYY-MM-DD (UTC, to kuni ham kiradi) &status=... &after_id=N (davom ettirish).
+    Oraliq so'rov boshida MAX(id) bilan qotiriladi (X-Export-Until-Id); uzilgan eksportni
+    after_id=<oxirgi olingan id>&until_id=<shu qiymat> bilan aynan davom ettirish mumkin.
+    """
+    if dataset not in EXPORTS or fmt not in EXPORT_FORMATS:
+        abort(404)
+    try:
+        date_from = datetime.date.fromisoformat(request.args['from']).isoformat() if request.args.get('from') else None
+        date_to = (datetime.date.fromisoformat(request.args['to']) + datetime.timedelta(days=1)).isoformat() if request.args.get('to') else None
+    except ValueError:
+        return jsonify(success=False, message="Sana formati: YYYY-MM-DD"), 400
+    status = (request.args.get('status') or None) if dataset != 'users' else None
+    after_id = request.args.get('after_id', 0, type=int)
+    until_id = request.args.get('until_id', type=int)
+    snapshot = report_snapshot_info()
+    if until_id is None:
+        table = EXPORTS[dataset][0]
+        conn = get_report_db()
+        until_id = conn.execute(f'SELECT COALESCE(MAX(id), 0) FROM {table}').fetchone()[0]
+        conn.close()
+        if table in ARCHIVE_TABLES:
+            # eng yangi qatorlar ham arxivlangan bo'lishi mumkin
+            until_id = max([until_id] + [r[0] or 0 for r in _archive_rows(f'SELECT MAX(id) FROM {table}', [])])
+
+    chunks = export_chunks(dataset, after_id, until_id, date_from, date_to, status)
+    resp = Response(stream_with_context(_export_lines(dataset, fmt, chunks, header=not after_id)),
+                    mimetype=EXPORT_FORMATS[fmt])
+    stamp = datetime.datetime.now().strftime('%Y%m%d-%H%M%S')
+    resp.headers['Content-Disposition'] = f'attachment; filename="{dataset}-{stamp}.{fmt}"'
+    resp.headers['X-Export-Until-Id'] = str(until_id)
+    if snapshot:
+        resp.headers['X-Snapshot-At'] = datetime.datetime.fromtimestamp(snapshot['taken_at']).isoformat(timespec='seconds')
+    resp.cache_control.no_store = True
+    return resp
+
+
+# ═══════════════════════════════════════════════
+# BACKUP — SQLite backup API, gzip snapshotlar, rotatsiya va tiklash
+# ═══════════════════════════════════════════════
+
+BACKUP_DIR = os.environ.get('BACKUP_DIR', 'backups')
+BACKUP_KEEP = int(os.environ.get('BACKUP_KEEP', 14))
+BACKUP_INTERVAL = float(os.environ.get('BACKUP_INTERVAL', 0))  # soniya; 0 — faqat `flask backup` (cron)
+BACKUP_PAGES = 256  # bir qadamda nusxalanadigan sahifalar — qadamlar orasida yozuvchilar navbat oladi
+BACKUP_STEP_SLEEP = 0.002
+BACKUP_MAX_RESTARTS = 3
+BACKUP_SYNC_PAGES = 4096  # nusxa har ~16 MB da fsync — yozuvchilar commit dagi fsync da katta kir kesh ortida kutmaydi
+BACKUP_LOCK_PATH = 'elitemc.backup.lock'
+_backup_running = threading.Lock()
+
+
+class BackupRestarted(Exception):
+    pass
+
+
+def _copy_db(dst_path, pages, sleep):
+    """
+    Qadamli online nusxa. WAL da manbada o'qish tranzaksiyasi butun nusxa davomida ochiq turadi —
+    sahifalar bitta snapshotdan olinadi, yozuvchilar kutmaydi, nusxa qayta boshlanmaydi. memdb da (WAL yo'q)
+    manba boshqa ulanishdan o'zgarsa SQLite nusxani boshidan boshlaydi; BACKUP_MAX_RESTARTS dan oshsa
+    BackupRestarted — chaqiruvchi bitta qadamli nusxaga o'tadi.
+    """
+    stats = {'steps': 0, 'restarts': 0}
+    last, synced, fd = [None], [0], [None]
+
+    def progress(status, remaining, total):
+        stats['steps'] += 1
+        if last[0] is not None and remaining > last[0]:
+            stats['restarts'] += 1
+            synced[0] = 0
+            if stats['restarts'] > BACKUP_MAX_RESTARTS:
+                raise BackupRestarted()
+        last[0] = remaining
+        if total - remaining - synced[0] >= BACKUP_SYNC_PAGES:
+            if fd[0] is None:
+                fd[0] = os.open(dst_path, os.O_RDONLY)
+            os.fsync(fd[0])
+            synced[0] = total - remaining
+        if sleep and remaining:
+            time.sleep(sleep)
+
+    src = db.raw_connect(timeout=30)
+    dst = sqlite3.connect(dst_path)
+    try:
+        if src.execute('PRAGMA journal_mode').fetchone()[0] == 'wal':
+            src.execute('BEGIN')
+            src.execute('SELECT 1 FROM sqlite_master LIMIT 1').fetchone()
+        src.backup(dst, pages=pages, progress=progress)
+        dst.execute('PRAGMA journal_mode=DELETE')  # nusxa -wal/-shm siz, bitta fayl sifatida ochiladi
+    finally:
+        if fd[0] is not None:
+            os.close(fd[0])
+        dst.close()
+        src.close()
+    return stats
+
+
+def _integrity_ok(path):
+    conn = sqlite3.connect(path)
+    try:
+        return conn.execute('PRAGMA integrity_check').fetchone()[0] == 'ok'
+    finally:
+        conn.close()
+
+
+def list_backups():
+    """Eng yangisi birinchi."""
+    out = []
+    for path in glob.glob(os.path.join(BACKUP_DIR, 'elitemc-*.db.gz')):
+        st = os.stat(path)
+        out.append({'name': os.path.basename(path), 'path': path, 'bytes': st.st_size, 'mtime': st.st_mtime})
+    return sorted(out, key=lambda b: b['name'], reverse=True)
+
+
+def create_backup(suffix='', pages=BACKUP_PAGES, sleep=BACKUP_STEP_SLEEP):
+    """
+    Nusxa -> PRAGMA integrity_check -> gzip -> gzip CRC tekshiruvi -> atomik nom -> rotatsiya.
+    Tayyor fayl faqat hamma tekshiruvdan o'tgach paydo bo'ladi.
+    """
+    os.makedirs(BACKUP_DIR, exist_ok=True)
+    started = time.perf_counter()
+    name = f"elitemc-{datetime.datetime.now().strftime('%Y%m%d-%H%M%S')}{suffix}.db.gz"
+    path = os.path.join(BACKUP_DIR, name)
+    tmp = os.path.join(BACKUP_DIR, f'.{name}.{os.getpid()}.tmp')
+    try:
+        try:
+            stats = _copy_db(tmp, pages, sleep)
+        except BackupRestarted:
+            stats = dict(_copy_db(tmp, -1, 0), restarts=BACKUP_MAX_RESTARTS + 1, fallback=True)
+        copied = time.perf_counter()
+        if not _integrity_ok(tmp):
+            raise RuntimeError(f"{name}: integrity_check muvaffaqiyatsiz")
+        db_bytes = os.path.getsize(tmp)
+        with open(tmp, 'rb') as f, gzip.open(tmp + '.gz', 'wb', compresslevel=6) as out:
+            shutil.copyfileobj(f, out, 1 << 20)
+        with gzip.open(tmp + '.gz', 'rb') as f:
+            while f.read(1 << 20):
+                pass
+        os.replace(tmp + '.gz', path)
+    finally:
+        for leftover in (tmp, tmp + '.gz'):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+
+    for old in list_backups()[BACKUP_KEEP:]:
+        os.remove(old['path'])
+    took = time.perf_counter() - started
+    metric_observe('backup_duration_seconds', took, buckets=(1, 5, 15, 60, 300, 900))
+    return dict(stats, name=name, path=path, bytes=os.path.getsize(path), db_bytes=db_bytes,
+                copy_s=round(copied - started, 3), total_s=round(took, 3))
+
+
+def restore_backup(path):
+    """
+    Snapshot ochiladi, integrity_check qilinadi va backup API bilan jonli bazaga yoziladi — fayl
+    almashtirilmaydi, shuning uchun ishlayotgan workerlarning ulanishlari buzilmaydi.
+    """
+    os.makedirs(BACKUP_DIR, exist_ok=True)
+    tmp = os.path.join(BACKUP_DIR, f'.restore.{os.getpid()}.tmp')  # DB_PATH ':memory:' bo'lishi mumkin
+    try:
+        with gzip.open(path, 'rb') as f, open(tmp, 'wb') as out:
+            shutil.copyfileobj(f, out, 1 << 20)
+        if not _integrity_ok(tmp):
+            raise RuntimeError(f"{path}: integrity_check muvaffaqiyatsiz")
+        src = sqlite3.connect(tmp)
+        dst = db.raw_connect(timeout=30)
+        try:
+            src.backup(dst)
+            return dst.execute('PRAGMA user_version').fetchone()[0]
+        finally:
+            dst.close()
+            src.close()
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def _scheduled_backup():
+    latest = list_backups()[:1]
+    if latest and time.time() - latest[0]['mtime'] < BACKUP_INTERVAL:
+        return
+    result = create_backup()
+    app.logger.info("Backup: %s (%d bayt, %.1f s, qayta boshlash: %d)", result['name'], result['bytes'],
+                    result['total_s'], result['restarts'])
+
+
+def start_backup_scheduler():
+    if BACKUP_INTERVAL > 0:
+        # Tekshiruv tez-tez, nusxa esa oxirgi fayl BACKUP_INTERVAL dan eski bo'lsagina — restartlar jadvalni surmaydi
+        start_leader_thread('backup', BACKUP_LOCK_PATH, min(BACKUP_INTERVAL, 300), _scheduled_backup, "Backup")
+
+
+@app.cli.command('backup')
+@click.option('--pages', default=BACKUP_PAGES, show_default=True, help="bir qadamdagi sahifalar (-1: bitta qadam)")
+def backup_command(pages):
+    """Bazaning siqilgan va tekshirilgan nusxasini BACKUP_DIR ga yozadi (eskilari BACKUP_KEEP gacha o'chiriladi)."""
+    r = create_backup(pages=pages)
+    fallback = ", bitta qadamga o'tildi" if r.get('fallback') else ''
+    print(f"  ✅ {r['path']}: {r['db_bytes'] / 1e6:.1f} MB -> {r['bytes'] / 1e6:.1f} MB, {r['total_s']:.1f} s"
+          f" ({r['steps']} qadam, {r['restarts']} qayta boshlash{fallback})")
+
+
+@app.cli.command('restore-backup')
+@click.argument('path')
+@click.option('--yes', is_flag=True, help="tasdiqlashsiz")
+def restore_backup_command(path, yes):
+    """Snapshotni jonli bazaga tiklaydi; avval joriy holatning '-pre-restore' nusxasi olinadi."""
+    if not yes and not click.confirm(f"Joriy baza {path} bilan almashtirilsinmi?"):
+        return
+    safety = create_backup(suffix='-pre-restore')
+    print(f"  💾 Joriy holat: {safety['path']}")
+    version = restore_backup(path)
+    print(f"  ✅ Tiklandi (sxema v{version}). Workerlarni qayta ishga tushiring — keshlar eski ma'lumotni ushlab turadi.")
+
+
+@app.route('/admin/api/backups', methods=['GET', 'POST'])
+@admin_required
+def api_backups():
+    if request.method == 'POST':
+        if not _backup_running.acquire(blocking=False):
+            return jsonify(success=False, message="Backup allaqachon ishlayapti"), 409
+
+        def run():
+            try:
+                create_backup()
+            except Exception as e:
+                app.logger.warning("Backup: %s", e)
+            finally:
+                _backup_running.release()
+
+        threading.Thread(target=run, name='backup-manual', daemon=True).start()
+        return jsonify(success=True, message="Backup boshlandi"), 202
+    return jsonify(running=_backup_running.locked(), keep=BACKUP_KEEP, interval=BACKUP_INTERVAL,
+                   backups=[{k: b[k] for k in ('name', 'bytes', 'mtime')} for b in list_backups()])
+
+
+# ═══════════════════════════════════════════════
+# REPORT SNAPSHOT — hisobotlar uchun davriy faqat-o'qish nusxa, alohida ulanishlar puli
+# ═══════════════════════════════════════════════
+
+REPORT_DB_PATH = os.environ.get('REPORT_DB_PATH', 'elitemc.report.db')
+REPORT_INTERVAL = float(os.environ.get('REPORT_INTERVAL', 0))  # soniya; 0 — hisobotlar jonli bazadan
+REPORT_MAX_AGE = float(os.environ.get('REPORT_MAX_AGE', 0)) or 3 * REPORT_INTERVAL  # eskirsa jonli bazaga qaytiladi
+REPORT_POOL_SIZE = 4
+REPORT_LOCK_PATH = 'elitemc.report.lock'
+
+
+# Snapshot faqat os.replace bilan almashadi — immutable ulanish qulf olmaydi; ident = (inode, mtime)
+_report_pool = ConnectionPool(lambda: sqlite3.connect(pathlib.Path(REPORT_DB_PATH).absolute().as_uri() + '?mode=ro&immutable=1',
+                                                      uri=True, factory=PooledConnection, check_same_thread=False),
+                              REPORT_POOL_SIZE)
+
+
+def report_snapshot_info():
+    """Yaroqli snapshot bo'lsa {'taken_at', 'age', 'ident'}; o'chirilgan, yo'q yoki eskirgan bo'lsa None."""
+    if REPORT_INTERVAL <= 0:
+        return None
+    try:
+        st = os.stat(REPORT_DB_PATH)
+    except OSError:
+        return None
+    age = time.time() - st.st_mtime
+    if age > REPORT_MAX_AGE:
+        return None
+    return {'taken_at': st.st_mtime, 'age': age, 'ident': (st.st_ino, st.st_mtime_ns)}
+
+
+def get_report_db():
+    """Admin hisobotlari va eksportlar uchun: snapshot yaroqli bo'lsa undan, aks holda jonli bazadan."""
+    info = report_snapshot_info()
+    if info is None:
+        return get_db()
+    conn = _report_pool.acquire(info['ident'])
+    if has_request_context() and g.get('sql_profile') is not None:
+        sql_profile_attach(conn)
+    return conn
+
+
+def report_freshness_html():
+    info = report_snapshot_info()
+    if info is None:
+        stale = ' (snapshot eskirgan)' if REPORT_INTERVAL > 0 else ''
+        return f'<span class="badge badge-success" style="font-size:.7rem;">🟢 Jonli{stale}</span>'
+    age = int(info['age'])
+    ago = f'{age // 60} daq' if age >= 60 else f'{age} s'
+    taken = datetime.datetime.fromtimestamp(info['taken_at']).strftime('%H:%M:%S')
+    return f'<span class="badge badge-pending" style="font-size:.7rem;" title="Snapshot {taken}">📸 {ago} oldin</span>'
+
+
+def refresh_report_snapshot():
+    """
+    Backup API bilan vaqtinchalik faylga nusxa (_copy_db: WAL o'qish snapshotidan — yozuvchilar kutmaydi),
+    so'ng os.replace. mtime nusxa boshlangan vaqtga qo'yiladi — ma'lumot kamida shu paytdagidek yangi.
+    """
+    started_at, started = time.time(), time.perf_counter()
+    tmp = f'{REPORT_DB_PATH}.{os.getpid()}.tmp'
+    try:
+        try:
+            stats = _copy_db(tmp, BACKUP_PAGES, BACKUP_STEP_SLEEP)
+        except BackupRestarted:
+            stats = dict(_copy_db(tmp, -1, 0), restarts=BACKUP_MAX_RESTARTS + 1, fallback=True)
+        os.utime(tmp, (started_at, started_at))
+        os.replace(tmp, REPORT_DB_PATH)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    took = time.perf_counter() - started
+    metric_observe('report_snapshot_seconds', took, buckets=(0.5, 1, 5, 15, 60))
+    return dict(stats, bytes=os.path.getsize(REPORT_DB_PATH), seconds=round(took, 3))
+
+
+def start_report_scheduler():
+    if REPORT_INTERVAL > 0:
+        start_leader_thread('report-snapshot', REPORT_LOCK_PATH, REPORT_INTERVAL, refresh_report_snapshot, "Hisobot snapshoti")
+
+
+@app.cli.command('refresh-report-snapshot')
+def refresh_report_snapshot_command():
+    """Hisobot snapshotini hozir yangilaydi (REPORT_INTERVAL > 0 bo'lganda ishlatiladi)."""
+    r = refresh_report_snapshot()
+    print(f"  ✅ {REPORT_DB_PATH}: {r['bytes'] / 1e6:.1f} MB, {r['seconds']:.1f} s ({r['restarts']} qayta boshlash)")
+
+
+# ═══════════════════════════════════════════════
+# ARCHIVE — eski yozuvlar alohida bazaga ko'chiriladi, tarix sahifalari uni talab bo'yicha o'qiydi
+# ═══════════════════════════════════════════════
+
+ARCHIVE_DB_PATH = os.environ.get('ARCHIVE_DB_PATH', 'elitemc_archive.db')
+ARCHIVE_AFTER_DAYS = int(os.environ.get('ARCHIVE_AFTER_DAYS', 180))
+ARCHIVE_INTERVAL = float(os.environ.get('ARCHIVE_INTERVAL', 0))  # soniya; 0 — faqat `flask archive` (cron)
+ARCHIVE_BATCH = 500  # bitta tranzaksiyada ko'chiriladigan qatorlar — yozuvchilar uzoq kutmaydi
+ARCHIVE_LOCK_PATH = 'elitemc.archive.lock'
+ARCHIVE_CURSOR = 'archive:'
+ARCHIVE_BUTTON = ('<button class="btn btn-secondary" data-target="{target}" data-url="{url}" onclick="loadArchive(this)">'
+                  '<i class="fas fa-box-archive"></i> Arxivdan yuklash</button>')
+# jadval -> (ko'chirish sharti, arxivdagi indeks); support_messages o'z murojaati bilan birga ko'chadi
+ARCHIVE_TABLES = {
+    'purchases': ("status IS NOT 'pending' AND created_at < :cutoff", 'user_id, created_at, id'),
+    'balance_deposits': ("status IN ('approved', 'rejected') AND created_at < :cutoff", 'user_id, created_at, id'),
+    'support_tickets': ("""status = 'closed' AND created_at < :cutoff AND NOT EXISTS
+                           (SELECT 1 FROM main.support_messages m WHERE m.ticket_id = support_tickets.id AND m.created_at >= :cutoff)""",
+                        'user_id, created_at, id'),
+    'support_messages': (None, 'ticket_id, id'),
+}
+
+
+def attach_archive(conn):
+    """
+    ARCHIVE_DB_PATH ni 'archive' sxemasi sifatida ulaydi (tranzaksiyadan tashqarida). Jadvallar asosiy
+    sxema ustunlaridan yaratiladi, keyin qo'shilgan ustunlar ALTER bilan to'ldiriladi.
+    """
+    conn.execute('ATTACH DATABASE ? AS archive', (ARCHIVE_DB_PATH,))
+    for table, (_, index_cols) in ARCHIVE_TABLES.items():
+        cols = conn.execute(f'PRAGMA main.table_info({table})').fetchall()
+        have = {r['name'] for r in conn.execute(f'PRAGMA archive.table_info({table})')}
+        if not have:
+            defs = ', '.join(f"{c['name']} {c['type']}{' PRIMARY KEY' if c['pk'] else ''}" for c in cols)
+            conn.execute(f'CREATE TABLE archive.{table} ({defs}, archived_at TIMESTAMP)')
+        for c in cols:
+            if have and c['name'] not in have:
+                conn.execute(f"ALTER TABLE archive.{table} ADD COLUMN {c['name']} {c['type']}")
+        conn.execute(f'CREATE INDEX IF NOT EXISTS archive.idx_{table}_archive ON {table} ({index_cols})')
+
+
+def with_archive(conn, table):
+    """FROM uchun manba: arxiv ulangan bo'lsa main va archive UNION ALL, aks holda jadvalning o'zi."""
+    if not any(r[1] == 'archive' for r in conn.execute('PRAGMA database_list')):
+        return table
+    cols = ', '.join(r[1] for r in conn.execute(f'PRAGMA main.table_info({table})'))
+    return f'(SELECT {cols} FROM main.{table} UNION ALL SELECT {cols} FROM archive.{table})'
+
+
+def db_pages(conn, schema='main'):
+    """(fayl hajmi, shundan bo'sh sahifalar) baytlarda."""
+    size = conn.execute(f'PRAGMA {schema}.page_size').fetchone()[0]
+    return (conn.execute(f'PRAGMA {schema}.page_count').fetchone()[0] * size,
+            conn.execute(f'PRAGMA {schema}.freelist_count').fetchone()[0] * size)
+
+
+def _copy_to_archive(conn, table, column, ids):
+    cols = ', '.join(r[1] for r in conn.execute(f'PRAGMA main.table_info({table})'))
+    marks = ','.join('?' * len(ids))
+    conn.execute(f'''INSERT OR REPLACE INTO archive.{table} ({cols}, archived_at)
+                     SELECT {cols}, CURRENT_TIMESTAMP FROM main.{table} WHERE {column} IN ({marks})''', ids)
+
+
+def _delete_archived(conn, table, column, ids, extra=''):
+    """Faqat arxivdagi nusxasi bilan ustunma-ustun bir xil qatorlar o'chadi — oraliqda o'zgargani keyingi yurishda qayta ko'chadi."""
+    same = ' AND '.join(f'a.{r[1]} IS {table}.{r[1]}' for r in conn.execute(f'PRAGMA main.table_info({table})'))
+    marks = ','.join('?' * len(ids))
+    return conn.execute(f'''DELETE FROM main.{table} WHERE {column} IN ({marks}) {extra}
+                            AND EXISTS (SELECT 1 FROM archive.{table} a WHERE a.id = {table}.id AND {same})''', ids).rowcount
+
+
+def archive_old_records(days=None, batch=ARCHIVE_BATCH):
+    """
+    ARCHIVE_TABLES shartiga mos yozuvlarni arxivga ko'chiradi. WAL da ATTACH qilingan bazalar orasida
+    commit atomik emas, shuning uchun har bir partiya ikki bosqichda: avval arxivga nusxa (INSERT OR REPLACE —
+    takrorlansa ham zararsiz) commit qilinadi, so'ng BEGIN IMMEDIATE da asosiy bazadan arxivdagi bilan bir xil
+    qatorlar o'chiriladi. Oraliqda uzilsa yozuv yo'qolmaydi — vaqtincha ikkala bazada turadi va keyingi yurishda
+    o'chadi (eksport id bo'yicha birlashtiradi). archive_in_progress bayrog'i user_stats va revenue_daily
+    triggerlarini o'chirishdan saqlaydi — umumiy summalar o'zgarmaydi.
+    """
+    started = time.perf_counter()
+    days = ARCHIVE_AFTER_DAYS if days is None else days
+    conn = get_db()
+    attach_archive(conn)
+    cutoff = conn.execute("SELECT datetime('now', ?)", (f'-{days} days',)).fetchone()[0]
+    moved, batches = dict.fromkeys(ARCHIVE_TABLES, 0), 0
+    try:
+        for table, (where, _) in ARCHIVE_TABLES.items():
+            after = 0
+            while where:
+                conn.execute('BEGIN')
+                ids = [r[0] for r in conn.execute(f'SELECT id FROM main.{table} WHERE id > :after AND {where} ORDER BY id LIMIT :batch',
+                                                  {'after': after, 'cutoff': cutoff, 'batch': batch})]
+                if not ids:
+                    conn.rollback()
+                    break
+                if table == 'support_tickets':
+                    _copy_to_archive(conn, 'support_messages', 'ticket_id', ids)
+                _copy_to_archive(conn, table, 'id', ids)
+                conn.commit()
+
+                conn.execute('BEGIN IMMEDIATE')
+                conn.execute('INSERT INTO archive_in_progress (flag) VALUES (1)')
+                if table == 'support_tickets':
+                    moved['support_messages'] += _delete_archived(conn, 'support_messages', 'ticket_id', ids)
+                    # oraliqda yangi xabar olgan murojaat asosiy bazada qoladi
+                    moved[table] += _delete_archived(conn, table, 'id', ids, extra='''AND NOT EXISTS
+                        (SELECT 1 FROM main.support_messages m WHERE m.ticket_id = support_tickets.id)''')
+                else:
+                    moved[table] += _delete_archived(conn, table, 'id', ids)
+                conn.execute('DELETE FROM archive_in_progress')
+                conn.commit()
+                after, batches = ids[-1], batches + 1
+    finally:
+        conn.close()
+    return {'cutoff': cutoff, 'moved': moved, 'batches': batches, 'seconds': round(time.perf_counter() - started, 3)}
+
+
+def open_archive():
+    """Arxivga faqat o'qish uchun ulanish; arxiv hali yaratilmagan bo'lsa None."""
+    if not os.path.exists(ARCHIVE_DB_PATH):
+        return None
+    conn = sqlite3.connect(pathlib.Path(ARCHIVE_DB_PATH).absolute().as_uri() + '?mode=ro', uri=True,
+                           factory=InstrumentedConnection)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+def archive_newest(table):
+    """Arxivga ko'chirilgan eng yangi yozuv sanasi (id bo'yicha oxirgisi) yoki None."""
+    conn = open_archive()
+    if conn is None:
+        return None
+    try:
+        row = conn.execute(f'SELECT created_at FROM {table} ORDER BY id DESC LIMIT 1').fetchone()
+    except sqlite3.OperationalError:
+        return None
+    finally:
+        conn.close()
+    return row[0] if row else None
+
+
+def archive_page(table, user_id, before=''):
+    """Arxivdan keyset sahifa — issiq bazadagi bilan bir xil (qatorlar, kursor); kursor ARCHIVE_CURSOR bilan."""
+    conn = open_archive()
+    if conn is None:
+        return [], None
+    try:
+        page, cursor = keyset_page(conn, table, user_id, before)
+    finally:
+        conn.close()
+    return page, (ARCHIVE_CURSOR + cursor if cursor else None)
+
+
+def archived_ticket(conn, ticket_id):
+    """Arxivdagi murojaat va xabarlari; username lar asosiy bazadan (conn) olinadi."""
+    arch = open_archive()
+    if arch is None:
+        return None, []
+    try:
+        ticket = arch.execute('SELECT * FROM support_tickets WHERE id=?', (ticket_id,)).fetchone()
+        messages = [dict(m) for m in arch.execute('SELECT * FROM support_messages WHERE ticket_id=? ORDER BY created_at, id',
+                                                  (ticket_id,))] if ticket else []
+    finally:
+        arch.close()
+    uids = list({m['user_id'] for m in messages})
+    names = {r['id']: r['username'] for r in conn.execute(
+        f"SELECT id, username FROM users WHERE id IN ({','.join('?' * len(uids))})", uids)} if uids else {}
+    for m in messages:
+        m['username'] = names.get(m['user_id'], '?')
+    return ticket, messages
+
+
+def _scheduled_archive():
+    r = archive_old_records()
+    if any(r['moved'].values()):
+        app.logger.info("Arxiv: %s (%.1f s)", r['moved'], r['seconds'])
+
+
+def start_archive_scheduler():
+    if ARCHIVE_INTERVAL > 0:
+        start_leader_thread('archive', ARCHIVE_LOCK_PATH, ARCHIVE_INTERVAL, _scheduled_archive, "Arxiv")
+
+
+@app.cli.command('archive')
+@click.option('--days', default=ARCHIVE_AFTER_DAYS, show_default=True, help="shundan eski yozuvlar ko'chiriladi")
+@click.option('--vacuum', is_flag=True, help="so'ng asosiy bazani VACUUM qilish (fayl kichrayadi, baza shu vaqt bloklanadi)")
+def archive_command(days, vacuum):
+    """Eski xaridlar, to'lovlar va yopilgan murojaatlarni ARCHIVE_DB_PATH ga ko'chiradi."""
+    conn = get_db()
+    size_before, free_before = db_pages(conn)
+    conn.close()
+    r = archive_old_records(days)
+    conn = get_db()
+    if vacuum:
+        conn.execute('VACUUM')
+    size_after, free_after = db_pages(conn)
+    conn.close()
+    print(f"  ✅ {r['cutoff']} dan eski: {', '.join(f'{t} {n}' for t, n in r['moved'].items())} ({r['batches']} partiya, {r['seconds']:.1f} s)")
+    print(f"  📦 Asosiy baza: {size_before / 1e6:.1f} MB ({(size_before - free_before) / 1e6:.1f} MB band)"
+          f" -> {size_after / 1e6:.1f} MB ({(size_after - free_after) / 1e6:.1f} MB band)")
+
+
 # ═══════════════════════════════════════════════
 # ADMIN RANK API ROUTES
 # ═══════════════════════════════════════════════
 
+PACKAGE_FIELDS = ('category', 'name', 'description', 'price', 'duration', 'features', 'color', 'is_active', 'sort_order')
+PACKAGE_DEFAULTS = {'description': '', 'price': 0, 'duration': '', 'features': '', 'color': '#3b82f6', 'is_active': 1}
+
+
+def catalog_version(conn) -> int:
+    row = conn.execute("SELECT value FROM settings WHERE key='catalog_version'").fetchone()
+    return int(row['value']) if row else 0
+
+
+def bump_catalog_version(conn) -> int:
+    conn.execute("UPDATE settings SET value=CAST(value AS INTEGER)+1 WHERE key='catalog_version'")
+    return catalog_version(conn)
+
+
+def _package_fields(data, create=False):
+    if not isinstance(data, dict):
+        raise ValueError("data obyekt bo'lishi kerak")
+    fields = {k: data[k] for k in PACKAGE_FIELDS if k in data}
+    if create:
+        fields = {**PACKAGE_DEFAULTS, **fields}
+        if not fields.get('name') or not fields.get('category'):
+            raise ValueError("Yangi rank uchun name va category majburiy")
+    if 'price' in fields:
+        fields['price'] = float(fields['price'])
+    for k in ('is_active', 'sort_order'):
+        if k in fields:
+            fields[k] = int(fields[k])
+    return fields
+
+
+@app.route('/admin/api/packages/bulk', methods=['POST'])
+@admin_required
+def packages_bulk():
+    """
+    {version, ops: [{op: 'create', data}, {op: 'update', id, data}, {op: 'delete', id},
+                    {op: 'activate' | 'deactivate', ids: [...]}]} — barchasi bitta tranzaksiyada.
+    version joriy katalog versiyasidan farq qilsa 409 (boshqa admin o'zgartirgan), hech narsa yozilmaydi.
+    Javob: yangi version, o'zgargan qatorlar (changed) va o'chirilgan id lar (deleted).
+    """
+    data = request.get_json(force=True, silent=True) or {}
+    ops = data.get('ops')
+    if not isinstance(ops, list) or not ops:
+        return jsonify(success=False, message="ops ro'yxati bo'sh"), 400
+
+    conn = get_db()
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        current = catalog_version(conn)
+        if data.get('version') is not None and int(data['version']) != current:
+            conn.rollback()
+            return jsonify(success=False, version=current,
+                           message="Katalog boshqa admin tomonidan o'zgartirilgan, ro'yxat yangilandi"), 409
+
+        changed, deleted = set(), set()
+        for op in ops:
+            if not isinstance(op, dict):
+                raise ValueError("Har bir amal obyekt bo'lishi kerak")
+            kind = op.get('op')
+            if kind == 'create':
+                fields = _package_fields(op.get('data'), create=True)
+                cur = conn.execute(f"INSERT INTO packages ({', '.join(fields)}) VALUES ({', '.join('?' * len(fields))})",
+                                   list(fields.values()))
+                changed.add(cur.lastrowid)
+            elif kind == 'update':
+                fields = _package_fields(op.get('data'))
+                pid = int(op['id'])
+                if fields and conn.execute(f"UPDATE packages SET {', '.join(f'{k}=?' for k in fields)} WHERE id=?",
+                                           [*fields.values(), pid]).rowcount == 0:
+                    raise ValueError(f"#{pid} rank topilmadi")
+                changed.add(pid)
+            elif kind == 'delete':
+                pid = int(op['id'])
+                conn.execute('DELETE FROM packages WHERE id=?', (pid,))
+                deleted.add(pid)
+            elif kind in ('activate', 'deactivate'):
+                ids = [int(i) for i in op.get('ids') or []]
+                if ids:
+                    conn.execute(f"UPDATE packages SET is_active=? WHERE id IN ({','.join('?' * len(ids))})",
+                                 [1 if kind == 'activate' else 0, *ids])
+                    changed.update(ids)
+            else:
+                raise ValueError(f"Noma'lum amal: {kind}")
+
+        version = bump_catalog_version(conn)
+        changed -= deleted
+        rows = [dict(r) for r in conn.execute(
+            f"SELECT * FROM packages WHERE id IN ({','.join('?' * len(changed))})", list(changed)).fetchall()] if changed else []
+        conn.commit()
+    except (ValueError, TypeError, KeyError, sqlite3.IntegrityError) as e:
+        conn.rollback()
+        return jsonify(success=False, message=str(e)), 400
+    finally:
+        conn.close()
+    return jsonify(success=True, version=version, changed=rows, deleted=sorted(deleted),
+                   message=f"{len(ops)} ta amal bajarildi")
+
+
 @app.route('/admin/add_rank', methods=['POST'])
 @admin_required
 def add_rank():
@@ -2280,6 +5610,7 @@ def add_rank():
                      (data.get('category'), data.get('name'), data.get('description', ''),
                       data.get('price', 0), data.get('duration', ''), data.get('features', ''),
                       data.get('color', '#3b82f6'), data.get('is_active', 1)))
+        bump_catalog_version(conn)
         conn.commit()
         conn.close()
         return jsonify(success=True, message='Rank muvaffaqiyatli qo\'shildi!')
@@ -2296,6 +5627,7 @@ def edit_rank(rank_id):
         conn.execute("""UPDATE packages SET name=?, description=?, price=?, duration=?, features=?, color=?, category=?, is_active=? WHERE id=?""",
                      (data.get('name'), data.get('description'), data.get('price'), data.get('duration'),
                       data.get('features'), data.get('color'), data.get('category'), data.get('is_active', 1), rank_id))
+        bump_catalog_version(conn)
         conn.commit()
         conn.close()
         return jsonify(success=True, message='Rank muvaffaqiyatli yangilandi!')
@@ -2309,6 +5641,7 @@ def delete_rank(rank_id):
     try:
         conn = get_db()
         conn.execute('DELETE FROM packages WHERE id=?', (rank_id,))
+        bump_catalog_version(conn)
         conn.commit()
         conn.close()
         return jsonify(success=True, message='Rank o\'chirildi!')
@@ -2316,6 +5649,33 @@ def delete_rank(rank_id):
         return jsonify(success=False, message=str(e)), 500
 
 
+@app.route('/admin/grant', methods=['POST'])
+@admin_required
+def bulk_grant():
+    """Paketni bir nechta o'yinchiga bepul berish: {package_id, nicks: [...], server?}"""
+    data = request.get_json(force=True, silent=True) or {}
+    nicks = [sanitize(n) for n in data.get('nicks') or [] if n and sanitize(n)]
+    conn = get_db()
+    pkg = conn.execute('SELECT * FROM packages WHERE id=?', (data.get('package_id'),)).fetchone()
+    conn.close()
+    if not pkg:
+        return jsonify(success=False, message='Tovar topilmadi!')
+    if not nicks:
+        return jsonify(success=False, message="Iltimos, o'yinchi nikini kiriting!")
+
+    results = execute_purchases([(nick, pkg, data.get('server')) for nick in nicks])
+    done = sum(1 for ok, _ in results if ok)
+    if done:
+        conn = get_db()
+        for nick, (ok, _) in zip(nicks, results):
+            if ok:
+                record_entitlement(conn, None, None, nick, pkg)
+        conn.commit()
+        conn.close()
+    return jsonify(success=done == len(nicks), message=f"{done}/{len(nicks)} o'yinchiga {pkg['name']} berildi",
+                   results=[{'nick': nick, 'ok': ok, 'response': resp} for nick, (ok, resp) in zip(nicks, results)])
+
+
 @app.route('/admin/settings', methods=['GET', 'POST'])
 @admin_required
 def admin_settings():
@@ -2402,37 +5762,132 @@ def admin_settings():
 # STATIC / API / ENTRY
 # ═══════════════════════════════════════════════
 
+STATIC_FOLDER = os.path.join(app.root_path, 'static')
+STATIC_MAX_AGE = int(os.environ.get('STATIC_MAX_AGE', '3600'))
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+# '' — fayl baytlarini worker o'zi yuboradi; 'x-sendfile' (Apache/lighttpd) yoki 'x-accel' (nginx)
+SENDFILE_MODE = os.environ.get('SENDFILE_MODE', '')
+X_ACCEL_PREFIX = os.environ.get('X_ACCEL_PREFIX', '/_protected/')
+PRECOMPRESS_EXTENSIONS = {'.css', '.js', '.svg', '.json', '.txt', '.html', '.xml', '.map'}
+
+app.config['USE_X_SENDFILE'] = SENDFILE_MODE == 'x-sendfile'
+
+_static_versions = {}
+
+
+def static_url(filename: str) -> str:
+    """/static URL ga fayl mtime asosidagi ?v= qo'shadi — shunday URL larni abadiy keshlash mumkin."""
+    version = _static_versions.get(filename)
+    if version is None:
+        try:
+            version = format(int(os.path.getmtime(os.path.join(STATIC_FOLDER, filename))), 'x')
+        except OSError:
+            version = ''
+        _static_versions[filename] = version
+    return f"/static/{filename}?v={version}" if version else f"/static/{filename}"
+
+
+def serve_file(directory: str, filename: str, immutable: bool = False):
+    path = safe_join(directory, filename)
+    if path is None or not os.path.isfile(path):
+        abort(404)
+    mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+    ext = os.path.splitext(path)[1].lower()
+
+    send_path, encoding = path, None
+    if ext in PRECOMPRESS_EXTENSIONS:
+        for enc, suffix in (('br', '.br'), ('gzip', '.gz')):
+            if request.accept_encodings[enc] and os.path.isfile(path + suffix):
+                send_path, encoding = path + suffix, enc
+                break
+
+    if SENDFILE_MODE == 'x-accel':
+        # nginx faylni o'zi yuboradi (Range va If-Modified-Since ham o'sha tomonda)
+        rel = os.path.relpath(send_path, app.root_path).replace(os.sep, '/')
+        resp = Response(mimetype=mimetype)
+        resp.headers['X-Accel-Redirect'] = X_ACCEL_PREFIX + rel
+    else:
+        resp = send_file(send_path, mimetype=mimetype, conditional=True, etag=True,
+                         max_age=IMMUTABLE_MAX_AGE if immutable else STATIC_MAX_AGE)
+
+    if encoding:
+        resp.headers['Content-Encoding'] = encoding
+    if ext in PRECOMPRESS_EXTENSIONS:
+        resp.vary.add('Accept-Encoding')
+    resp.cache_control.no_cache = None
+    resp.cache_control.public = True
+    resp.cache_control.max_age = IMMUTABLE_MAX_AGE if immutable else STATIC_MAX_AGE
+    if immutable:
+        resp.cache_control.immutable = True
+    return resp
+
+
+@app.route('/static/<path:filename>')
+def static_files(filename):
+    return serve_file(STATIC_FOLDER, filename, immutable='v' in request.args)
+
+
 @app.route('/static/uploads/<path:filename>')
 def uploaded_file(filename):
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+    # Yuklangan fayl nomlari noyob (vaqt belgisi bilan) — tarkibi hech qachon o'zgarmaydi
+    return serve_file(app.config['UPLOAD_FOLDER'], filename, immutable=True)
+
+
+@app.cli.command('precompress-static')
+def precompress_static_command():
+    """static/ dagi matnli fayllar uchun .gz (va brotli bo'lsa .br) variantlarini yozadi."""
+    done = 0
+    for root, _, files in os.walk(STATIC_FOLDER):
+        if os.path.abspath(root).startswith(os.path.abspath(app.config['UPLOAD_FOLDER'])):
+            continue
+        for name in files:
+            if os.path.splitext(name)[1].lower() not in PRECOMPRESS_EXTENSIONS:
+                continue
+            path = os.path.join(root, name)
+            with open(path, 'rb') as f:
+                data = f.read()
+            with open(path + '.gz', 'wb') as f:
+                f.write(gzip.compress(data, 9))
+            if BROTLI_AVAILABLE:
+                with open(path + '.br', 'wb') as f:
+                    f.write(brotli.compress(data, quality=11))
+            done += 1
+    print(f"  ✅ {done} ta fayl siqildi")
 
 
 @app.route('/api/packages')
 def api_packages():
     conn = get_db()
     packages = [dict(row) for row in conn.execute('SELECT * FROM packages ORDER BY sort_order, category, price').fetchall()]
+    version = catalog_version(conn)
     conn.close()
-    return jsonify(packages)
+    resp = jsonify(packages)
+    resp.headers['X-Catalog-Version'] = str(version)
+    return resp
 
 
 @app.route('/api/stats')
 def api_stats():
     conn = get_db()
     tu = conn.execute('SELECT COUNT(*) as c FROM users WHERE is_admin=0').fetchone()['c']
-    tp = conn.execute('SELECT COUNT(*) as c FROM purchases').fetchone()['c']
-    tr = conn.execute('SELECT COALESCE(SUM(amount),0) as s FROM purchases').fetchone()['s']
+    tr, tp = analytics_totals(conn)
     conn.close()
     return jsonify(total_users=tu, total_purchases=tp, total_revenue=tr)
 
 
+@app.route('/admin/api/ratelimit')
+@admin_required
+def api_ratelimit_stats():
+    return jsonify(rate_limit_stats())
+
+
 @app.route('/api/update_stats', methods=['POST'])
+@rate_limited('ingest')
 def update_player_stats():
-    SECRET_TOKEN = "ssmernix_legend_teams"
-
     try:
         data = request.get_json(force=True, silent=True)
 
-        if not data or data.get('token') != SECRET_TOKEN:
+        if not data or data.get('token') != STATS_TOKEN:
             return jsonify(success=False, message="Xato token!")
 
         nick = data.get('nick')
@@ -2447,15 +5902,10 @@ def update_player_stats():
 
         conn = get_db()
         conn.execute('''INSERT INTO player_stats (minecraft_nick, server_type, kills, deaths, time_played, money)
-                        VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT(minecraft_nick, server_type) 
-                        DO UPDATE SET
-            kills=?,
-            deaths=?,
-            time_played=?,
-            money=?,
-            last_updated=CURRENT_TIMESTAMP''',
-                     (nick, srv, kills, deaths, time_played, money,
-                      kills, deaths, time_played, money))
+                        VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT(minecraft_nick, server_type)
+                        DO UPDATE SET kills=excluded.kills, deaths=excluded.deaths, time_played=excluded.time_played,
+                        money=excluded.money, last_updated=CURRENT_TIMESTAMP''',
+                     (nick, srv, kills, deaths, time_played, money))
         conn.commit()
         conn.close()
         return jsonify(success=True, message="Statistika yangilandi")
@@ -2464,15 +5914,54 @@ def update_player_stats():
         return jsonify(success=False, error=str(e))
 
 
-if not os.path.exists('elitemc.db'):
-    print("=" * 62)
-    print("  🔄 DATABASE YARATILMOQDA...")
-    print("=" * 62)
-    init_db()
-    print("  ✅ DATABASE TAYYOR!")
-    print("=" * 62)
+# ═══════════════════════════════════════════════
+# APP FACTORY — gunicorn --preload bilan xavfsiz ishga tushirish
+# ═══════════════════════════════════════════════
+
+_post_fork_callbacks = []
+
+
+def after_fork(fn):
+    """Har bir worker jarayonida fork dan keyin bajariladigan funksiyani ro'yxatga oladi."""
+    _post_fork_callbacks.append(fn)
+    return fn
+
+
+after_fork(start_expiry_scheduler)
+after_fork(start_backup_scheduler)
+after_fork(start_archive_scheduler)
+after_fork(start_report_scheduler)
+after_fork(start_reconcile_scheduler)
+
+
+def on_worker_start():
+    """gunicorn.conf.py dagi post_fork chaqiradi: ulanishlar va fon threadlari shu yerda ochiladi."""
+    for fn in _post_fork_callbacks:
+        fn()
+
+
+def create_app():
+    """
+    Kirish nuqtasi: gunicorn -c gunicorn.conf.py 'main:create_app()'.
+    --preload da master jarayonda bir marta bajariladi; ochiq DB ulanishi yoki thread qoldirmaydi.
+    """
+    started = time.perf_counter()
+    boot = ensure_schema() or {'bootstrapped': False}
+    db.pool.clear()
+    if boot['bootstrapped']:
+        print("=" * 62)
+        print(f"  ✅ DATABASE TAYYOR! (sxema v{SCHEMA_VERSION}: {boot['schema_ms']:.1f} ms,"
+              f" qulf kutish: {boot['lock_wait_ms']:.1f} ms, jami: {boot['total_ms']:.1f} ms)")
+        print("=" * 62)
+    app.config['STARTUP_MS'] = (time.perf_counter() - started) * 1000 + IMPORT_MS
+    return app
+
+
+IMPORT_MS = (time.perf_counter() - _IMPORT_STARTED) * 1000
 
 if __name__ == '__main__':
+    create_app()
+    on_worker_start()
     port = int(os.environ.get("PORT", 5000))
     print("=" * 62)
     print("  🎮  EliteMC.uz — Ultra Premium Donate Platform")
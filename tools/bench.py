@@ -0,0 +1,651 @@
+"""
+Saytning asosiy yo'llari uchun takrorlanadigan benchmark.
+
+Vaqtinchalik papkada sintetik baza yaratiladi (users, purchases, deposits, tickets/messages,
+player_stats), RCON va Server List Ping mahalliy soxta serverlarga (tools/fakemc.py) yo'naltiriladi,
+so'ng har bir ssenariy Flask test client va/yoki haqiqiy gunicorn orqali o'lchanadi.
+
+    python tools/bench.py --users 5000 --purchases 100000 --requests 500 --out bench.json
+    python tools/bench.py --mode gunicorn --workers 4 --concurrency 16 --baseline bench.json
+    python tools/bench.py --mode test_client --database-url sqlite:///:memory: --db-pool-size 0
+
+Natija: har bir ssenariy uchun throughput va p50/p95/p99 (ms) — JSON faylda.
+"""
+import argparse
+import contextlib
+import datetime
+import hashlib
+import json
+import os
+import random
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+
+TOOLS = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(TOOLS)
+sys.path.insert(0, TOOLS)
+sys.path.insert(0, ROOT)
+
+from fakemc import FakeRconServer, FakeStatusServer  # noqa: E402
+
+BENCH_USER = 'bench'
+BENCH_PASSWORD = 'bench-password'
+RCON_PASSWORD = 'bench-rcon'
+STATS_TOKEN = 'ssmernix_legend_teams'
+
+
+# ═══════════════════════════════════════════════
+# SEED
+# ═══════════════════════════════════════════════
+
+def seed_database(args, rcon_port, status_port):
+    """Joriy papkada elitemc.db ni yaratadi va sintetik ma'lumot bilan to'ldiradi."""
+    import main
+    main.create_app()
+    rng = random.Random(args.seed)
+    conn = main.get_db()
+    conn.execute('BEGIN')
+
+    settings = {'server_ip': f'127.0.0.1:{status_port}'}
+    for prefix in ('anarchy', 'smp'):
+        settings.update({f'{prefix}_rcon_host': '127.0.0.1', f'{prefix}_rcon_port': str(rcon_port),
+                         f'{prefix}_rcon_password': RCON_PASSWORD})
+    settings.update(rcon_host='127.0.0.1', rcon_port=str(rcon_port), rcon_password=RCON_PASSWORD)
+    conn.executemany('INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)', settings.items())
+
+    pw = hashlib.sha256(b'x').hexdigest()
+    conn.executemany('INSERT INTO users (username, email, password, balance, minecraft_nick, created_at) VALUES (?,?,?,?,?,?)',
+                     ((f'user{i}', f'user{i}@bench.local', pw, rng.randint(0, 200000), f'Player{i}',
+                       _ts(rng, args.days)) for i in range(args.users)))
+    conn.execute('INSERT INTO users (username, email, password, balance, minecraft_nick) VALUES (?,?,?,?,?)',
+                 (BENCH_USER, 'bench@bench.local', hashlib.sha256(BENCH_PASSWORD.encode()).hexdigest(), 1e12, 'BenchPlayer'))
+    bench_uid = conn.execute('SELECT id FROM users WHERE username=?', (BENCH_USER,)).fetchone()[0]
+    user_ids = [r[0] for r in conn.execute('SELECT id FROM users').fetchall()]
+    packages = [dict(r) for r in conn.execute('SELECT id, name, price, category FROM packages').fetchall()]
+
+    def purchase_row(uid):
+        p = rng.choice(packages)
+        return uid, p['id'], p['price'], p['name'], f'Player{uid}', _ts(rng, args.days), p['category']
+
+    conn.executemany('INSERT INTO purchases (user_id, package_id, amount, package_name, minecraft_nick, created_at, category) VALUES (?,?,?,?,?,?,?)',
+                     (purchase_row(rng.choice(user_ids)) for _ in range(args.purchases)))
+    conn.executemany('INSERT INTO purchases (user_id, package_id, amount, package_name, minecraft_nick, created_at, category) VALUES (?,?,?,?,?,?,?)',
+                     (purchase_row(bench_uid) for _ in range(args.heavy_purchases)))
+    conn.executemany('INSERT INTO balance_deposits (user_id, amount, card_number, transaction_id, status, created_at) VALUES (?,?,?,?,?,?)',
+                     ((rng.choice(user_ids), rng.randint(10, 500) * 1000, '8600 **** **** 0000', f'TXN{i}',
+                       rng.choice(('pending', 'approved', 'approved', 'rejected')), _ts(rng, args.days))
+                      for i in range(args.deposits)))
+
+    conn.executemany('INSERT INTO support_tickets (user_id, subject, status, created_at) VALUES (?,?,?,?)',
+                     ((rng.choice(user_ids), f'Murojaat {i}', rng.choice(('open', 'answered', 'closed')), _ts(rng, args.days))
+                      for i in range(args.tickets)))
+    conn.execute('INSERT INTO support_tickets (user_id, subject) VALUES (?, ?)', (bench_uid, 'Bench ticket'))
+    bench_ticket = conn.execute('SELECT MAX(id) FROM support_tickets').fetchone()[0]
+    ticket_rows = conn.execute('SELECT id, user_id FROM support_tickets').fetchall()
+    conn.executemany('INSERT INTO support_messages (ticket_id, user_id, message, is_admin_reply, created_at) VALUES (?,?,?,?,?)',
+                     ((t[0], t[1], f'Xabar matni {j} ' + 'lorem ipsum ' * rng.randint(1, 12), 0, _ts(rng, args.days))
+                      for t in ticket_rows for j in range(args.messages_per_ticket)))
+    conn.executemany('INSERT OR IGNORE INTO player_stats (minecraft_nick, server_type, kills, deaths, time_played, money) VALUES (?,?,?,?,?,?)',
+                     ((f'Player{i}', rng.choice(('anarchy', 'smp')), rng.randint(0, 5000), rng.randint(0, 5000),
+                       f'{rng.randint(0, 900)}h', rng.random() * 1e6) for i in range(args.stats)))
+    conn.commit()
+    conn.close()
+    rank = next(p for p in packages if p['name'] == 'VIP')
+    return {'bench_ticket': bench_ticket, 'rank_package': rank['id']}
+
+
+def _ts(rng, days):
+    moment = datetime.datetime.now() - datetime.timedelta(seconds=rng.randint(0, days * 86400))
+    return moment.strftime('%Y-%m-%d %H:%M:%S')
+
+
+# ═══════════════════════════════════════════════
+# SCENARIOS
+# ═══════════════════════════════════════════════
+
+def scenarios(ctx):
+    """(nom, method, path, json_body_factory, login_kerakmi)"""
+    counter = iter(range(10 ** 9))
+    return [
+        ('index', 'GET', '/', None, False),
+        ('shop', 'GET', '/shop', None, False),
+        ('api_packages', 'GET', '/api/packages', None, False),
+        ('profile', 'GET', '/profile', None, True),
+        ('balance', 'GET', '/balance', None, True),
+        ('support', 'GET', '/support', None, True),
+        ('support_messages', 'GET', f"/support/{ctx['bench_ticket']}/messages", None, True),
+        ('update_stats', 'POST', '/api/update_stats',
+         lambda: {'token': STATS_TOKEN, 'nick': f'Player{next(counter) % 5000}', 'server': 'anarchy',
+                  'kills': 10, 'deaths': 3, 'time_played': '12h', 'money': 1500}, False),
+        ('buy_rank', 'POST', f"/buy_rank/{ctx['rank_package']}", lambda: {'nick': 'BenchPlayer'}, True),
+        ('buy_token_custom', 'POST', '/buy_token_custom', lambda: {'amount': 500, 'nick': 'BenchPlayer'}, True),
+    ]
+
+
+def _is_error(status, body):
+    if status >= 400:
+        return True
+    if body[:1] == b'{':
+        try:
+            return json.loads(body).get('success') is False
+        except ValueError:
+            return False
+    return False
+
+
+def summarize(latencies, errors, wall):
+    lat = sorted(latencies)
+
+    def pct(p):
+        return round(lat[min(len(lat) - 1, int(round(p / 100 * len(lat) + 0.5)) - 1)] * 1000, 3) if lat else None
+
+    return {'requests': len(lat), 'errors': errors, 'throughput_rps': round(len(lat) / wall, 1) if wall else None,
+            'p50_ms': pct(50), 'p95_ms': pct(95), 'p99_ms': pct(99),
+            'mean_ms': round(sum(lat) / len(lat) * 1000, 3) if lat else None}
+
+
+# ═══════════════════════════════════════════════
+# RUNNERS
+# ═══════════════════════════════════════════════
+
+def run_test_client(ctx, args, only=None, tag='test_client'):
+    import main
+    results = {}
+    client = main.app.test_client()
+    client.post('/login', json={'username': BENCH_USER, 'password': BENCH_PASSWORD})
+    anon = main.app.test_client()
+    for name, method, path, body, auth in scenarios(ctx):
+        if only and name not in only:
+            continue
+        c = client if auth else anon
+        for _ in range(args.warmup):
+            c.open(path, method=method, json=body() if body else None)
+        latencies, errors = [], 0
+        wall_started = time.perf_counter()
+        for _ in range(args.requests):
+            started = time.perf_counter()
+            resp = c.open(path, method=method, json=body() if body else None)
+            latencies.append(time.perf_counter() - started)
+            errors += _is_error(resp.status_code, resp.get_data())
+        results[name] = summarize(latencies, errors, time.perf_counter() - wall_started)
+        print(f"  [{tag:<11}] {name:<18} {results[name]['throughput_rps']:>8} rps  p50 {results[name]['p50_ms']:>8} ms"
+              f"  p99 {results[name]['p99_ms']:>8} ms  err {errors}")
+    return results
+
+
+def _writer_load(db_path, rate, stop, out):
+    # Alohida jarayonda bevosita SQLite ga yozadi: backup/snapshot paytida commit qancha kutadi
+    import sqlite3
+    conn = sqlite3.connect(db_path, timeout=30)
+    latencies, errors = [], 0
+    started = time.perf_counter()
+    while not stop.is_set():
+        t = time.perf_counter()
+        try:
+            conn.execute("INSERT INTO support_messages (ticket_id, user_id, message) VALUES (1, 1, 'bench yozuvchi')")
+            conn.commit()
+        except sqlite3.OperationalError:
+            errors += 1
+        took = time.perf_counter() - t
+        latencies.append(took)
+        time.sleep(max(0.0, 1 / rate - took))
+    out.send(dict(summarize(latencies, errors, time.perf_counter() - started),
+                  max_ms=round(max(latencies, default=0) * 1000, 3)))
+
+
+@contextlib.contextmanager
+def writer_load(args, tag):
+    """--writer-rate > 0 bo'lsa blok davomida parallel yozuvchi; natija blokdan keyin qaytgan dict da."""
+    import multiprocessing
+    import main
+    result = {}
+    if args.writer_rate <= 0 or main.db.memory:
+        yield result
+        return
+    mp = multiprocessing.get_context('fork')
+    stop, (recv, send) = mp.Event(), mp.Pipe(duplex=False)
+    proc = mp.Process(target=_writer_load, args=(main.DB_PATH, args.writer_rate, stop, send))
+    proc.start()
+    try:
+        yield result
+    finally:
+        stop.set()
+        result.update(recv.recv())
+        proc.join()
+        print(f"  [{tag:<11}] yozuvchi {args.writer_rate:g}/s: p50 {result['p50_ms']} ms  p99 {result['p99_ms']} ms"
+              f"  max {result['max_ms']} ms  err {result['errors']}")
+
+
+def run_backup(ctx, args):
+    """
+    O'qish/yozish ssenariylari va parallel yozuvchi kechikishi: backupsiz va har bir --backup-pages
+    qiymati bilan create_backup() to'xtovsiz takrorlanib turganda (alohida threadda).
+    """
+    import main
+    only = ('profile', 'support_messages', 'update_stats', 'buy_rank')
+    db_mb = os.path.getsize(main.DB_PATH) / 1e6
+    print(f"  [backup]      baza {db_mb:.1f} MB")
+    with writer_load(args, 'baseline') as writer:
+        results = {'db_mb': round(db_mb, 1), 'baseline': run_test_client(ctx, args, only, 'baseline')}
+    results['baseline']['writer'] = writer
+    for pages in args.backup_pages:
+        stop, runs = threading.Event(), []
+
+        def loop():
+            while not stop.is_set():
+                runs.append(main.create_backup(pages=pages))
+
+        t = threading.Thread(target=loop)
+        t.start()
+        tag = f'pages={pages}'
+        with writer_load(args, tag) as writer:
+            results[tag] = run_test_client(ctx, args, only, tag)
+        stop.set()
+        t.join()
+        results[tag]['writer'] = writer
+        results[tag]['backups'] = {
+            'count': len(runs), 'mean_copy_s': round(sum(r['copy_s'] for r in runs) / len(runs), 3),
+            'mean_total_s': round(sum(r['total_s'] for r in runs) / len(runs), 3),
+            'restarts': sum(r['restarts'] for r in runs), 'fallbacks': sum(1 for r in runs if r.get('fallback')),
+            'compressed_mb': round(runs[-1]['bytes'] / 1e6, 1),
+        }
+        print(f"  [{tag:<11}] {results[tag]['backups']}")
+    return results
+
+
+def _report_load(interval, stop, rounds):
+    # Alohida jarayonda: GIL yozuvchilar bilan bo'linmaydi, farq faqat SQLite qulflaridan keladi
+    import main
+    main.REPORT_INTERVAL, main.REPORT_MAX_AGE = interval, 3 * interval
+    admin = main.app.test_client()
+    with admin.session_transaction() as s:
+        s['user_id'], s['is_admin'] = 1, True
+    while not stop.is_set():
+        for dataset in ('purchases', 'deposits', 'users'):
+            admin.get(f'/admin/export/{dataset}.csv').get_data()
+        admin.get('/admin/api/analytics?days=365&dimension=package')
+        with rounds.get_lock():
+            rounds.value += 1
+
+
+def run_report(ctx, args):
+    """
+    Yozuvchilar kechikishi: hisobotlarsiz, eksport/analitika jonli bazadan va snapshotdan uzluksiz o'qilganda,
+    hamda snapshot to'xtovsiz yangilanib turganda.
+    """
+    import multiprocessing
+    import main
+    only = ('update_stats', 'buy_rank', 'buy_token_custom')
+    with writer_load(args, 'baseline') as writer:
+        results = {'baseline': run_test_client(ctx, args, only, 'baseline')}
+    results['baseline']['writer'] = writer
+    stop, refreshes = threading.Event(), []
+
+    def loop():
+        while not stop.is_set():
+            refreshes.append(main.refresh_report_snapshot())
+
+    t = threading.Thread(target=loop)
+    t.start()
+    with writer_load(args, 'refreshing') as writer:
+        results['refreshing'] = run_test_client(ctx, args, only, 'refreshing')
+    stop.set()
+    t.join()
+    results['refreshing'].update(writer=writer, refreshes=len(refreshes),
+                                 restarts=sum(r['restarts'] for r in refreshes),
+                                 fallbacks=sum(1 for r in refreshes if r.get('fallback')),
+                                 mean_refresh_s=round(sum(r['seconds'] for r in refreshes) / len(refreshes), 3))
+    print(f"  [refreshing ] {len(refreshes)} yangilash, qayta boshlash {results['refreshing']['restarts']}")
+    mp = multiprocessing.get_context('fork')
+    for tag, interval in (('live', 0), ('snapshot', 3600)):
+        if interval:
+            results['refresh'] = main.refresh_report_snapshot()
+            print(f"  [refresh    ] {results['refresh']}")
+        stop, rounds = mp.Event(), mp.Value('i', 0)
+        procs = [mp.Process(target=_report_load, args=(interval, stop, rounds)) for _ in range(args.report_readers)]
+        for p in procs:
+            p.start()
+        with writer_load(args, tag) as writer:
+            results[tag] = run_test_client(ctx, args, only, tag)
+        stop.set()
+        for p in procs:
+            p.join()
+        results[tag]['writer'] = writer
+        results[tag]['report_rounds'] = rounds.value
+        print(f"  [{tag:<11}] {rounds.value} hisobot aylanishi")
+    return results
+
+
+def run_archive(ctx, args):
+    """Tarix sahifalari va asosiy baza hajmi: --archive-days dan eski yozuvlar arxivga ko'chirilib, VACUUM dan oldin va keyin."""
+    import main
+    only = ('index', 'profile', 'balance', 'support', 'support_messages')
+
+    def sizes():
+        conn = main.get_db()
+        size, free = main.db_pages(conn)
+        conn.close()
+        return {'db_mb': round(size / 1e6, 1), 'used_mb': round((size - free) / 1e6, 1)}
+
+    results = {'before': {**sizes(), **run_test_client(ctx, args, only, 'before')}}
+    moved = main.archive_old_records(args.archive_days)
+    conn = main.get_db()
+    started = time.perf_counter()
+    conn.execute('VACUUM')
+    vacuum_s = round(time.perf_counter() - started, 3)
+    conn.close()
+    results['archive'] = {**moved, 'vacuum_s': vacuum_s, 'archive_mb': round(os.path.getsize(main.ARCHIVE_DB_PATH) / 1e6, 1)}
+    print(f"  [archive    ] {results['archive']}")
+    results['after'] = {**sizes(), **run_test_client(ctx, args, only, 'after')}
+    print(f"  [archive    ] baza {results['before']['db_mb']} MB -> {results['after']['db_mb']} MB")
+    return results
+
+
+class HttpSession:
+    """Minimal urllib klient; session cookie Secure bo'lgani uchun uni qo'lda yuboramiz."""
+
+    def __init__(self, base):
+        self.base = base
+        self.cookie = None
+
+    def request(self, method, path, body=None):
+        data = json.dumps(body).encode() if body is not None else None
+        req = urllib.request.Request(self.base + path, data=data, method=method)
+        if data is not None:
+            req.add_header('Content-Type', 'application/json')
+        if self.cookie:
+            req.add_header('Cookie', self.cookie)
+        try:
+            with urllib.request.urlopen(req, timeout=30) as resp:
+                status, payload, headers = resp.status, resp.read(), resp.headers
+        except urllib.error.HTTPError as e:
+            status, payload, headers = e.code, e.read(), e.headers
+        set_cookie = headers.get('Set-Cookie')
+        if set_cookie:
+            self.cookie = set_cookie.split(';', 1)[0]
+        return status, payload
+
+
+def run_rcon(args, rcon_port):
+    """Har bir buyruq uchun alohida ulanish (rcon_command) va pipelining (rcon_batch) taqqoslanadi."""
+    import main
+    main.create_app()
+    cmds = [f'lp user Bench{i} parent set VIP' for i in range(args.rcon_commands)]
+    results = {}
+
+    latencies, errors = [], 0
+    wall_started = time.perf_counter()
+    for cmd in cmds:
+        started = time.perf_counter()
+        try:
+            main.rcon_command('127.0.0.1', rcon_port, RCON_PASSWORD, cmd, server='bench')
+        except main.RconError:
+            errors += 1
+        latencies.append(time.perf_counter() - started)
+    results['per_command'] = summarize(latencies, errors, time.perf_counter() - wall_started)
+
+    for size in args.rcon_batch_sizes:
+        latencies, errors = [], 0
+        wall_started = time.perf_counter()
+        for i in range(0, len(cmds), size):
+            started = time.perf_counter()
+            out = main.rcon_batch('127.0.0.1', rcon_port, RCON_PASSWORD, cmds[i:i + size], server='bench')
+            latencies.append(time.perf_counter() - started)
+            errors += sum(1 for ok, _ in out if not ok)
+        results[f'batch_{size}'] = summarize(latencies, errors, time.perf_counter() - wall_started)
+
+    for name, r in results.items():
+        wall = r['requests'] / r['throughput_rps'] if r['throughput_rps'] else None
+        r['commands_per_s'] = round(len(cmds) / wall, 1) if wall else None
+        print(f"  [rcon]        {name:<18} {r['commands_per_s']:>8} cmd/s  p50 {r['p50_ms']:>8} ms  err {r['errors']}")
+    return results
+
+
+def run_expiry(args, rcon_port):
+    """
+    Katta sintetik navbat: --expiry-backlog ta muddati o'tgan va 10 baravar ko'p hali amal qiluvchi
+    rank. process_expirations partiyalari (revocations/s) va bitta partiyani tanlash vaqti o'lchanadi.
+    """
+    import main
+    main.create_app()
+    conn = main.get_db()
+    conn.execute('BEGIN')
+    settings = {}
+    for prefix in ('anarchy', 'smp'):
+        settings.update({f'{prefix}_rcon_host': '127.0.0.1', f'{prefix}_rcon_port': str(rcon_port),
+                         f'{prefix}_rcon_password': RCON_PASSWORD})
+    conn.executemany('INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)', settings.items())
+    rng = random.Random(args.seed)
+
+    def row(i, offset):
+        return (f'Player{i}', rng.choice(('anarchy', 'smp')), rng.choice(('VIP', 'MVP', 'Legend')), offset)
+
+    conn.executemany("INSERT INTO entitlements (minecraft_nick, server, package_name, expires_at) VALUES (?, ?, ?, datetime('now', ?))",
+                     (row(i, f'-{rng.randint(1, 86400 * 30)} seconds') for i in range(args.expiry_backlog)))
+    conn.executemany("INSERT INTO entitlements (minecraft_nick, server, package_name, expires_at) VALUES (?, ?, ?, datetime('now', ?))",
+                     (row(i, f'+{rng.randint(60, 86400 * 90)} seconds') for i in range(args.expiry_backlog, args.expiry_backlog * 11)))
+    conn.commit()
+
+    started = time.perf_counter()
+    for _ in range(20):
+        conn.execute('''SELECT id FROM entitlements WHERE status = 'active' AND expires_at <= CURRENT_TIMESTAMP
+                          AND (retry_at IS NULL OR retry_at <= CURRENT_TIMESTAMP) ORDER BY expires_at LIMIT ?''',
+                     (args.expiry_batch,)).fetchall()
+    select_ms = (time.perf_counter() - started) / 20 * 1000
+    conn.close()
+
+    latencies, revoked, failed = [], 0, 0
+    wall_started = time.perf_counter()
+    while True:
+        started = time.perf_counter()
+        done, errors = main.process_expirations(args.expiry_batch)
+        if not done and not errors:
+            break
+        latencies.append(time.perf_counter() - started)
+        revoked += done
+        failed += errors
+        if not done:
+            break
+    wall = time.perf_counter() - wall_started
+    result = summarize(latencies, failed, wall)
+    result.update(backlog=args.expiry_backlog, revoked=revoked, batch=args.expiry_batch,
+                  revocations_per_s=round(revoked / wall, 1) if wall else None, select_batch_ms=round(select_ms, 3))
+    print(f"  [expiry]      {revoked}/{args.expiry_backlog} {result['revocations_per_s']:>8} rank/s  "
+          f"partiya p50 {result['p50_ms']} ms  tanlash {result['select_batch_ms']} ms  xato {failed}")
+    return result
+
+
+def run_gunicorn(ctx, args, workdir):
+    port = _free_port()
+    env = dict(os.environ, PORT=str(port), WEB_CONCURRENCY=str(args.workers), RATELIMIT_ENABLED='0')
+    proc = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '-c', os.path.join(ROOT, 'gunicorn.conf.py'),
+         '--chdir', workdir, '--pythonpath', ROOT, '--threads', str(args.threads), 'main:create_app()'],
+        env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    base = f'http://127.0.0.1:{port}'
+    try:
+        _wait_http(base + '/api/stats', 30)
+        results = {}
+        for name, method, path, body, auth in scenarios(ctx):
+            per_thread = max(1, args.requests // args.concurrency)
+            latencies, errors = [], [0]
+            lock = threading.Lock()
+
+            def worker():
+                s = HttpSession(base)
+                if auth:
+                    s.request('POST', '/login', {'username': BENCH_USER, 'password': BENCH_PASSWORD})
+                for _ in range(args.warmup):
+                    s.request(method, path, body() if body else None)
+                local, local_err = [], 0
+                barrier.wait()
+                for _ in range(per_thread):
+                    started = time.perf_counter()
+                    status, payload = s.request(method, path, body() if body else None)
+                    local.append(time.perf_counter() - started)
+                    local_err += _is_error(status, payload)
+                with lock:
+                    latencies.extend(local)
+                    errors[0] += local_err
+
+            barrier = threading.Barrier(args.concurrency + 1)
+            threads = [threading.Thread(target=worker) for _ in range(args.concurrency)]
+            for t in threads:
+                t.start()
+            barrier.wait()
+            wall_started = time.perf_counter()
+            for t in threads:
+                t.join()
+            results[name] = summarize(latencies, errors[0], time.perf_counter() - wall_started)
+            print(f"  [gunicorn]    {name:<18} {results[name]['throughput_rps']:>8} rps  p50 {results[name]['p50_ms']:>8} ms"
+                  f"  p99 {results[name]['p99_ms']:>8} ms  err {errors[0]}")
+        return results
+    finally:
+        proc.send_signal(signal.SIGTERM)
+        proc.wait(timeout=15)
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _wait_http(url, timeout):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            urllib.request.urlopen(url, timeout=1).read()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f'{url} javob bermadi')
+
+
+def compare(results, baseline_path):
+    with open(baseline_path) as f:
+        baseline = json.load(f)['results']
+    print(f"\n  Baseline bilan taqqoslash ({baseline_path}):")
+    for mode, scen in results.items():
+        for name, cur in scen.items():
+            old = baseline.get(mode, {}).get(name)
+            if not old or not old.get('p95_ms') or not cur.get('p95_ms'):
+                continue
+            d_p95 = (cur['p95_ms'] - old['p95_ms']) / old['p95_ms'] * 100
+            d_rps = (cur['throughput_rps'] - old['throughput_rps']) / old['throughput_rps'] * 100
+            flag = '  ⚠️' if d_p95 > 10 else ''
+            print(f"    {mode:<11} {name:<18} p95 {d_p95:+6.1f}%  rps {d_rps:+6.1f}%{flag}")
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument('--mode', choices=('test_client', 'gunicorn', 'both', 'rcon', 'expiry', 'backup', 'archive', 'report'), default='both')
+    ap.add_argument('--users', type=int, default=2000)
+    ap.add_argument('--purchases', type=int, default=20000)
+    ap.add_argument('--heavy-purchases', type=int, default=500, help="bench foydalanuvchisining xaridlari (/profile)")
+    ap.add_argument('--deposits', type=int, default=5000)
+    ap.add_argument('--tickets', type=int, default=1000)
+    ap.add_argument('--messages-per-ticket', type=int, default=10)
+    ap.add_argument('--stats', type=int, default=2000)
+    ap.add_argument('--days', type=int, default=365)
+    ap.add_argument('--requests', type=int, default=300, help='har bir ssenariy uchun')
+    ap.add_argument('--warmup', type=int, default=5)
+    ap.add_argument('--workers', type=int, default=4)
+    ap.add_argument('--threads', type=int, default=1)
+    ap.add_argument('--concurrency', type=int, default=8)
+    ap.add_argument('--seed', type=int, default=1)
+    ap.add_argument('--rcon-latency-ms', type=float, default=0, help='soxta serverning javob kechikishi')
+    ap.add_argument('--rcon-error-rate', type=float, default=0)
+    ap.add_argument('--rcon-commands', type=int, default=1000, help='--mode rcon uchun')
+    ap.add_argument('--rcon-batch-sizes', type=lambda v: [int(x) for x in v.split(',')], default=[10, 100])
+    ap.add_argument('--status-latency-ms', type=float, default=0)
+    ap.add_argument('--expiry-backlog', type=int, default=20000, help="--mode expiry: muddati o'tgan rank'lar soni")
+    ap.add_argument('--expiry-batch', type=int, default=500)
+    ap.add_argument('--backup-pages', type=lambda v: [int(x) for x in v.split(',')], default=[256, -1],
+                    help="--mode backup: bir qadamdagi sahifalar (-1: bitta qadam)")
+    ap.add_argument('--archive-days', type=int, default=90, help="--mode archive: shundan eski yozuvlar ko'chiriladi")
+    ap.add_argument('--writer-rate', type=float, default=100,
+                    help="--mode backup/report: alohida jarayondagi yozuvchi, INSERT/s (0 — o'chiq)")
+    ap.add_argument('--report-readers', type=int, default=1, help="--mode report: parallel hisobot jarayonlari")
+    ap.add_argument('--database-url', help="DATABASE_URL (masalan sqlite:///:memory: — faqat test_client; gunicorn workerlari bazani ulashmaydi)")
+    ap.add_argument('--db-pool-size', type=int, help='DB_POOL_SIZE; 0 — har so\'rovda yangi ulanish')
+    ap.add_argument('--out', default='bench_results.json')
+    ap.add_argument('--baseline', help='oldingi natija fayli bilan taqqoslash')
+    ap.add_argument('--keep', action='store_true', help="vaqtinchalik papkani o'chirmaslik")
+    args = ap.parse_args()
+
+    out_path = os.path.abspath(args.out)
+    baseline_path = os.path.abspath(args.baseline) if args.baseline else None
+    workdir = tempfile.mkdtemp(prefix='elitemc-bench-')
+    rcon = FakeRconServer(password=RCON_PASSWORD, latency=args.rcon_latency_ms / 1000,
+                          error_rate=args.rcon_error_rate, seed=args.seed).start()
+    status = FakeStatusServer(latency=args.status_latency_ms / 1000, seed=args.seed).start()
+    os.environ['RATELIMIT_ENABLED'] = '0'
+    if args.database_url:
+        os.environ['DATABASE_URL'] = args.database_url
+    if args.db_pool_size is not None:
+        os.environ['DB_POOL_SIZE'] = str(args.db_pool_size)
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    seed_s = 0.0
+    try:
+        results = {}
+        if args.mode == 'rcon':
+            results['rcon'] = run_rcon(args, rcon.port)
+        elif args.mode == 'expiry':
+            results['expiry'] = run_expiry(args, rcon.port)
+        else:
+            seed_started = time.perf_counter()
+            ctx = seed_database(args, rcon.port, status.port)
+            seed_s = time.perf_counter() - seed_started
+            print(f"  Baza tayyor: {seed_s:.1f} s ({workdir})")
+        if args.mode in ('test_client', 'both'):
+            results['test_client'] = run_test_client(ctx, args)
+        if args.mode in ('gunicorn', 'both'):
+            results['gunicorn'] = run_gunicorn(ctx, args, workdir)
+        if args.mode == 'backup':
+            results['backup'] = run_backup(ctx, args)
+        if args.mode == 'archive':
+            results['archive'] = run_archive(ctx, args)
+        if args.mode == 'report':
+            results['report'] = run_report(ctx, args)
+    finally:
+        os.chdir(cwd)
+        rcon.stop()
+        status.stop()
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        'meta': {
+            'git': git_revision(), 'python': sys.version.split()[0],
+            'at': datetime.datetime.now().isoformat(timespec='seconds'),
+            'seed_seconds': round(seed_s, 2), 'rcon_commands': len(rcon.commands), 'rcon_stats': rcon.stats,
+            'params': {k: v for k, v in vars(args).items() if k not in ('out', 'baseline', 'keep')},
+        },
+        'results': results,
+    }
+    with open(out_path, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"  → {out_path}")
+    if baseline_path:
+        compare(results, baseline_path)
+
+
+if __name__ == '__main__':
+    main()
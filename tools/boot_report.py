@@ -0,0 +1,118 @@
+"""
+Worker ishga tushish vaqti va xotirasini o'lchaydi: --preload bilan va usiz.
+
+    python tools/boot_report.py --workers 4 --out boot_report.json
+
+Har bir rejimda gunicorn vaqtinchalik papkada (alohida elitemc.db bilan) ishga tushiriladi,
+barcha workerlar so'rovga javob berguncha kutiladi, so'ng har bir worker uchun
+RSS / PSS / USS (/proc/<pid>/smaps_rollup) yig'iladi.
+"""
+import argparse
+import json
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def children(pid):
+    try:
+        with open(f'/proc/{pid}/task/{pid}/children') as f:
+            return [int(p) for p in f.read().split()]
+    except OSError:
+        return []
+
+
+def memory_kb(pid):
+    out = {}
+    for path, keys in ((f'/proc/{pid}/status', ('VmRSS',)),
+                       (f'/proc/{pid}/smaps_rollup', ('Pss', 'Private_Clean', 'Private_Dirty'))):
+        try:
+            with open(path) as f:
+                for line in f:
+                    name, _, rest = line.partition(':')
+                    if name in keys:
+                        out[name] = int(rest.split()[0])
+        except OSError:
+            pass
+    return {
+        'rss_kb': out.get('VmRSS'),
+        'pss_kb': out.get('Pss'),
+        'uss_kb': (out['Private_Clean'] + out['Private_Dirty']) if 'Private_Dirty' in out else None,
+    }
+
+
+def run_mode(preload: bool, workers: int, timeout: float):
+    workdir = tempfile.mkdtemp(prefix='elitemc-boot-')
+    port = free_port()
+    env = dict(os.environ, PORT=str(port), WEB_CONCURRENCY=str(workers), GUNICORN_PRELOAD='1' if preload else '0')
+    started = time.perf_counter()
+    proc = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '-c', os.path.join(ROOT, 'gunicorn.conf.py'),
+         '--chdir', workdir, '--pythonpath', ROOT, 'main:create_app()'],
+        env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        ready_at = None
+        while time.perf_counter() - started < timeout:
+            if len(children(proc.pid)) >= workers:
+                try:
+                    urllib.request.urlopen(f'http://127.0.0.1:{port}/api/stats', timeout=1).read()
+                    ready_at = time.perf_counter()
+                    break
+                except OSError:
+                    pass
+            time.sleep(0.02)
+        if ready_at is None:
+            raise RuntimeError('gunicorn belgilangan vaqtda tayyor bo\'lmadi')
+        # Har bir worker kamida bitta so'rovga javob berib, o'z importlarini tugatishi uchun
+        for _ in range(workers * 4):
+            urllib.request.urlopen(f'http://127.0.0.1:{port}/api/stats', timeout=2).read()
+        time.sleep(0.5)
+        worker_mem = [dict(pid=pid, **memory_kb(pid)) for pid in children(proc.pid)]
+        return {
+            'preload': preload,
+            'workers': workers,
+            'startup_ms': round((ready_at - started) * 1000, 1),
+            'master': memory_kb(proc.pid),
+            'worker_memory': worker_mem,
+            'total_pss_kb': sum(w['pss_kb'] or 0 for w in worker_mem) + (memory_kb(proc.pid)['pss_kb'] or 0),
+        }
+    finally:
+        proc.send_signal(signal.SIGTERM)
+        proc.wait(timeout=10)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument('--workers', type=int, default=4)
+    ap.add_argument('--timeout', type=float, default=60)
+    ap.add_argument('--out', default='boot_report.json')
+    args = ap.parse_args()
+
+    results = [run_mode(False, args.workers, args.timeout), run_mode(True, args.workers, args.timeout)]
+    for r in results:
+        label = 'preload' if r['preload'] else 'no-preload'
+        pss = [w['pss_kb'] for w in r['worker_memory']]
+        print(f"{label:>11}: startup {r['startup_ms']:8.1f} ms | total PSS {r['total_pss_kb'] / 1024:7.1f} MB"
+              f" | worker PSS {', '.join(f'{p / 1024:.1f}' for p in pss if p)} MB")
+    with open(args.out, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"→ {args.out}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,279 @@
+"""
+Mahalliy soxta Minecraft server: RCON va Java Server List Ping protokollari.
+
+Benchmark va oflayn tekshiruvlar uchun — haqiqiy o'yin serverisiz execute_purchase,
+buy_token_custom va get_real_online kod yo'llarini ishlatish imkonini beradi.
+Javob kechikishi, xato inyeksiyasi va ulanishlar chegarasi sozlanadi; har bir qabul qilingan
+RCON buyrug'i yoziladi.
+
+    python tools/fakemc.py --rcon-port 25575 --status-port 25565 --password test \\
+        --latency-ms 20 --jitter-ms 5 --error-rate 0.05 --max-connections 8
+"""
+import argparse
+import json
+import random
+import socket
+import struct
+import threading
+import time
+
+RCON_AUTH = 3
+RCON_EXEC = 2
+RCON_AUTH_RESPONSE = 2
+RCON_RESPONSE = 0
+
+ERROR_MODES = ('drop', 'message', 'auth')
+
+
+def _recv_exact(conn, n):
+    data = b''
+    while len(data) < n:
+        chunk = conn.recv(n - len(data))
+        if not chunk:
+            raise ConnectionError('client closed')
+        data += chunk
+    return data
+
+
+class _TCPServer:
+    """
+    latency/jitter — har bir javob oldidan kutish (soniya);
+    error_rate — javoblarning qancha qismi xato bilan tugashi (0..1), seed bilan takrorlanadi;
+    max_connections — bir vaqtdagi ulanishlar chegarasi, oshganlari darhol yopiladi.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, jitter=0.0, error_rate=0.0,
+                 max_connections=None, seed=None):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((host, port))
+        self.sock.listen(128)
+        self.host, self.port = self.sock.getsockname()
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.max_connections = max_connections
+        self.stats = {'connections': 0, 'rejected': 0, 'active': 0, 'peak_active': 0, 'errors': 0}
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def start(self):
+        threading.Thread(target=self._accept_loop, daemon=True).start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        try:
+            # close() o'zi bloklangan accept() ni uzmaydi — port ochiq qolib ketadi
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _accept_loop(self):
+        while not self._stop.is_set():
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            with self._lock:
+                if self.max_connections is not None and self.stats['active'] >= self.max_connections:
+                    self.stats['rejected'] += 1
+                    conn.close()
+                    continue
+                self.stats['connections'] += 1
+                self.stats['active'] += 1
+                self.stats['peak_active'] = max(self.stats['peak_active'], self.stats['active'])
+            threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    def _serve(self, conn):
+        try:
+            with conn:
+                self.handle(conn)
+        except (ConnectionError, OSError, struct.error):
+            pass
+        finally:
+            with self._lock:
+                self.stats['active'] -= 1
+
+    def delay(self):
+        pause = self.latency + (self._rng.uniform(0, self.jitter) if self.jitter else 0)
+        if pause > 0:
+            time.sleep(pause)
+
+    def should_fail(self):
+        if not self.error_rate:
+            return False
+        with self._lock:
+            failed = self._rng.random() < self.error_rate
+            if failed:
+                self.stats['errors'] += 1
+        return failed
+
+    def handle(self, conn):
+        raise NotImplementedError
+
+
+class FakeRconServer(_TCPServer):
+    """
+    error_mode: 'drop' — javobsiz ulanishni uzadi, 'message' — error_message matnini qaytaradi,
+    'auth' — autentifikatsiyani rad etadi.
+    """
+
+    def __init__(self, password='test', host='127.0.0.1', port=0, error_mode='drop',
+                 error_message='An unexpected error occurred trying to execute that command', **kwargs):
+        super().__init__(host, port, **kwargs)
+        if error_mode not in ERROR_MODES:
+            raise ValueError(f'error_mode: {ERROR_MODES}')
+        self.password = password
+        self.error_mode = error_mode
+        self.error_message = error_message
+        self.commands = []
+        self.log = []
+
+    def respond(self, command: str) -> str:
+        return f'OK: {command}'
+
+    def handle(self, conn):
+        authed = False
+        while True:
+            (length,) = struct.unpack('<i', _recv_exact(conn, 4))
+            payload = _recv_exact(conn, length)
+            req_id, req_type = struct.unpack('<ii', payload[:8])
+            body = payload[8:-2].decode('utf8')
+            self.delay()
+            if req_type == RCON_AUTH:
+                authed = body == self.password and not (self.error_mode == 'auth' and self.should_fail())
+                self._send(conn, req_id if authed else -1, RCON_AUTH_RESPONSE, '')
+            elif req_type == RCON_EXEC and authed:
+                failed = self.error_mode != 'auth' and self.should_fail()
+                with self._lock:
+                    self.commands.append(body)
+                    self.log.append({'at': time.time(), 'request_id': req_id, 'command': body, 'failed': failed})
+                if failed and self.error_mode == 'drop':
+                    return
+                text = self.error_message if failed else self.respond(body)
+                # vanilla server uzun javobni 4096 belgilik bo'laklarga ajratib, bir xil id bilan yuboradi
+                for i in range(0, max(len(text), 1), 4096):
+                    self._send(conn, req_id, RCON_RESPONSE, text[i:i + 4096])
+            elif authed:
+                # vanilla server kabi: noma'lum tur o'sha id bilan qaytariladi (pipelining sentinel)
+                self._send(conn, req_id, RCON_RESPONSE, f'Unknown request {req_type:x}')
+            else:
+                self._send(conn, -1, RCON_RESPONSE, '')
+
+    @staticmethod
+    def _send(conn, req_id, req_type, body):
+        payload = struct.pack('<ii', req_id, req_type) + body.encode('utf8') + b'\x00\x00'
+        conn.sendall(struct.pack('<i', len(payload)) + payload)
+
+
+def _read_varint(conn):
+    value = 0
+    for i in range(5):
+        (byte,) = _recv_exact(conn, 1)
+        value |= (byte & 0x7F) << (7 * i)
+        if not byte & 0x80:
+            return value
+    raise ValueError('varint too long')
+
+
+def _varint(value):
+    out = b''
+    value &= 0xFFFFFFFF
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if value:
+            out += bytes([byte | 0x80])
+        else:
+            return out + bytes([byte])
+
+
+class FakeStatusServer(_TCPServer):
+    """Xato inyeksiyasida status so'rovi javobsiz uziladi (server o'chgan holat)."""
+
+    def __init__(self, online=42, max_players=2026, host='127.0.0.1', port=0, **kwargs):
+        super().__init__(host, port, **kwargs)
+        self.online = online
+        self.max_players = max_players
+        self.requests = 0
+
+    def status_json(self):
+        return {
+            'version': {'name': '1.21.1', 'protocol': 767},
+            'players': {'online': self.online, 'max': self.max_players},
+            'description': {'text': 'EliteMC fake server'},
+        }
+
+    def handle(self, conn):
+        while True:
+            length = _read_varint(conn)
+            packet = _recv_exact(conn, length)
+            packet_id = packet[0]
+            if packet_id == 0x00 and len(packet) > 1:
+                continue  # handshake
+            if packet_id == 0x00:
+                with self._lock:
+                    self.requests += 1
+                self.delay()
+                if self.should_fail():
+                    return
+                data = json.dumps(self.status_json()).encode('utf8')
+                body = b'\x00' + _varint(len(data)) + data
+                conn.sendall(_varint(len(body)) + body)
+            elif packet_id == 0x01:
+                conn.sendall(_varint(len(packet)) + packet)
+                return
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument('--host', default='127.0.0.1')
+    ap.add_argument('--rcon-port', type=int, default=25575)
+    ap.add_argument('--status-port', type=int, default=25565)
+    ap.add_argument('--password', default='test')
+    ap.add_argument('--latency-ms', type=float, default=0)
+    ap.add_argument('--jitter-ms', type=float, default=0)
+    ap.add_argument('--error-rate', type=float, default=0)
+    ap.add_argument('--error-mode', choices=ERROR_MODES, default='drop')
+    ap.add_argument('--max-connections', type=int)
+    ap.add_argument('--online', type=int, default=42)
+    ap.add_argument('--seed', type=int)
+    ap.add_argument('--log', help="qabul qilingan buyruqlarni JSONL faylga yozish (to'xtatilganda)")
+    args = ap.parse_args()
+
+    common = dict(host=args.host, latency=args.latency_ms / 1000, jitter=args.jitter_ms / 1000,
+                  error_rate=args.error_rate, max_connections=args.max_connections, seed=args.seed)
+    rcon = FakeRconServer(password=args.password, port=args.rcon_port, error_mode=args.error_mode, **common).start()
+    status = FakeStatusServer(online=args.online, port=args.status_port, **common).start()
+    print(f'  RCON   {rcon.host}:{rcon.port} (parol: {args.password})')
+    print(f'  Status {status.host}:{status.port}')
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        rcon.stop()
+        status.stop()
+        print(f'\n  RCON: {len(rcon.commands)} buyruq, {rcon.stats}')
+        print(f'  Status: {status.requests} so\'rov, {status.stats}')
+        if args.log:
+            with open(args.log, 'w') as f:
+                for entry in rcon.log:
+                    f.write(json.dumps(entry) + '\n')
+
+
+if __name__ == '__main__':
+    main()